@@ -0,0 +1,203 @@
+"""
+aio.py
+
+classes:
+  AsyncDB
+"""
+import time
+from collections import deque
+from Queue import Full
+from threading import Lock
+from db import DB
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+class AsyncDB(object):
+    """
+    Event loop friendly wrapper around a DB. Reads of the in-memory data stay synchronous;
+    everything that waits on the disk returns a future instead. Durable writes are resolved
+    by the journal's worker thread, and loading, compaction and locked transactions run on
+    an executor so lock waits and file I/O never block the loop. Writes are queued from the
+    loop unless the journal's queue is full, in which case they wait for room on the
+    executor (see _write).
+
+    Needs asyncio, or trollius on Python 2 (where futures are awaited with ``yield From(...)``).
+    """
+
+    def __init__(self, db, loop=None, executor=None):
+        """
+        :param db: The DB to wrap
+        :param loop: Event loop the futures belong to, defaults to the current one
+        :param executor: Executor for blocking work, defaults to the loop's
+        """
+        if asyncio is None:
+            raise ImportError('AsyncDB needs asyncio (or trollius on Python 2)')
+        self.db = db
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor
+        # Writes waiting for room in the journal's queue, as (queue, durability, future); see _write
+        self._backlog = deque()
+        self._backlog_mutex = Lock()
+
+    @classmethod
+    def open(cls, file_name='', loop=None, executor=None, **options):
+        """
+        Open (and load) a database on the executor.
+        :param options: Passed on to DB
+        :return: Future of the AsyncDB
+        """
+        if asyncio is None:
+            raise ImportError('AsyncDB needs asyncio (or trollius on Python 2)')
+        loop = loop or asyncio.get_event_loop()
+        return loop.run_in_executor(executor, lambda: cls(DB(file_name, **options), loop, executor))
+
+    def __getitem__(self, key):
+        """
+        Value of a key. A missing key is set to the default value, as DB does, but through
+        _write so a full queue never blocks the loop.
+        """
+        db = self.db
+        if key in db._data or db._journal.readonly:
+            return db[key]
+        value = db._data.default_factory()
+        self._write(lambda block: (db._set(key, value, None, block), value), 'queued')
+        return value
+    get = __getitem__
+
+    def __contains__(self, key):
+        return self.db.has_key(key)
+
+    def keys(self):
+        return self.db.keys()
+
+    def size(self):
+        return self.db.size()
+
+    def set(self, key, value, durability='written', ttl=None):
+        """
+        Set a key. It is visible in memory at once, unless the journal's queue is full and it
+        waits in the backlog (see _write); the future resolves to the value once the record has
+        reached the durability (see Journal.wait).
+        :param ttl: Seconds until the key expires, see DB.set
+        """
+        expires = None if ttl is None else time.time() + ttl
+        return self._write(lambda block: (self.db._set(key, value, expires, block), value), durability)
+
+    def delete(self, key, durability='written'):
+        """Delete a key; the future resolves to the old value once the delete has reached the durability."""
+        return self._write(lambda block: self.db._delete(key, block), durability)
+
+    def update(self, d, durability='written', ttl=None):
+        """
+        Set several keys as one batch record; the future resolves once it has reached the durability.
+        :param ttl: Seconds until the keys expire, see DB.set
+        """
+        if not d:
+            return self._when(None, durability, None)
+        expires = None if ttl is None else time.time() + ttl
+        return self._write(lambda block: (self.db._update(d, expires, block), None), durability)
+
+    def flush(self, fsync=False):
+        """
+        Future resolving once every write made so far is written (and, optionally, fsynced),
+        including the ones still waiting in the backlog.
+        """
+        return self._write(lambda block: (self.db._journal.queued, True), 'fsynced' if fsync else 'written')
+
+    def load(self):
+        """Sync with the journal on the executor."""
+        return self._run(self.db.load)
+
+    def compact(self):
+        """Compact the journal on the executor."""
+        return self._run(self.db.compact)
+
+    def lock(self, fn, *args):
+        """
+        Run fn(db, *args) on the executor inside db.lock(): an exclusive transaction across
+        processes, see DB.lock. The lock is waited for on the executor, never on the loop.
+        :return: Future of fn's result
+        """
+        def transaction():
+            with self.db.lock():
+                return fn(self.db, *args)
+        return self._run(transaction)
+
+    def close(self):
+        """Write out the queued records and close the database on the executor."""
+        return self._run(self.db.close)
+
+    def _run(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def _write(self, queue, durability):
+        """
+        Queue a write without blocking the loop. If the journal's queue is full (and the
+        journal does not raise Queue.Full), the write joins a backlog that the executor feeds
+        to the journal in order, waiting for room; later writes queue up behind it.
+        :param queue: Function of whether to block, queueing the write and returning
+                      (sequence number, result)
+        :return: Future of the result, once the write has reached the durability
+        """
+        with self._backlog_mutex:
+            if not self._backlog:
+                try:
+                    sequence, result = queue(False)
+                except Full:
+                    if self.db._journal.overflow == 'raise':
+                        raise
+                else:
+                    return self._when(sequence, durability, result)
+            future = asyncio.Future(loop=self.loop)
+            self._backlog.append((queue, durability, future))
+            if len(self._backlog) == 1:
+                self._run(self._drain)
+        return future
+
+    def _drain(self):
+        """Executor task: queue the backlog's writes one by one, waiting for room."""
+        with self._backlog_mutex:
+            queue, durability, future = self._backlog[0]
+        while True:
+            try:
+                outcome = queue(True)
+            except Exception as e:
+                outcome = e
+            self.loop.call_soon_threadsafe(self._queued, outcome, durability, future)
+            with self._backlog_mutex:
+                self._backlog.popleft()
+                if not self._backlog:
+                    return
+                queue, durability, future = self._backlog[0]
+
+    def _queued(self, outcome, durability, future):
+        """Resolve the future of a backlogged write once it is queued (or failed to be)."""
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            self._when(outcome[0], durability, outcome[1], future)
+
+    def _when(self, sequence, durability, result, future=None):
+        """
+        Future resolving to result once a record reaches a durability (at once for sequence None).
+        :param future: Future to resolve, defaults to a new one
+        """
+        if future is None:
+            future = asyncio.Future(loop=self.loop)
+
+        def resolve():
+            if not future.done():
+                future.set_result(result)
+
+        if sequence is None:
+            resolve()
+        else:
+            self.db._journal.when(sequence, durability, lambda: self.loop.call_soon_threadsafe(resolve))
+        return future
@@ -0,0 +1,54 @@
+"""
+bench
+
+Benchmarks for daybreak's hot paths.
+"""
+import os
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def scratch():
+    """Yield a temporary directory for benchmark journals, removed afterwards."""
+    path = tempfile.mkdtemp(prefix='daybreak-bench-')
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def timed(fn, *args, **kwargs):
+    """
+    Call a function and measure it.
+    :return: (seconds elapsed, return value)
+    """
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - start, result
+
+
+def write_journal(path, formatter, records):
+    """Write records straight to a new journal file, bypassing the write queue."""
+    with open(path, 'wb') as f:
+        f.write(formatter.create_header())
+        for record in records:
+            f.write(formatter.serialize(record))
+    return os.path.getsize(path)
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    """
+    Summarize latency samples.
+    :return: dict of 'p50' style keys (plus min, max and mean) to seconds
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    result = {'min': samples[0], 'max': samples[-1], 'mean': sum(samples) / len(samples)}
+    for point in points:
+        index = min(len(samples) - 1, int(round(point / 100.0 * (len(samples) - 1))))
+        result['p%s' % ('%g' % point).replace('.', '_')] = samples[index]
+    return result
@@ -0,0 +1,49 @@
+"""
+Command line entry point: python -m daybreak.bench [benchmark ...] [--scale N] [--output FILE]
+
+Prints (or writes) one JSON document, so runs can be stored and compared over time.
+"""
+import sys
+import json
+import time
+import platform
+from argparse import ArgumentParser
+from daybreak.bench import writes, loads, contention, formats
+
+BENCHMARKS = {
+    'writes': writes.run,
+    'loads': loads.run,
+    'contention': contention.run,
+    'formats': formats.run,
+}
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m daybreak.bench', description="Benchmark daybreak's hot paths.")
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run: {} (default: all)'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply the size of every benchmark')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: {}'.format(', '.join(sorted(unknown))))
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'results': {},
+    }
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        report['results'][name] = BENCHMARKS[name](args.scale)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    sys.exit(main())
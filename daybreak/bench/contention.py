@@ -0,0 +1,51 @@
+"""
+bench/contention.py
+
+Several processes writing to (and syncing from) one journal at the same time.
+"""
+import os
+import time
+from multiprocessing import Process
+from daybreak.db import DB
+from daybreak.bench import scratch
+
+
+def writer(path, name, records, sync_every):
+    """Process body: write records, syncing with the other writers every `sync_every`."""
+    db = DB(path)
+    for i in xrange(records):
+        db['%s-%d' % (name, i % 1000)] = i
+        if sync_every and i % sync_every == 0:
+            db.load()
+    db.close()
+
+
+def contention(processes=4, records=20000, sync_every=1000):
+    """
+    :return: dict with the combined records per second and the final journal size
+    """
+    with scratch() as path:
+        journal = os.path.join(path, 'contention.db')
+        DB(journal).close()
+        workers = [Process(target=writer, args=(journal, 'p%d' % n, records, sync_every))
+                   for n in xrange(processes)]
+        start = time.time()
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        seconds = time.time() - start
+        db = DB(journal)
+        result = {
+            'processes': processes,
+            'records': processes * records,
+            'seconds': seconds,
+            'records_per_second': processes * records / seconds,
+            'logsize': db.logsize(),
+        }
+        db.close()
+    return result
+
+
+def run(scale=1.0):
+    return [contention(processes, int(20000 * scale)) for processes in (1, 2, 4)]
@@ -0,0 +1,68 @@
+"""
+bench/formats.py
+
+Compares load time of the journal format versions, and of journals with and without
+compressed values.
+Run with: python -m daybreak.bench.formats
+"""
+import os
+import json
+import random
+from daybreak.db import DB
+from daybreak.format import DefaultFormat, CompressedFormat
+from daybreak.bench import scratch, timed, write_journal
+
+
+def sample_records(records, keys, seed=0):
+    """Records with a mix of value types, overwriting `keys` distinct keys."""
+    rand = random.Random(seed)
+    values = [
+        lambda: rand.randint(0, 1 << 30),
+        lambda: rand.random(),
+        lambda: 'value-%d' % rand.randint(0, 1 << 30),
+        lambda: {'id': rand.randint(0, 1000), 'tags': ['a', 'b'], 'score': rand.random()},
+    ]
+    return [['key-%d' % rand.randint(0, keys - 1), rand.choice(values)()] for _ in xrange(records)]
+
+
+def document_records(records, keys, seed=0):
+    """Records whose values are repetitive JSON documents, the kind compression is for."""
+    rand = random.Random(seed)
+    return [['key-%d' % rand.randint(0, keys - 1), json.dumps({
+        'id': rand.randint(0, 1 << 30),
+        'status': rand.choice(['open', 'pending', 'done']),
+        'owner': 'user-%d' % rand.randint(0, 1000),
+        'tags': rand.sample(['alpha', 'beta', 'gamma', 'delta'], 2),
+        'updated': '2016-%02d-%02dT%02d:00:00Z' % (rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 23)),
+    })] for _ in xrange(records)]
+
+
+def load_time(formatter, records):
+    """
+    Time opening (and so loading) a journal written with the given formatter.
+    :return: dict with seconds, bytes on disk and records per second
+    """
+    with scratch() as path:
+        journal = os.path.join(path, 'bench.db')
+        size = write_journal(journal, formatter, records)
+        seconds, db = timed(DB, journal, formatter)
+        db.close()
+    return {'seconds': seconds, 'bytes': size, 'records_per_second': len(records) / seconds}
+
+
+def run(scale=1.0):
+    """
+    Load the same records written as version 1 and as version 2, and JSON documents
+    written without and with compression.
+    """
+    data = sample_records(int(100000 * scale), int(10000 * scale) or 1)
+    result = dict(('v%d' % version, load_time(DefaultFormat(version), data)) for version in (1, 2))
+    documents = document_records(int(100000 * scale), int(10000 * scale) or 1)
+    dictionary = CompressedFormat.train(value for _, value in documents[:1000])
+    result['documents'] = load_time(DefaultFormat(), documents)
+    result['documents_compressed'] = load_time(CompressedFormat(dictionary), documents)
+    return result
+
+
+if __name__ == '__main__':
+    print json.dumps(run(), indent=2, sort_keys=True)
@@ -0,0 +1,51 @@
+"""
+bench/loads.py
+
+Load and compaction benchmarks over journals of different sizes and overwrite ratios.
+"""
+import os
+from daybreak.db import DB
+from daybreak.format import DefaultFormat
+from daybreak.bench import scratch, timed, write_journal
+
+
+def journal_records(records, overwrite):
+    """
+    Records where roughly `overwrite` of them rewrite an existing key.
+    :param overwrite: Fraction between 0 (every key distinct) and 1
+    """
+    keys = max(1, int(records * (1 - overwrite)))
+    return [['key-%d' % (i % keys), {'n': i, 'payload': 'x' * 32}] for i in xrange(records)]
+
+
+def load_and_compact(records, overwrite, **options):
+    """
+    Time a cold load and a compaction of one journal.
+    :return: dict with seconds, bytes before and after compaction and live keys
+    """
+    with scratch() as path:
+        journal = os.path.join(path, 'load.db')
+        size = write_journal(journal, DefaultFormat(), journal_records(records, overwrite))
+        load, db = timed(DB, journal, **options)
+        compact, _ = timed(db.compact)
+        result = {
+            'records': records,
+            'overwrite': overwrite,
+            'keys': db.size(),
+            'bytes': size,
+            'load_seconds': load,
+            'compact_seconds': compact,
+            'compacted_bytes': os.path.getsize(journal),
+        }
+        db.close()
+    return result
+
+
+def run(scale=1.0):
+    results = []
+    for records in (10000, 100000):
+        for overwrite in (0.0, 0.5, 0.9):
+            results.append(load_and_compact(int(records * scale), overwrite))
+    results.append(dict(load_and_compact(int(100000 * scale), 0.5, mmap=True), mmap=True))
+    results.append(dict(load_and_compact(int(100000 * scale), 0.5, lazy_values=True), lazy_values=True))
+    return results
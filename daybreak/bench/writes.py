@@ -0,0 +1,82 @@
+"""
+bench/writes.py
+
+Write path benchmarks: sustained set/delete throughput through the journal worker, latency
+of a set until it is durably on disk, and the cost of serializing a record.
+"""
+import os
+import time
+from daybreak.db import DB
+from daybreak.format import DefaultFormat
+from daybreak.bench import scratch, timed, percentiles
+
+
+def throughput(records=100000, keys=10000, delete_every=10, **options):
+    """
+    Sets (and every `delete_every`th record, deletes) as fast as possible, then waits for the
+    worker to drain the queue.
+    :return: dict with queueing and end-to-end records per second
+    """
+    with scratch() as path:
+        db = DB(os.path.join(path, 'throughput.db'), **options)
+        start = time.time()
+        for i in xrange(records):
+            key = 'key-%d' % (i % keys)
+            if delete_every and i % delete_every == 0:
+                del db[key]
+            else:
+                db[key] = i
+        queued = time.time() - start
+        db.flush()
+        total = time.time() - start
+        stats = db._journal.batch_stats()
+        db.close()
+    return {
+        'records': records,
+        'queued_per_second': records / queued,
+        'written_per_second': records / total,
+        'mean_batch': stats['mean'],
+    }
+
+
+def durable_latency(records=2000, fsync='batch', **options):
+    """
+    Time each set_flush, which waits until the record is fsynced.
+    :return: dict of latency percentiles in seconds
+    """
+    samples = []
+    with scratch() as path:
+        db = DB(os.path.join(path, 'latency.db'), fsync=fsync, **options)
+        for i in xrange(records):
+            seconds, _ = timed(db.set_flush, 'key-%d' % i, i)
+            samples.append(seconds)
+        db.close()
+    result = percentiles(samples)
+    result['records'] = records
+    return result
+
+
+def serialization(records=100000, batch=256):
+    """
+    Serialize records one at a time and in batches of `batch` (as the journal worker does).
+    :return: dict of seconds per record for serialize and serialize_many
+    """
+    from daybreak.bench.formats import sample_records
+    formatter = DefaultFormat()
+    data = sample_records(records, records)
+    single, _ = timed(lambda: [formatter.serialize(record) for record in data])
+    many, _ = timed(lambda: [formatter.serialize_many(data[i:i + batch]) for i in xrange(0, len(data), batch)])
+    return {
+        'records': records,
+        'serialize_per_record': single / records,
+        'serialize_many_per_record': many / records,
+    }
+
+
+def run(scale=1.0):
+    return {
+        'serialization': serialization(int(100000 * scale)),
+        'throughput': throughput(int(100000 * scale)),
+        'throughput_linger': throughput(int(100000 * scale), linger=0.005),
+        'durable_latency': durable_latency(int(2000 * scale)),
+    }
@@ -0,0 +1,82 @@
+"""
+checkpoint.py
+
+Snapshots of a database's data, tagged with how much of the journal they cover, so a load
+can start from the snapshot and replay only the journal records written after it.
+
+functions:
+  fingerprint
+  write_checkpoint
+  read_checkpoint
+"""
+import os
+from binascii import crc32
+from copy import copy
+from StringIO import StringIO
+from struct import Struct, pack, unpack_from
+from files import create_temp
+
+# Magic string of checkpoint files
+MAGIC = 'DAYBREAKCKPT'
+
+# Inode and size of the journal prefix covered, its record count, and its fingerprint
+HEADER = Struct('!QQQI')
+
+# Bytes before the covered offset that the fingerprint is taken over
+FINGERPRINT_BYTES = 4096
+
+
+def fingerprint(stream, offset):
+    """CRC of the journal bytes just before offset, telling apart a journal rewritten in place."""
+    start = max(0, offset - FINGERPRINT_BYTES)
+    stream.seek(start)
+    return crc32(stream.read(offset - start)) & 0xffffffff
+
+
+def write_checkpoint(path, data, formatter, inode, offset, count, tail, expires=None):
+    """
+    Atomically write a checkpoint. The data is stored as a single batch record, so it is
+    read back with one CRC check and without evaluating anything.
+    :param data: dict of the data as of offset
+    :param formatter: Formatter of the journal
+    :param inode: Inode of the journal file
+    :param offset: Journal offset the data covers
+    :param count: Number of journal records before offset
+    :param tail: fingerprint of the journal at offset
+    :param expires: dict of key to expiry time, for the keys that have one
+    """
+    expires = expires or {}
+    checkpoint = bytearray(MAGIC) + HEADER.pack(inode, offset, count, tail) + formatter.create_header()
+    checkpoint += formatter.serialize_batch([[key, value, expires[key]] if key in expires else [key, value]
+                                             for key, value in data.iteritems()])
+    checkpoint += pack('!I', crc32(checkpoint) & 0xffffffff)
+    out, temp = create_temp(path, '.tmp')
+    with out:
+        out.write(checkpoint)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(temp, path)
+
+
+def read_checkpoint(path, formatter):
+    """
+    Read a checkpoint written by write_checkpoint.
+    :param formatter: Formatter of the journal (the checkpoint records its own version)
+    :return: (inode, offset, count, tail, generator of records), or None if there is no
+             intact checkpoint
+    """
+    try:
+        with open(path, 'rb') as f:
+            checkpoint = f.read()
+    except IOError:
+        return None
+    start = len(MAGIC) + HEADER.size
+    if len(checkpoint) < start + 4 or not checkpoint.startswith(MAGIC):
+        return None
+    if unpack_from('!I', checkpoint, len(checkpoint) - 4)[0] != crc32(checkpoint[:-4]) & 0xffffffff:
+        return None
+    inode, offset, count, tail = HEADER.unpack_from(checkpoint, len(MAGIC))
+    stream = StringIO(checkpoint[start:-4])
+    reader = copy(formatter)
+    reader.read_header(stream)
+    return inode, offset, count, tail, reader.deserialize(stream.read())
@@ -3,23 +3,96 @@ db.py
 
 Main functions for daybreak.
 """
-import toolz
+import os
+import time
 from toolz import curry
-from sys import getsizeof
 from collections import defaultdict
-from journal import Journal
+from heapq import heappush, heappop, heapify
+from contextlib import contextmanager
+from Queue import Full
+from threading import Thread, RLock
+from journal import Journal, JournalReplaced
 from format import DefaultFormat
+from keydir import LazyValues
+from stats import deep_sizeof
+from checkpoint import fingerprint, write_checkpoint, read_checkpoint
+from index import SortedKeys, ValueIndex, successor
+
+
+# Stands for a key that is not in the data, see DB._save
+MISSING = object()
 
 
 class DB(object):
 
-    def __init__(self, file_name='', formatter=None):
+    # Most expired keys a sweep drops before letting other threads at the data
+    SWEEP_BATCH = 1000
+
+    def __init__(self, file_name='', formatter=None, compact_ratio=None, compact_min=1000, lazy_values=False,
+                 cache_bytes=1 << 24, autoload=True, checkpoint_records=None, checkpoint_bytes=None, ordered=False,
+                 poll_interval=1.0, sweep_interval=1.0, **options):
+        """
+        Open (or create) a database.
+        :param file_name: Path to the journal file
+        :param formatter: Record formatter, defaults to DefaultFormat
+        :param compact_ratio: Compact in the background once the journal holds this many
+                              records per live key (None disables auto-compaction)
+        :param compact_min: Never auto-compact journals with fewer records than this
+        :param lazy_values: Keep only each key's location in memory and read values from the
+                            journal when they are accessed
+        :param cache_bytes: With lazy_values, how many bytes of values to keep cached
+        :param autoload: Load the journal now; otherwise it is up to the caller (see load and _restore)
+        :param checkpoint_records: Checkpoint in the background every this many journal records
+        :param checkpoint_bytes: Checkpoint in the background every this many journal bytes
+                                 (neither works with lazy_values or segment_bytes, see checkpoint)
+        :param ordered: Keep a sorted index of the keys, so range and prefix scans read only
+                        the keys they return
+        :param poll_interval: With readonly=True, seconds between checks of the journal's size
+                              and inode for new records (None to sync only on load)
+        :param sweep_interval: Seconds between background sweeps for expired keys (None to drop
+                               them only as they are accessed), see set and sweep
+        :param options: Passed on to the Journal, see Journal.__init__
+        """
+        if (checkpoint_records or checkpoint_bytes) and (lazy_values or options.get('segment_bytes')):
+            raise ValueError('Checkpoints need the values in memory and a single journal file')
         self.file_name = file_name
-        self._data = defaultdict(lambda: None)
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._compactor = None
+        self.checkpoint_path = file_name + '.checkpoint'
+        self.checkpoint_records = checkpoint_records
+        self.checkpoint_bytes = checkpoint_bytes
+        # Journal record count and offset covered by the last checkpoint
+        self._checkpointed = (0, 0)
+        self._checkpointer = None
+        self._mutex = RLock()
+        self.lazy_values = lazy_values
         if formatter is None:
             formatter = DefaultFormat()
-        self._journal = Journal(file_name, formatter)
-        self.load()
+        if lazy_values:
+            formatter.require('lazy_values', 'deserialize_stream', 'locations', 'load_value')
+        if compact_ratio:
+            formatter.require('compact_ratio', 'deserialize_stream', 'load_value')
+        self._journal = Journal(file_name, formatter, **options)
+        if lazy_values:
+            self._data = LazyValues(self._journal, lambda: None, cache_bytes)
+        else:
+            self._data = defaultdict(lambda: None)
+        self._ordered = SortedKeys() if ordered else None
+        self._indexes = {}
+        # Expiry time of every key set with a ttl, and a heap of (expiry time, key) to sweep
+        # them in order; entries for keys set again since are skipped when they come up
+        self._expires = {}
+        self._expiring = []
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+        self.poll_interval = poll_interval
+        if autoload:
+            self.load()
+        if self._journal.readonly and poll_interval:
+            self._poller = Thread(target=self._poll)
+            self._poller.daemon = True
+            self._poller.start()
 
     def file(self):
         """Returns database file name."""
@@ -32,59 +105,373 @@ class DB(object):
     def __getitem__(self, key):
         """Retrieve a value at key from the database."""
         if key not in self._data:
+            if self._journal.readonly:
+                return self._data.default_factory()
             self.set(key, self._data.default_factory())
+        elif self._expires and self._expired(key):
+            # Not stored, or the key would outlive its expiry
+            return self._data.default_factory()
         return self._data[key]
     get = __getitem__
 
     @curry
-    def __setitem__(self, key, value):
-        """Set a key in the database to be written at some future date."""
-        self._data[key] = value
-        self._journal << [key, value]
+    def __setitem__(self, key, value, durability='queued', ttl=None):
+        """
+        Set a key in the database to be written at some future date.
+        :param durability: How far the write must get before returning, see Journal.wait
+        :param ttl: Seconds until the key expires. The expiry time is stored in the record;
+                    once it passes, the key is gone for reads and is dropped from memory when
+                    accessed or swept (see sweep), and from the journal by the next load or
+                    compaction. None keeps the key until it is deleted.
+        """
+        expires = None if ttl is None else time.time() + ttl
+        self._journal.wait(self._set(key, value, expires), durability)
         return value
     set = __setitem__
 
     @curry
     def set_flush(self, key, value):
-        """Flushes data immediately to disk."""
-        return self.set(key, value)
+        """Set a key and wait until it is fsynced to disk."""
+        return self.set(key, value, durability='fsynced')
 
-    def __delitem__(self, key):
+    def __delitem__(self, key, durability='queued'):
         """Delete a key from the database."""
-        self._journal << [key]
-        return self._data.pop(key, None)
+        sequence, value = self._delete(key)
+        self._journal.wait(sequence, durability)
+        return value
     delete = __delitem__
 
     def delete_flush(self, key):
-        """Immediately delete the key on disk."""
-        return self.delete(key)
+        """Delete a key and wait until the delete is fsynced to disk."""
+        return self.delete(key, durability='fsynced')
 
-    def update(self, d):
-        """Update database with dict (Fast batch update)."""
-        [self.set(*x) for x in d.iteritems()]
-        return toolz.merge(self._data, d)
+    def update(self, d, durability='queued', ttl=None):
+        """
+        Update database with dict (Fast batch update). The keys are queued and written as a
+        single batch record, which is replayed all or nothing.
+        :param durability: How far the write must get before returning, see Journal.wait
+        :param ttl: Seconds until the keys expire, see set
+        """
+        if d:
+            expires = None if ttl is None else time.time() + ttl
+            self._journal.wait(self._update(d, expires), durability)
 
     def update_flush(self, d):
-        """Update database with dict (Fast batch update)."""
-        return self.update(d)
+        """Update database with dict and wait until it is fsynced to disk."""
+        return self.update(d, durability='fsynced')
+
+    def _set(self, key, value, expires=None, block=None):
+        """
+        Set a key in memory and queue its record.
+        :param expires: Time the key expires at, None for never
+        :param block: Whether to wait for room in a full queue, see Journal.append
+        :return: The record's sequence number
+        """
+        self._journal.writable()
+        self._check_expiry(expires)
+        saved = self._save((key,)) if self._refusable(block) else None
+        try:
+            if expires is None and not self._expires:
+                return self._put(key, value, [key, value], block)
+            # Keeps the sweeper from dropping the key between the two updates
+            with self._mutex:
+                self._expire(key, expires)
+                return self._put(key, value, [key, value] if expires is None else [key, value, expires], block)
+        except Full:
+            self._put_back(saved)
+            raise
+
+    def _put(self, key, value, record, block):
+        """Set a key in memory and the indexes and queue its record (see _set)."""
+        self._data[key] = value
+        if self._ordered is not None or self._indexes:
+            with self._journal.stats.timer('index'):
+                self._index(key, value)
+        return self._queue(record, block)
+
+    def _delete(self, key, block=None):
+        """
+        Delete a key in memory and queue its record.
+        :param block: Whether to wait for room in a full queue, see Journal.append
+        :return: (sequence number, old value)
+        """
+        self._journal.writable()
+        sequence = self._queue([key], block)
+        if self._ordered is not None or self._indexes:
+            with self._journal.stats.timer('index'):
+                self._unindex(key)
+        self._expires.pop(key, None)
+        return sequence, self._data.pop(key, None)
+
+    def _update(self, d, expires=None, block=None):
+        """
+        Set several keys in memory and queue them as one batch.
+        :param expires: Time the keys expire at, None for never
+        :param block: Whether to wait for room in a full queue, see Journal.append
+        :return: The batch's sequence number
+        """
+        self._journal.writable()
+        self._check_expiry(expires)
+        saved = self._save(d) if self._refusable(block) else None
+        try:
+            if expires is None and not self._expires:
+                return self._put_many(d, None, block)
+            with self._mutex:
+                for key in d:
+                    self._expire(key, expires)
+                return self._put_many(d, expires, block)
+        except Full:
+            self._put_back(saved)
+            raise
+
+    def _check_expiry(self, expires):
+        """Raise ValueError if an expiry time is given but the journal's format cannot store it."""
+        if expires is not None and not self._journal.formatter.stores_expiry():
+            raise ValueError('The journal format cannot store expiry times, so a ttl would be lost on reload')
+
+    def _refusable(self, block):
+        """Whether the journal's queue may refuse a record (raising Queue.Full) rather than wait for room."""
+        return block is False or (block is None and self._journal.overflow == 'raise')
+
+    def _save(self, keys):
+        """
+        Remember how keys stand in memory, for _put_back to undo a write the journal's queue
+        refused (see _refusable).
+        :return: List of (key, value or MISSING (location state, with lazy_values), expiry time or None)
+        """
+        data = self._data
+        if self.lazy_values:
+            return [(key, data.state(key), self._expires.get(key)) for key in keys]
+        return [(key, data.get(key, MISSING), self._expires.get(key)) for key in keys]
+
+    def _put_back(self, saved):
+        """
+        Restore keys in memory, the indexes and the expiry times, as _save found them. Holds
+        the mutex, as _expire changes the heap the sweeper pops from.
+        """
+        data = self._data
+        with self._mutex:
+            for key, entry, expires in saved:
+                if self.lazy_values:
+                    data.reset(key, entry)
+                elif entry is MISSING:
+                    data.pop(key, None)
+                else:
+                    data[key] = entry
+                self._expire(key, expires)
+                if self._ordered is not None or self._indexes:
+                    if key in data:
+                        self._index(key, data[key])
+                    else:
+                        self._unindex(key)
+
+    def _put_many(self, d, expires, block):
+        """Set several keys in memory and the indexes and queue them as one batch (see _update)."""
+        records = []
+        for key, value in d.iteritems():
+            self._data[key] = value
+            records.append([key, value] if expires is None else [key, value, expires])
+        if self._ordered is not None or self._indexes:
+            with self._journal.stats.timer('index'):
+                for key, value in d.iteritems():
+                    self._index(key, value)
+        return self._queue(tuple(records), block)
+
+    def _expire(self, key, expires):
+        """Record when a key expires (None for never), starting the sweeper if it is not running yet."""
+        if expires is None:
+            self._expires.pop(key, None)
+            return
+        self._expires[key] = expires
+        heappush(self._expiring, (expires, key))
+        if len(self._expiring) > 2 * len(self._expires) + self.SWEEP_BATCH:
+            # Mostly entries for keys set again since: rebuild rather than let it grow
+            self._expiring = [(expiry, item) for item, expiry in self._expires.iteritems()]
+            heapify(self._expiring)
+        if self._sweeper is None and self.sweep_interval:
+            self._sweeper = Thread(target=self._sweep)
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+    def _expired(self, key):
+        """
+        Drop a key from memory if its expiry time has passed.
+        :return: True if it was dropped
+        """
+        expires = self._expires.get(key)
+        if expires is None or expires > time.time():
+            return False
+        with self._mutex:
+            if self._expires.get(key) != expires:
+                # Set again in the meantime
+                return False
+            self._evict(key)
+        return True
+
+    def _evict(self, key):
+        """Drop an expired key from memory and the indexes (its records stay in the journal)."""
+        del self._expires[key]
+        self._data.pop(key, None)
+        if self._ordered is not None or self._indexes:
+            self._unindex(key)
+        self._journal.stats.incr('expired')
+
+    def sweep(self, limit=None):
+        """
+        Drop the keys whose expiry time has passed from memory, soonest first. Only the keys
+        due are looked at, so a sweep costs O(k log n) for k expired keys. The background
+        sweeper does this every sweep_interval seconds, SWEEP_BATCH keys at a time.
+        :param limit: Drop at most this many keys
+        :return: Number of keys dropped
+        """
+        now = time.time()
+        dropped = 0
+        with self._mutex:
+            heap = self._expiring
+            while heap and heap[0][0] <= now and (limit is None or dropped < limit):
+                expires, key = heappop(heap)
+                if self._expires.get(key) == expires:
+                    self._evict(key)
+                    dropped += 1
+        return dropped
+
+    def _swept(self):
+        """The data in memory, once the keys whose expiry time has passed are dropped (see sweep)."""
+        if self._expires:
+            self.sweep()
+        return self._data
+
+    def _sweep(self):
+        """Background thread: drop expired keys every sweep_interval seconds until the database is closed."""
+        while True:
+            time.sleep(self.sweep_interval)
+            if self.closed():
+                break
+            while self.sweep(self.SWEEP_BATCH) == self.SWEEP_BATCH:
+                pass
+
+    def _queue(self, record, block=None):
+        """Queue a record for the journal (see Journal.append), compacting if it has grown too large."""
+        sequence = self._journal.append(record, block)
+        if self.compact_ratio:
+            self._auto_compact()
+        if self.checkpoint_records or self.checkpoint_bytes:
+            self._auto_checkpoint()
+        return sequence
 
     def has_key(self, key):
         """Does this db have this key?"""
-        return key in self._data
+        return key in self._data and not (self._expires and self._expired(key))
     include = has_key
     is_member = has_key
 
-    def has_value(self, value):
-        """Does this db have this value?"""
-        return value in self._data.values()
+    def has_value(self, value, index=None):
+        """
+        Does this db have this value?
+        :param index: Name of a secondary index (see create_index) to look the value up in
+                      instead, i.e. check if any value has this as its indexed field
+        """
+        data = self._swept()
+        if index is not None:
+            return value in self._indexes[index]
+        return value in data.values()
+
+    def create_index(self, name, fn):
+        """
+        Declare a secondary index on a field of the values, e.g.
+
+            db.create_index('status', lambda value: value['status'])
+
+        It is built from the data now and kept up to date by every write and load after.
+        Values fn raises KeyError, IndexError, TypeError or AttributeError for are left out.
+        :param name: Name to query the index by (see find)
+        :param fn: Function of a value to its indexed field, which must be hashable
+        """
+        with self._journal.stats.timer('index_build'):
+            self._indexes[name] = ValueIndex(fn, self._data.iteritems())
+
+    def drop_index(self, name):
+        """Remove a secondary index."""
+        del self._indexes[name]
+
+    def find(self, index, field):
+        """
+        Look up the items whose value has a field, through a secondary index (see create_index).
+        :return: List of key, value pairs
+        """
+        data = self._data
+        return [(key, data[key]) for key in self._indexes[index].find(field)
+                if key in data and not (self._expires and self._expired(key))]
 
     def size(self):
         """Return the number of stored items."""
-        return len(self._data.values())
+        return len(self._swept())
 
     def bytesize(self):
-        """Utility method that will return the size of the database in bytes."""
-        return getsizeof(self._data)
+        """
+        Estimate the memory held by the database's keys and values, in bytes. Large databases
+        are extrapolated from a sample of their items.
+        """
+        if not self.lazy_values:
+            return deep_sizeof(self._data)
+        data = self._data
+        with data.mutex:
+            pending = dict(data.pending)
+        return deep_sizeof(data.keydir) + deep_sizeof(pending) + deep_sizeof(data.cache)
+
+    def stats(self):
+        """
+        Report what the database has been doing: queue depth, records and bytes written and
+        read, latency histograms (in seconds) for writes, flushes, fsyncs, lock waits, loads and
+        deserialization, batch sizes, the share of writes coalesced away, CRC failures, bytes
+        dropped by crash recovery, keys expired, time spent maintaining and building indexes
+        and an estimate of live data memory.
+        :return: dict of metrics
+        """
+        journal = self._journal
+        result = journal.stats.snapshot()
+        result.update({
+            'queue_depth': journal.qsize(),
+            'keys': self.size(),
+            'logsize': journal.count,
+            'coalesce_ratio': journal.batch_stats()['coalesce_ratio'],
+            'memory_bytes': self.bytesize(),
+        })
+        return result
+
+    def add_stats_hook(self, callback, interval=10):
+        """
+        Export metrics: call callback(db.stats()) every `interval` seconds from a background
+        thread until the database is closed.
+        """
+        def report():
+            while True:
+                time.sleep(interval)
+                if self.closed():
+                    break
+                callback(self.stats())
+        thread = Thread(target=report)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _poll(self):
+        """Read-only databases: load whenever the journal file's size or inode changes."""
+        seen = None
+        while True:
+            time.sleep(self.poll_interval)
+            if self.closed():
+                break
+            try:
+                stat = os.stat(self.file_name)
+            except OSError:
+                continue
+            with self.synchronize():
+                if self.closed():
+                    break
+                if (stat.st_ino, stat.st_size) != seen:
+                    self.load()
+                    seen = stat.st_ino, stat.st_size
 
     def logsize(self):
         """Counter of how many records are in the journal."""
@@ -92,51 +479,291 @@ class DB(object):
 
     def is_empty(self):
         """Return true if database is empty."""
-        return bool(self._data)
+        return bool(self._swept())
 
     def __iter__(self):
         """Iterate over the key, value pairs in the database."""
-        return iter(self._data.items())
+        return iter(self._swept().items())
 
     def keys(self):
         """Return the keys in the db."""
-        return self._data.keys()
+        return self._swept().keys()
+
+    def range(self, start=None, end=None, reverse=False):
+        """
+        Lazily iterate over the key, value pairs with keys from start (inclusive) to end
+        (exclusive) in key order. With DB(..., ordered=True) this costs O(log n + k) for k
+        keys; otherwise the keys are sorted first.
+        :param start: Lowest key, None for no lower bound
+        :param end: Key to stop before, None for no upper bound
+        :param reverse: Iterate from the highest key down
+        """
+        index = self._ordered if self._ordered is not None else SortedKeys(self._data.keys())
+        data = self._data
+        for key in index.irange(start, end, reverse):
+            if key in data and not (self._expires and self._expired(key)):
+                yield key, data[key]
+
+    def prefix(self, prefix, reverse=False):
+        """Lazily iterate over the key, value pairs whose keys start with prefix, in key order (see range)."""
+        return self.range(prefix, successor(prefix), reverse)
 
-    def flush(self):
-        """Flush all changes to disk."""
-        self.update(self._data)
+    def flush(self, fsync=False, timeout=None):
+        """
+        Wait until every change made so far is written to the journal file.
+        :param fsync: Also wait until it is on stable storage
+        :param timeout: Seconds to wait at most
+        :return: True if the changes were flushed, False on timeout
+        """
+        return self._journal.flush(fsync, timeout)
 
     def load(self):
-        """Sync the database with what is on disk."""
-        self._data = defaultdict(self._data.default_factory, dict(self._journal.load()))
+        """
+        Sync the database with what is on disk. Only records appended since the last sync are
+        applied, unless another process replaced the journal, which forces a full reload. A full
+        load starts from the checkpoint, if there is a valid one, and replays the records after it.
+        """
+        journal = self._journal
+        with self._mutex, journal.stats.timer('load'):
+            while True:
+                try:
+                    if journal.replaced() or journal.pos == 0:
+                        self.clear()
+                        if self._resume():
+                            self._apply(journal.replay(self.lazy_values))
+                        else:
+                            self._apply(journal.load(self.lazy_values))
+                    else:
+                        self._apply(journal.replay(self.lazy_values))
+                    return
+                except JournalReplaced:
+                    # Swapped for a compacted file after the check above: start over from it
+                    continue
     sunrise = load
 
+    def checkpoint(self):
+        """
+        Write a snapshot of the data with the journal offset it covers, so a full load reads
+        the snapshot and replays only the journal records written after it. The journal is
+        locked only while the data is copied. Lazily loaded and segmented databases load from
+        hint files instead and cannot checkpoint.
+        """
+        journal = self._journal
+        if self.lazy_values or journal.segment_bytes:
+            raise ValueError('Checkpoints need the values in memory and a single journal file')
+        with self.lock():
+            data = dict(self._data)
+            expires = dict(self._expires)
+            offset, count, inode = journal.pos, journal.count, journal.inode
+            with journal.random_mutex:
+                tail = fingerprint(journal.random, offset)
+        with journal.stats.timer('checkpoint'):
+            write_checkpoint(self.checkpoint_path, data, journal.formatter, inode, offset, count, tail, expires)
+        self._checkpointed = (count, offset)
+
+    def _resume(self):
+        """
+        Take the data from the checkpoint, if it was written for the journal as it is now.
+        :return: True if it was; the journal records after it still need replaying
+        """
+        journal = self._journal
+        if self.lazy_values or journal.segment_bytes:
+            return False
+        checkpoint = read_checkpoint(self.checkpoint_path, journal.formatter)
+        if checkpoint is None:
+            return False
+        inode, offset, count, tail, records = checkpoint
+        journal.flush()
+        if not journal.restore(offset, count, inode):
+            return False
+        with journal.random_mutex:
+            if os.fstat(journal.random.fileno()).st_size < offset or fingerprint(journal.random, offset) != tail:
+                return False
+        self._apply(records)
+        self._checkpointed = (count, offset)
+        journal.stats.incr('checkpoint_loads')
+        return True
+
+    def _restore(self, live, end, count, inode):
+        """
+        Take the data from a snapshot of the journal (see Journal.restore), falling back to a
+        full load if the journal was replaced since.
+        :param live: dict of key to the rest of its last record: [value] or [value, expiry
+                     time] (value locations instead of values, with lazy_values)
+        """
+        self._journal.flush()
+        if not self._journal.restore(end, count, inode):
+            return self.load()
+        self.clear()
+        self._apply([key] + state for key, state in live.iteritems())
+
+    def _apply(self, records):
+        """
+        Apply journal records (sets and deletes) to the in-memory data and the indexes. Sets
+        whose expiry time has passed are applied as deletes.
+        """
+        data = self._data
+        if self._ordered is None and not self._indexes:
+            return self._apply_unordered(records)
+        if not data:
+            # Loading from scratch: build the indexes once at the end
+            self._apply_unordered(records)
+            with self._journal.stats.timer('index_build'):
+                self._reindex()
+            return
+        stats = self._journal.stats
+        for record in records:
+            self._apply_unordered((record,))
+            with stats.timer('index'):
+                if record[0] not in data:
+                    self._unindex(record[0])
+                elif self.lazy_values:
+                    self._index(record[0], data[record[0]])
+                else:
+                    self._index(record[0], record[1])
+
+    def _index(self, key, value):
+        """Add a key with its new value to the key index and the secondary indexes."""
+        if self._ordered is not None:
+            self._ordered.add(key)
+        for index in self._indexes.itervalues():
+            index.add(key, value)
+
+    def _unindex(self, key):
+        """Remove a key from the key index and the secondary indexes."""
+        if self._ordered is not None:
+            self._ordered.discard(key)
+        for index in self._indexes.itervalues():
+            index.discard(key)
+
+    def _reindex(self):
+        """Rebuild the key index and the secondary indexes from the data."""
+        if self._ordered is not None:
+            self._ordered.reset(self._data.keys())
+        for index in self._indexes.itervalues():
+            index.reset(self._data.iteritems())
+
+    def _apply_unordered(self, records):
+        """Apply journal records to the in-memory data only."""
+        data = self._data
+        expires = self._expires
+        now = time.time()
+        if self.lazy_values:
+            for record in records:
+                if len(record) == 2:
+                    data.locate(record[0], record[1])
+                elif len(record) == 1 or record[2] <= now:
+                    data.discard(record[0])
+                else:
+                    data.locate(record[0], record[1])
+                    self._expire(record[0], record[2])
+                    continue
+                if expires:
+                    expires.pop(record[0], None)
+            return
+        for record in records:
+            if len(record) == 2:
+                data[record[0]] = record[1]
+            elif len(record) == 1 or record[2] <= now:
+                data.pop(record[0], None)
+            else:
+                data[record[0]] = record[1]
+                self._expire(record[0], record[2])
+                continue
+            if expires:
+                expires.pop(record[0], None)
+
+    @contextmanager
     def lock(self):
-        """Lock the database for an exclusive commit across processes and threads."""
-        # TODO: This lock should be a subclass with methods __enter__ and __exit__ so developers can user as:
-        #    with db.lock:
-        #        pass
-        pass
+        """
+        Lock the database for an exclusive commit across processes and threads:
+
+            with db.lock():
+                db['counter'] += 1
+
+        The records other processes appended since our last sync are applied first, and the
+        block's writes are on disk before the lock is released.
+        """
+        with self.synchronize():
+            with self._journal.transaction():
+                self.load()
+                yield self
 
+    @contextmanager
     def synchronize(self):
-        """Synchronize access to the database from multiple threads."""
-        pass
+        """Synchronize access to the database from multiple threads (of this process only)."""
+        with self._mutex:
+            yield self
 
     def clear(self, flush=False):
         """Remove all keys and values from the database."""
         if flush:
             self._journal.clear()
-        return self._data.clear()
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+        result = self._data.clear()
+        self._expires.clear()
+        del self._expiring[:]
+        self._reindex()
+        return result
+
+    def recover(self, keep=True):
+        """
+        Repair the journal after a crash and load what is left of it. A torn record at the
+        end is truncated and damaged regions in the middle are cut out, keeping the records
+        around them; open with DB(..., recover=True) to do this before the first load.
+        :param keep: Save the bytes dropped aside, in file_name.torn and file_name.quarantine
+        :return: What was dropped, see Journal.recover
+        """
+        with self.synchronize():
+            report = self._journal.recover(keep)
+            self.load()
+        return report
 
     def compact(self):
-        """Compact the database to remove stale commits and reduce the file size."""
-        self._journal.clear()
-        self.flush()
+        """
+        Compact the database to remove stale commits and expired keys and reduce the file size.
+        The compacted journal is swapped in atomically, so other processes never see a partial file.
+        """
+        return self._journal.compact()
+
+    def migrate(self, formatter=None):
+        """
+        Rewrite the journal in another format, by default the latest DefaultFormat version.
+        Journals in older formats stay readable (and writable) without migrating.
+        """
+        return self._journal.compact(formatter or DefaultFormat())
+
+    def _auto_compact(self):
+        """Start a background compaction if the journal has grown too far past the live data."""
+        logsize = self._journal.count
+        if logsize < self.compact_min or logsize < self.compact_ratio * len(self._data):
+            return
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = Thread(target=self.compact)
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _auto_checkpoint(self):
+        """Start a background checkpoint once enough has been written since the last one."""
+        count, offset = self._checkpointed
+        journal = self._journal
+        if count > journal.count:
+            # Compacted since
+            count, offset = 0, 0
+        if not ((self.checkpoint_records and journal.count - count >= self.checkpoint_records) or
+                (self.checkpoint_bytes and journal.pos - offset >= self.checkpoint_bytes)):
+            return
+        if self._checkpointer is None or not self._checkpointer.is_alive():
+            self._checkpointer = Thread(target=self.checkpoint)
+            self._checkpointer.daemon = True
+            self._checkpointer.start()
 
     def close(self):
         """Close the database for reading and writing."""
-        self.clear()
-        self._journal.close()
+        with self.synchronize():
+            self.clear()
+            self._journal.close()
 
     def closed(self):
         """Checks if the database connection has been closed."""
@@ -144,7 +771,7 @@ class DB(object):
 
     def values(self):
         """Returns a list of the internal dictionary values."""
-        return self._data.values()
+        return self._swept().values()
 
     def __del__(self):
         """A handler that will ensure that databases are closed and synced when the current process exits."""
@@ -0,0 +1,25 @@
+"""
+files.py
+
+Helpers for files that are written aside and renamed over their target, shared by the journal,
+its segments, checkpoints and crash recovery.
+
+functions:
+  create_temp
+"""
+import os
+import tempfile
+from stat import S_IMODE
+
+
+def create_temp(path, suffix):
+    """
+    Create a uniquely named file next to path, to be renamed over it once written.
+    :return: (file opened for reading and writing, its path)
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(suffix, name + '.', directory)
+    if os.path.exists(path):
+        # mkstemp makes the file private to its owner; keep the permissions path has
+        os.fchmod(fd, S_IMODE(os.stat(path).st_mode))
+    return os.fdopen(fd, 'wb+'), temp
@@ -4,13 +4,16 @@ format.py
 classes:
   BaseFormat
   DefaultFormat
+  CompressedFormat
 """
 from abc import ABCMeta, abstractmethod
-from struct import pack, unpack
-from StringIO import StringIO
+from collections import Counter
+from struct import Struct, pack, unpack, unpack_from
 from toolz import first
 from binascii import crc32
+import marshal
 import json
+import zlib
 
 
 class BaseFormat(object):
@@ -39,11 +42,40 @@ class BaseFormat(object):
     def serialize(self, data):
         """
         Serializes data into a compatible database record string.
-        :param data: Must be a list with one or two items (1=delete, 2=[key, value])
+        :param data: Must be a list with one to three items (1=delete, 2=[key, value],
+                     3=[key, value, expiry time in seconds since the epoch])
         :return: Data as compatible database record string
         """
         pass
 
+    def serialize_many(self, records):
+        """
+        Serializes several records, each applied on its own, into one buffer. Formats should
+        override this if they can do it cheaper than serializing the records one by one.
+        :param records: List of records as for serialize
+        :return: Data as compatible database record string
+        """
+        return bytearray().join(self.serialize(record) for record in records)
+
+    def serialize_batch(self, records):
+        """
+        Serializes several records to be applied all or nothing. Formats without batch
+        records fall back to serializing them one by one (and lose the atomicity).
+        :param records: List of records as for serialize
+        :return: Data as compatible database record string
+        """
+        return bytearray().join(self.serialize(record) for record in records)
+
+    def encode_key(self, key):
+        """
+        Keys are stored as byte strings; unicode keys are UTF-8 encoded. ShardedDB also picks
+        a key's shard from this encoding.
+        :return: The key as a byte string
+        """
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return str(key)
+
     @abstractmethod
     def deserialize(self, string):
         """
@@ -53,64 +85,503 @@ class BaseFormat(object):
         """
         pass
 
+    def deserialize_stream(self, stream, chunk_size=1 << 16, size=None, locate=False):
+        """
+        Parses records from a file object as they are read. Formats that can parse chunks
+        incrementally should override this; the default reads everything first.
+        :param stream: Python file buffer positioned at the first record
+        :param chunk_size: Number of bytes to read at a time
+        :param size: Number of bytes to read, defaults to the rest of the stream
+        :param locate: Yield where each value is stored (see locations) instead of the value
+        :return: Generator of records as Python lists
+        """
+        if locate:
+            raise NotImplementedError
+        return self.deserialize(stream.read() if size is None else stream.read(size))
+
+    def records(self, buf, offset, size=None):
+        """
+        Parses every complete record in a buffer (needed for the mmap read path).
+        :param buf: memoryview or mmap over serialized records
+        :param offset: Offset of the first record in buf
+        :param size: Offset in buf to stop parsing at, defaults to its length
+        :return: Generator of (record, offset just past the record)
+        """
+        raise NotImplementedError
+
+    def locations(self, buf, offset, size=None, base=0):
+        """
+        Like records, but a set yields [key, (value offset, value size, tag)] rather than the
+        value itself (needed for lazily loaded values).
+        :param base: File offset of buf, added to the value offsets
+        """
+        raise NotImplementedError
+
+    def load_value(self, tag, value):
+        """
+        Decodes a value found by locations.
+        :param tag: The tag returned by locations
+        :param value: The value bytes
+        """
+        raise NotImplementedError
+
+    def stores_expiry(self):
+        """
+        Whether records can carry an expiry time (see serialize). Formats that cannot keep
+        the default, and DB refuses a ttl rather than have the key come back after a reload.
+        """
+        return False
+
+    def expiring(self, tag):
+        """
+        Whether a value found by locations carries an expiry time (see expiry). Formats
+        that cannot store expiry times keep the default.
+        :param tag: The tag returned by locations
+        """
+        return False
+
+    def expiry(self, value):
+        """
+        Reads the expiry time stored with a value for which expiring is True.
+        :param value: The value bytes, or at least their start
+        :return: Seconds since the epoch
+        """
+        raise NotImplementedError
+
+    def require(self, feature, *methods):
+        """
+        Check that the format implements the optional methods a feature parses the journal
+        with, so it fails when the journal is opened rather than at the first read.
+        :param feature: What needs them, for the error message
+        :param methods: Names of BaseFormat methods whose defaults raise NotImplementedError
+                        (deserialize_stream: its locate=True)
+        :raise ValueError: Naming the first method left to BaseFormat
+        """
+        for name in methods:
+            if getattr(type(self), name).__func__ is getattr(BaseFormat, name).__func__:
+                raise ValueError('{} needs a format implementing {}, which {} does not'.format(
+                    feature, name, type(self).__name__))
+
 
 class FormatException(Exception):
     pass
 
 
+class CRCException(FormatException):
+    pass
+
+
+def to_bytes(view):
+    """Copy a memoryview slice to a string (slices of an mmap already are strings)."""
+    return view if isinstance(view, str) else view.tobytes()
+
+
 class DefaultFormat(BaseFormat):
 
     # Magic string of the file header
     MAGIC = bytearray('DAYBREAK')
 
-    # Database file format version
-    VERSION = 1
+    # Database file format version used for new journals
+    VERSION = 2
+
+    # Database file format versions this class can read and write
+    VERSIONS = (1, 2)
 
     # Special value size used for deleted records
     DELETE = (1 << 32) - 1
 
+    # Value type tags stored with every version 2 record
+    STR, UNICODE, INT, FLOAT, MARSHAL = range(5)
+
+    # Bits of the tag byte holding the value type; the rest are reserved for record flags
+    TYPE_MASK = 0x0f
+
+    # Record flag: a batch of records sharing one CRC (key size holds the record count)
+    BATCH = 0x10
+
+    # Record flag: the value starts with the time it expires at (see EXPIRY)
+    EXPIRES = 0x40
+
+    # Version 2 record header (key size, value size, tag) and CRC
+    RECORD = Struct('!IIB')
+    CRC = Struct('!I')
+
+    # Expiry time of an EXPIRES record, in seconds since the epoch
+    EXPIRY = Struct('!d')
+
+    def __init__(self, version=None):
+        """
+        :param version: File format version for new journals, defaults to VERSION. Existing
+                        journals keep the version recorded in their header.
+        """
+        self.version = self.VERSION if version is None else version
+        if self.version not in self.VERSIONS:
+            raise FormatException("Unsupported database version {}".format(self.version))
+
     def read_header(self, stream):
         stream.seek(0)
         if stream.read(len(self.MAGIC)) != self.MAGIC:
             raise FormatException('Not a Daybreak database')
         version = first(unpack('!H', stream.read(2)))
-        if version != self.VERSION:
+        if version not in self.VERSIONS:
             raise FormatException("Expected database version {}, got {}".format(self.VERSION, version))
+        self.version = version
 
     def create_header(self):
-        return bytearray(self.MAGIC) + bytearray(pack('!H', self.VERSION))
+        return bytearray(self.MAGIC) + bytearray(pack('!H', self.version))
 
     def serialize(self, data):
-        data[0] = bytearray(str(data[0]))
+        if self.version == 1:
+            return self.serialize_v1(data)
+        return self.serialize_many((data,))
+
+    def serialize_many(self, records):
+        """
+        Packs the headers and CRCs with precompiled structs, computes each CRC from the
+        pieces instead of from a copy of the record, and copies everything into the result
+        in a single join.
+        """
+        if self.version == 1:
+            return BaseFormat.serialize_many(self, records)
+        parts = []
+        add = parts.extend
+        pack_header, pack_crc = self.RECORD.pack, self.CRC.pack
+        encode_key, encode_value = self.encode_key, self.encode_value
+        for record in records:
+            key = encode_key(record[0])
+            if len(record) == 1:
+                header, value = pack_header(len(key), self.DELETE, self.STR), ''
+            else:
+                tag, value = encode_value(record[1])
+                if len(record) > 2:
+                    tag, value = tag | self.EXPIRES, self.EXPIRY.pack(record[2]) + value
+                header = pack_header(len(key), len(value), tag)
+            add((header, key, value, pack_crc(crc32(value, crc32(key, crc32(header))) & 0xffffffff)))
+        return bytearray(''.join(parts))
+
+    def serialize_batch(self, records):
+        if self.version == 1:
+            return BaseFormat.serialize_batch(self, records)
+        body = bytearray().join(self.encode_record(record) for record in records)
+        batch = bytearray(self.RECORD.pack(len(records), len(body), self.BATCH)) + body
+        return batch + bytearray(self.crc32(batch))
+
+    def encode_record(self, data):
+        """A version 2 record without its CRC."""
+        key = self.encode_key(data[0])
+        if len(data) == 1:
+            return bytearray(self.RECORD.pack(len(key), self.DELETE, self.STR)) + key
+        tag, value = self.encode_value(data[1])
+        if len(data) > 2:
+            tag, value = tag | self.EXPIRES, self.EXPIRY.pack(data[2]) + value
+        return bytearray(self.RECORD.pack(len(key), len(value), tag)) + key + value
+
+    def serialize_v1(self, data):
+        """Version 1 records have nowhere to put an expiry time, so keys are stored without one."""
+        key = bytearray(str(data[0]))
         if len(data) == 1:
-            record = bytearray(pack('!II', len(data[0]), self.DELETE)) + data[0]
+            record = bytearray(pack('!II', len(key), self.DELETE)) + key
         else:
-            if data[1] is dict:
-                data[1] = json.dumps(data[1])
-            data[1] = bytearray(str(data[1]))
-            record = bytearray(pack('!II', len(data[0]), len(data[1]))) + data[0] + data[1]
+            value = data[1]
+            if value is dict:
+                value = json.dumps(value)
+            value = bytearray(str(value))
+            record = bytearray(pack('!II', len(key), len(value))) + key + value
         return record + bytearray(self.crc32(record))
 
+    def encode_value(self, value):
+        """
+        Picks the cheapest codec for a value.
+        :return: (type tag, encoded value)
+        """
+        kind = type(value)
+        if kind is str:
+            return self.STR, value
+        if kind is unicode:
+            return self.UNICODE, value.encode('utf-8')
+        if kind is int:
+            return self.INT, pack('!q', value)
+        if kind is float:
+            return self.FLOAT, pack('!d', value)
+        try:
+            return self.MARSHAL, marshal.dumps(value, 2)
+        except ValueError:
+            # Not a builtin type: stored as its string form, like version 1 did
+            return self.STR, str(value)
+
+    def decode_value(self, tag, value):
+        """
+        Decodes a value written by encode_value.
+        :param tag: Type tag of the record
+        :param value: memoryview (or mmap slice) of the encoded value
+        """
+        kind = tag & self.TYPE_MASK
+        if kind == self.STR:
+            return to_bytes(value)
+        if kind == self.UNICODE:
+            return to_bytes(value).decode('utf-8')
+        if kind == self.INT:
+            return unpack_from('!q', value)[0]
+        if kind == self.FLOAT:
+            return unpack_from('!d', value)[0]
+        if kind == self.MARSHAL:
+            return marshal.loads(to_bytes(value))
+        raise FormatException("Unknown value type {}".format(kind))
+
     def deserialize(self, string):
-        string = StringIO(string)
-        while string.tell() < string.len:
-            meta = string.read(8)
-            key_size, value_size = unpack('!II', meta)
+        buf = memoryview(bytearray(string))
+        offset = 0
+        for record, offset in self.records(buf, 0):
+            yield record
+        if offset != len(buf):
+            raise FormatException("Truncated record at offset {}".format(offset))
+
+    def deserialize_stream(self, stream, chunk_size=1 << 16, size=None, locate=False):
+        base = stream.tell() if locate else 0
+        pending = bytearray()
+        while size is None or size > 0:
+            chunk = stream.read(chunk_size if size is None else min(chunk_size, size))
+            if not chunk:
+                break
+            if size is not None:
+                size -= len(chunk)
+            pending += chunk
+            buf = memoryview(pending)
+            offset = 0
+            if locate:
+                for record, offset in self.locations(buf, 0, None, base):
+                    yield record
+            else:
+                for record, offset in self.records(buf, 0):
+                    yield record
+            # The view must be gone before the bytearray can be resized.
+            del buf
+            del pending[:offset]
+            base += offset
+        if pending:
+            raise FormatException("Truncated record at end of stream")
+
+    def frames(self, buf, offset, size=None):
+        """
+        Finds and CRC checks every complete record in a buffer, stopping at the first incomplete one.
+        :param buf: memoryview or mmap over serialized records
+        :param offset: Offset of the first record in buf
+        :param size: Offset in buf to stop parsing at, defaults to its length
+        :return: Generator of (key, tag, value offset, value size or None for a delete, record end)
+        """
+        if size is None:
+            size = len(buf)
+        typed = self.version > 1
+        meta = 9 if typed else 8
+        tag = None
+        while offset + meta <= size:
+            if typed:
+                key_size, value_size, tag = unpack_from('!IIB', buf, offset)
+            else:
+                key_size, value_size = unpack_from('!II', buf, offset)
+            batch = typed and tag & self.BATCH
             data_size = key_size
-            if value_size != self.DELETE:
+            if batch:
+                data_size = value_size
+            elif value_size != self.DELETE:
                 data_size += value_size
-            data = string.read(data_size)
-            if string.read(4) != self.crc32(meta + data):
-                raise FormatException("CRC mismatch: your data might be corrupted!")
+            end = offset + meta + data_size + 4
+            if end > size:
+                break
+            if to_bytes(buf[end - 4:end]) != self.crc32(buf[offset:end - 4]):
+                raise CRCException("CRC mismatch: your data might be corrupted!")
+            if batch:
+                for frame in self.batch_frames(buf, offset + meta, end - 4, key_size, end):
+                    yield frame
+            else:
+                key = to_bytes(buf[offset + meta:offset + meta + key_size])
+                if value_size == self.DELETE:
+                    yield key, tag, None, None, end
+                else:
+                    yield key, tag, end - 4 - value_size, value_size, end
+            offset = end
+
+    def batch_frames(self, buf, offset, stop, count, end):
+        """
+        Finds the records inside a batch whose CRC has been checked. They all end where the batch does.
+        :param offset: Offset of the first record in the batch
+        :param stop: Offset the batch's records end at
+        :param count: Number of records in the batch
+        :param end: Offset just past the batch
+        """
+        for _ in xrange(count):
+            if offset + 9 > stop:
+                break
+            key_size, value_size, tag = unpack_from('!IIB', buf, offset)
+            start = offset + 9
+            offset = start + key_size
+            key = to_bytes(buf[start:offset])
             if value_size == self.DELETE:
-                yield [data[:key_size]]
+                yield key, tag, None, None, end
             else:
-                value = data[-value_size:]
-                try:
-                    value = eval(value)
-                except:
-                    pass
-                yield [data[:key_size], value]
+                yield key, tag, offset, value_size, end
+                offset += value_size
+        if offset != stop:
+            raise FormatException("Malformed batch record")
+
+    def records(self, buf, offset, size=None):
+        for key, tag, start, length, end in self.frames(buf, offset, size):
+            if length is None:
+                yield [key], end
+            elif tag is not None and tag & self.EXPIRES:
+                expires = self.EXPIRY.unpack_from(buf, start)[0]
+                yield [key, self.load_value(tag, buf[start:start + length]), expires], end
+            else:
+                yield [key, self.load_value(tag, buf[start:start + length])], end
+
+    def locations(self, buf, offset, size=None, base=0):
+        for key, tag, start, length, end in self.frames(buf, offset, size):
+            if length is None:
+                yield [key], end
+            elif tag is not None and tag & self.EXPIRES:
+                yield [key, (base + start, length, tag), self.EXPIRY.unpack_from(buf, start)[0]], end
+            else:
+                yield [key, (base + start, length, tag)], end
+
+    def load_value(self, tag, value):
+        if self.version > 1:
+            if tag & self.EXPIRES:
+                value = value[self.EXPIRY.size:]
+            return self.decode_value(tag, value)
+        value = to_bytes(value)
+        try:
+            return eval(value)
+        except:
+            return value
+
+    def stores_expiry(self):
+        # Version 1 records have no tag to flag an expiry time with
+        return self.version > 1
+
+    def expiring(self, tag):
+        return tag is not None and bool(tag & self.EXPIRES)
+
+    def expiry(self, value):
+        return self.EXPIRY.unpack_from(value)[0]
 
     def crc32(self, s):
-        return pack('!I', crc32(str(s)) & 0xffffffff)
+        return pack('!I', crc32(s) & 0xffffffff)
+
+
+class CompressedFormat(DefaultFormat):
+    """
+    DefaultFormat whose values are deflated with a preset dictionary, stored once in the
+    journal header (format version 3). Values shorter than min_size, or which deflate would
+    not shrink by at least an eighth, are stored as they are; a flag in the tag byte tells
+    the two apart, so only values worth it cost any CPU to read or write.
+
+    Python 2's zlib takes no preset dictionary, so the compressor and the decompressor are
+    primed by running the dictionary through them once, and every value continues from a
+    copy of the primed stream.
+    """
+
+    VERSION = 3
+
+    VERSIONS = (1, 2, 3)
+
+    # Record flag: the value is deflated with the dictionary
+    COMPRESSED = 0x20
+
+    # Deflate only looks back this far, so longer dictionaries are cut to their end
+    WINDOW = 1 << 15
+
+    # Length of the fragments train looks for in the sample values
+    FRAGMENT = 16
+
+    def __init__(self, dictionary='', level=6, min_size=64, version=None):
+        """
+        :param dictionary: Preset dictionary for new journals, e.g. from train. Existing
+                           journals keep the dictionary recorded in their header.
+        :param level: zlib compression level
+        :param min_size: Values shorter than this (in bytes, once encoded) are not compressed
+        :param version: File format version for new journals, defaults to VERSION
+        """
+        DefaultFormat.__init__(self, version)
+        self.level = level
+        self.min_size = min_size
+        self.prime(dictionary)
+
+    @classmethod
+    def train(cls, values, size=WINDOW):
+        """
+        Build a dictionary from sample values: the samples made most of fragments common to
+        the others, skipping those mostly covered already, and the most typical last, where
+        deflate reaches them with the shortest distances.
+        :param values: Sample of the values the journal will hold
+        :param size: Maximum size of the dictionary in bytes
+        """
+        encoder = DefaultFormat()
+        samples = []
+        counts = Counter()
+        for value in values:
+            encoded = encoder.encode_value(value)[1]
+            fragments = set(encoded[i:i + cls.FRAGMENT] for i in xrange(len(encoded) - cls.FRAGMENT + 1))
+            if fragments:
+                counts.update(fragments)
+                samples.append((encoded, fragments))
+        samples.sort(key=lambda (encoded, fragments): sum(counts[f] for f in fragments) / float(len(fragments)),
+                     reverse=True)
+        dictionary, covered = '', set()
+        for encoded, fragments in samples:
+            if len(dictionary) + len(encoded) > size or 2 * len(fragments & covered) > len(fragments):
+                continue
+            dictionary = encoded + dictionary
+            covered |= fragments
+        return dictionary
+
+    def prime(self, dictionary):
+        """Switch to another dictionary, priming the compressor and the decompressor with it."""
+        self.dictionary = str(dictionary)[-self.WINDOW:]
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        if self.dictionary:
+            primed = self.compressor.compress(self.dictionary) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.decompressor.decompress(primed)
+
+    def __getstate__(self):
+        # zlib streams cannot be pickled (e.g. for ShardedDB's process pool): prime them again
+        state = self.__dict__.copy()
+        del state['compressor'], state['decompressor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.prime(self.dictionary)
+
+    def read_header(self, stream):
+        DefaultFormat.read_header(self, stream)
+        if self.version < 3:
+            return self.prime('')
+        size = first(unpack('!I', stream.read(4)))
+        dictionary = stream.read(size)
+        if len(dictionary) != size:
+            raise FormatException('Truncated header')
+        if dictionary != self.dictionary:
+            self.prime(dictionary)
+
+    def create_header(self):
+        header = DefaultFormat.create_header(self)
+        if self.version < 3:
+            return header
+        return header + bytearray(pack('!I', len(self.dictionary))) + self.dictionary
+
+    def encode_value(self, value):
+        tag, encoded = DefaultFormat.encode_value(self, value)
+        if self.version < 3 or len(encoded) < self.min_size:
+            return tag, encoded
+        compressor = self.compressor.copy()
+        compressed = compressor.compress(encoded) + compressor.flush()
+        if len(compressed) > len(encoded) - len(encoded) // 8:
+            return tag, encoded
+        return tag | self.COMPRESSED, compressed
+
+    def decode_value(self, tag, value):
+        if tag & self.COMPRESSED:
+            decompressor = self.decompressor.copy()
+            value = decompressor.decompress(to_bytes(value)) + decompressor.flush()
+        return DefaultFormat.decode_value(self, tag, value)
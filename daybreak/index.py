@@ -0,0 +1,215 @@
+"""
+index.py
+
+classes:
+  SortedKeys
+  ValueIndex
+
+functions:
+  successor
+"""
+import sys
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from threading import Lock
+
+
+class SortedKeys(object):
+    """
+    Sorted set of keys for DB(..., ordered=True), kept as a list of sorted blocks of at most
+    a few hundred keys, with the largest key of every block in a separate list. Finding a key
+    is two bisections and adding or removing one moves at most a block, so the index stays
+    cheap to maintain on every write and a range of k keys is read in O(log n + k).
+    """
+
+    # Blocks are split once they hold twice this many keys
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        self.mutex = Lock()
+        self.reset(keys)
+
+    def reset(self, keys=()):
+        """Replace the index with the given keys (sorted in one go, cheaper than adding them one by one)."""
+        keys = sorted(set(keys))
+        with self.mutex:
+            self.blocks = [keys[i:i + self.LOAD] for i in xrange(0, len(keys), self.LOAD)]
+            self.maxes = [block[-1] for block in self.blocks]
+            self.length = len(keys)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, key):
+        with self.mutex:
+            i = bisect_left(self.maxes, key)
+            if i == len(self.maxes):
+                return False
+            block = self.blocks[i]
+            return block[bisect_left(block, key)] == key
+
+    def add(self, key):
+        """Add a key, if it is not in the index yet."""
+        with self.mutex:
+            if not self.maxes:
+                self.blocks.append([key])
+                self.maxes.append(key)
+                self.length = 1
+                return
+            i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+            block = self.blocks[i]
+            j = bisect_left(block, key)
+            if j < len(block) and block[j] == key:
+                return
+            block.insert(j, key)
+            self.maxes[i] = block[-1]
+            self.length += 1
+            if len(block) > 2 * self.LOAD:
+                self.blocks[i:i + 1] = [block[:self.LOAD], block[self.LOAD:]]
+                self.maxes[i:i + 1] = [block[self.LOAD - 1], block[-1]]
+
+    def discard(self, key):
+        """Remove a key, if it is in the index."""
+        with self.mutex:
+            i = bisect_left(self.maxes, key)
+            if i == len(self.maxes):
+                return
+            block = self.blocks[i]
+            j = bisect_left(block, key)
+            if block[j] != key:
+                return
+            del block[j]
+            self.length -= 1
+            if block:
+                self.maxes[i] = block[-1]
+            else:
+                del self.blocks[i]
+                del self.maxes[i]
+
+    def irange(self, start=None, end=None, reverse=False):
+        """
+        Generator of the keys from start (inclusive) to end (exclusive), None meaning
+        unbounded. Keys are read a block at a time, so keys added or removed while iterating
+        are seen or skipped according to where the iteration has got to.
+        """
+        if reverse:
+            return self._descending(start, end)
+        return self._ascending(start, end)
+
+    def _ascending(self, start, end):
+        low, inclusive = start, True
+        while True:
+            with self.mutex:
+                if low is None:
+                    i, j = 0, 0
+                else:
+                    find = bisect_left if inclusive else bisect_right
+                    i = find(self.maxes, low)
+                    j = find(self.blocks[i], low) if i < len(self.blocks) else 0
+                if i == len(self.blocks):
+                    return
+                chunk = self.blocks[i][j:]
+            for key in chunk:
+                if end is not None and key >= end:
+                    return
+                yield key
+            low, inclusive = chunk[-1], False
+
+    def _descending(self, start, end):
+        high = end
+        while True:
+            with self.mutex:
+                if not self.blocks:
+                    return
+                if high is None:
+                    chunk = self.blocks[-1][:]
+                else:
+                    i = min(bisect_left(self.maxes, high), len(self.maxes) - 1)
+                    j = bisect_left(self.blocks[i], high)
+                    if j:
+                        chunk = self.blocks[i][:j]
+                    elif i:
+                        chunk = self.blocks[i - 1][:]
+                    else:
+                        return
+            for key in reversed(chunk):
+                if start is not None and key < start:
+                    return
+                yield key
+            high = chunk[0]
+
+
+class ValueIndex(object):
+    """
+    Secondary index for DB.create_index: which keys have a value whose field (as computed
+    by fn) is what. A reverse map remembers every key's field, so a key can be moved or
+    removed without its old value. Values fn cannot read the field from (it raises KeyError,
+    IndexError, TypeError or AttributeError) and unhashable fields are left out.
+    """
+
+    def __init__(self, fn, items=()):
+        """
+        :param fn: Function of a value to its indexed field
+        :param items: Initial (key, value) pairs
+        """
+        self.fn = fn
+        self.mutex = Lock()
+        self.reset(items)
+
+    def reset(self, items=()):
+        """Replace the index with the given (key, value) pairs."""
+        with self.mutex:
+            self.keys = defaultdict(set)
+            self.fields = {}
+            for key, value in items:
+                self._add(key, value)
+
+    def add(self, key, value):
+        """Index a key's (new) value."""
+        with self.mutex:
+            self._remove(key)
+            self._add(key, value)
+
+    def discard(self, key):
+        """Remove a key from the index."""
+        with self.mutex:
+            self._remove(key)
+
+    def find(self, field):
+        """:return: The keys whose value has the field"""
+        with self.mutex:
+            return list(self.keys.get(field, ()))
+
+    def __contains__(self, field):
+        with self.mutex:
+            return field in self.keys
+
+    def _add(self, key, value):
+        try:
+            field = self.fn(value)
+            self.keys[field].add(key)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return
+        self.fields[key] = field
+
+    def _remove(self, key):
+        if key not in self.fields:
+            return
+        field = self.fields.pop(key)
+        keys = self.keys[field]
+        keys.discard(key)
+        if not keys:
+            del self.keys[field]
+
+
+def successor(prefix):
+    """
+    The smallest string greater than every string starting with prefix, i.e. the end of the
+    range of keys with that prefix (None if there is no such string).
+    """
+    top = 0xff if isinstance(prefix, str) else sys.maxunicode
+    character = chr if isinstance(prefix, str) else unichr
+    for i in reversed(xrange(len(prefix))):
+        if ord(prefix[i]) < top:
+            return prefix[:i] + character(ord(prefix[i]) + 1)
+    return None
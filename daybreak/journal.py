@@ -3,115 +3,1130 @@ journal.py
 
 classes:
   Journal
+  JournalReplaced
 """
 import os
+import time
+import mmap
 import toolz
-from Queue import Queue
-from FileLock import FileLock
-from threading import Thread
+from copy import copy
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from Queue import Queue, Empty, Full
+from lock import create_lock
+from format import FormatException, CRCException
+from segment import segment_path, hint_path, segment_numbers, scan, write_hint, read_hint
+from recovery import repair
+from files import create_temp
+from stats import Stats
+from threading import Thread, Lock, Condition
+
+
+class JournalReplaced(Exception):
+    """
+    Raised by Journal.read when this process switched its writes to a file another process
+    swapped in (e.g. by compacting) since the last read. The records read so far belong to
+    the old file, so the journal has to be loaded again in full (see Journal.load).
+    """
+    pass
 
 
 class Journal(Queue):
     """
     Class for interacting with the database file (or "journal") via a thread-safe Queue.
     """
-    def __init__(self, file_path, formatter):
-        """Initialize the journal with a database file, formatter object, and thread."""
-        Queue.__init__(self)
+
+    # How far a record must get before wait returns, from cheapest to safest
+    DURABILITY = ('queued', 'written', 'fsynced')
+
+    # What queueing a record does when the queue is full
+    OVERFLOW = ('block', 'raise', 'coalesce')
+
+    # Queued to wake the worker up without writing anything
+    WAKE = object()
+
+    def __init__(self, file_path, formatter, linger=0, batch_bytes=1 << 20, fsync='never', locking='flock',
+                 chunk_size=1 << 16, mmap=False, queue_size=0, overflow='block', segment_bytes=None, readonly=False,
+                 recover=False):
+        """
+        Initialize the journal with a database file, formatter object, and thread.
+        :param linger: Seconds the worker waits for more records before committing a batch
+        :param batch_bytes: Commit a batch as soon as its serialized size reaches this many bytes
+        :param fsync: 'never', 'batch' (after every batch) or a number of seconds between fsyncs
+        :param locking: 'flock' for fd-based advisory locks, or 'lockfile' for the FileLock fallback
+        :param chunk_size: Number of bytes read at a time while loading
+        :param mmap: Parse records straight out of a memory map of the journal instead of reading it
+        :param queue_size: Most records (with coalesce, distinct keys) waiting to be written, 0 for no limit
+        :param overflow: When the queue is full, 'block' until there is room or 'raise' Queue.Full.
+                         'coalesce' blocks too, but also merges every queued write to a key into
+                         its latest value (a delete cancels the queued set) before it is written
+        :param segment_bytes: Seal the journal file into a numbered segment with a hint file once
+                              it grows past this many bytes (see segment.py), None to never seal
+        :param readonly: Follow a journal another process writes: no writer thread, no header
+                         written, and no lock taken, so reading never holds the writer up
+                         (see read_committed)
+        :param recover: Check every record of the journal file on open and repair what a crash
+                        left damaged instead of failing to load it (see recover)
+        """
+        if overflow not in self.OVERFLOW:
+            raise ValueError("overflow must be one of {}".format(', '.join(self.OVERFLOW)))
+        self.overflow = overflow
+        Queue.__init__(self, queue_size)
+        if fsync not in ('never', 'batch') and not isinstance(fsync, (int, long, float)):
+            raise ValueError("fsync must be 'never', 'batch' or an interval in seconds")
+        if mmap:
+            formatter.require('mmap=True', 'records')
+        if readonly:
+            formatter.require('readonly=True', 'records')
+        if recover:
+            formatter.require('recover=True', 'locations')
+        if segment_bytes:
+            formatter.require('segment_bytes', 'deserialize_stream', 'load_value')
         self.file_path = file_path
         self.formatter = formatter
+        self.read_format = formatter
+        self.linger = linger
+        self.batch_bytes = batch_bytes
+        self.fsync = fsync
+        self.chunk_size = chunk_size
+        self.mmap = mmap
+        self.segment_bytes = segment_bytes
+        self.readonly = readonly
+        # Offset of a record whose CRC failed once; it is taken as being written until it fails again
+        self.suspect = None
+        # Number the file being read will have once sealed, and the sealed segments read so
+        # far: number -> (open file, formatter)
+        self.segment = None
+        self.sealed = {}
         self.file = None
+        self.reader = None
+        self.random = None
+        self.random_mutex = Lock()
+        self.mapping = None
+        # Called as listener(records, buf, offset, formatter, inode) after each batch is written
+        self.listeners = []
+        self.stats = Stats()
+        self.lock = create_lock(file_path, lambda: self.file.fileno(), 'local' if readonly else locking)
         self.inode = None
+        self.read_inode = None
+        self.stale = False
         self.count = 0
         self.byte_size = 0
         self.pos = 0
+        self.batches = 0
+        self.batch_records = 0
+        self.batch_max = 0
+        self.synced = time.time()
+        self.dirty = False
+        # Sequence numbers of the last record queued, written to the file, and fsynced
+        self.sequence = Lock()
+        self.progress = Condition(Lock())
+        self.queued = 0
+        self.written = 0
+        self.durable = 0
+        self.coalesced = 0
+        # (sequence, durability, callback) to be called by the worker, see when
+        self.callbacks = []
         self.open()
-        self.thread = Thread(target=self.worker)
-        self.thread.daemon = True
-        self.thread.start()
+        # What the last recover found, None if it never ran
+        self.recovery = None
+        if recover and not readonly:
+            self.recover()
+        self.thread = None
+        if not readonly:
+            self.thread = Thread(target=self.worker)
+            self.thread.daemon = True
+            self.thread.start()
 
     def __lshift__(self, record):
         """
         Send record to be processed by the internal thread.
-        :param record: Python list with either [key, value] or [key]
+        :param record: Python list with either [key, value] or [key], or a tuple of such
+                       records to be written as one batch and replayed all or nothing
+        :return: Sequence number of the record, to pass to wait
+        """
+        return self.append(record)
+
+    def append(self, record, block=None):
+        """
+        Queue a record, see __lshift__.
+        :param block: Whether to wait for room in a full queue rather than raise Queue.Full,
+                      defaults to what the overflow policy says. False also raises rather than
+                      wait for another thread that is waiting for room.
+        :return: Sequence number of the record
+        """
+        self.writable()
+        if not self.sequence.acquire(block is not False):
+            raise Full
+        try:
+            self.put(record, self.overflow != 'raise' if block is None else block)
+            return self.queued
+        finally:
+            self.sequence.release()
+
+    def _init(self, maxsize):
+        # Entries are (sequence number of the oldest write they hold, record)
+        if self.overflow == 'coalesce':
+            self.queue = OrderedDict()
+            self.generation = 0
+        else:
+            self.queue = deque()
+        # Set by when to wake the worker; kept out of the queue so it takes no room there and
+        # does not keep later writes from coalescing
+        self.woken = False
+
+    def _put(self, item):
+        self.queued += 1
+        sequence = self.queued
+        if self.overflow != 'coalesce':
+            self.queue.append((sequence, item))
+            return
+        if isinstance(item, list):
+            slot = (self.generation, item[0])
+            if slot in self.queue:
+                self.queue[slot] = (self.queue[slot][0], item)
+                self.coalesced += 1
+                # Queue.put counts a task for this record, but the worker will only take one
+                self.unfinished_tasks -= 1
+                return
+        else:
+            # Batches keep their place: later writes never merge into an entry queued before them
+            self.generation += 1
+            slot = (self.generation,)
+        self.queue[slot] = (sequence, item)
+
+    def _get(self):
+        if self.overflow == 'coalesce':
+            return self.queue.popitem(last=False)[1][1]
+        return self.queue.popleft()[1]
+
+    def take(self, block=True, timeout=None):
+        """
+        The worker's Queue.get: also returns WAKE, once, after when has woken it up.
+        :raise Empty: If there is nothing to take
+        """
+        with self.not_empty:
+            deadline = None if timeout is None else time.time() + timeout
+            while block and not self._qsize() and not self.woken:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+            # The worker calls signal after whatever it takes, which is what waking it is for
+            woken, self.woken = self.woken, False
+            if self._qsize():
+                item = self._get()
+                self.not_full.notify()
+                return item
+            if woken:
+                return self.WAKE
+            raise Empty
+
+    def oldest(self):
+        """Sequence number of the oldest write still queued (if none are, the next one to be)."""
+        with self.mutex:
+            if not self.queue:
+                return self.queued + 1
+            if self.overflow == 'coalesce':
+                return next(self.queue.itervalues())[0]
+            return self.queue[0][0]
+
+    def wait(self, sequence, durability='written', timeout=None):
+        """
+        Block until a queued record has reached the given durability.
+        :param sequence: Sequence number returned when the record was queued
+        :param durability: 'queued' (return at once), 'written' (to the file, so other
+                           processes can read it) or 'fsynced' (on stable storage)
+        :param timeout: Seconds to wait at most, or None to wait as long as it takes
+        :return: True if the record got there, False on timeout
+        """
+        if durability not in self.DURABILITY:
+            raise ValueError("durability must be one of {}".format(', '.join(self.DURABILITY)))
+        if durability == 'queued':
+            return True
+        # With fsync='batch' the worker syncs every batch right after writing it
+        synced_by_worker = durability == 'fsynced' and self.fsync == 'batch'
+        deadline = None if timeout is None else time.time() + timeout
+        with self.progress:
+            while self.written < sequence or (synced_by_worker and self.durable < sequence):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.progress.wait(remaining)
+            if durability == 'written' or self.durable >= sequence:
+                return True
+        self.sync()
+        return True
+
+    def when(self, sequence, durability, callback):
+        """
+        Like wait, but instead of blocking, have callback() called (from the worker thread,
+        or right away if it is already there) once the record has reached the durability.
+        The worker fsyncs as soon as a callback is waiting on it.
+        """
+        if durability not in self.DURABILITY:
+            raise ValueError("durability must be one of {}".format(', '.join(self.DURABILITY)))
+        with self.progress:
+            reached = self.reached(sequence, durability)
+            if not reached:
+                self.callbacks.append((sequence, durability, callback))
+        if reached:
+            callback()
+        else:
+            # Wake the worker, which may be idle with the record written but not yet fsynced
+            with self.not_empty:
+                self.woken = True
+                self.not_empty.notify()
+
+    def reached(self, sequence, durability):
+        """Check if a record has reached a durability (call with progress held)."""
+        if durability == 'queued':
+            return True
+        if durability == 'written':
+            return self.written >= sequence
+        return self.durable >= sequence
+
+    def signal(self):
+        """Fsync if a callback is waiting on it, then call the callbacks whose records got there."""
+        with self.progress:
+            if not self.callbacks:
+                return
+            syncing = any(durability == 'fsynced' and self.written >= sequence > self.durable
+                          for sequence, durability, _ in self.callbacks)
+        if syncing:
+            self.sync()
+        with self.progress:
+            due = [callback for sequence, durability, callback in self.callbacks
+                   if self.reached(sequence, durability)]
+            self.callbacks = [entry for entry in self.callbacks if not self.reached(entry[0], entry[1])]
+        for callback in due:
+            callback()
+
+    def flush(self, fsync=False, timeout=None):
         """
-        self.put(record)
+        Wait until every record queued so far is written (and, optionally, fsynced).
+        :return: True if they were, False on timeout
+        """
+        return self.wait(self.queued, 'fsynced' if fsync else 'written', timeout)
+
+    def writable(self):
+        """Raise IOError if the journal was opened read-only."""
+        if self.readonly:
+            raise IOError('{} is opened read-only'.format(self.file_path))
 
     def clear(self):
-        """Clear the journal file's contents."""
-        self.file.seek(0)
-        self.file.truncate()
-        self.file.close()
-        self.open()
+        """
+        Clear the journal file's contents (and remove its sealed segments). An empty journal is
+        renamed over the file rather than truncating it, as other processes may have it mapped.
+        """
+        self.writable()
+        with self.lock():
+            out, temp = create_temp(self.file_path, '.clear')
+            with out:
+                out.write(self.formatter.create_header())
+                out.flush()
+                os.fsync(out.fileno())
+            os.rename(temp, self.file_path)
+            if self.segment_bytes:
+                for number in segment_numbers(self.file_path):
+                    os.remove(segment_path(self.file_path, number))
+                    if os.path.exists(hint_path(self.file_path, number)):
+                        os.remove(hint_path(self.file_path, number))
+            self.reopen()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the exclusive lock for a read-modify-write. The worker thread may still write while
+        we hold it, and every record queued by the time the block ends is written before the
+        lock is released.
+        """
+        self.writable()
+        with self.lock():
+            self.lock.lend(self.thread.ident)
+            try:
+                yield self
+            finally:
+                try:
+                    self.flush()
+                finally:
+                    self.lock.reclaim(self.thread.ident)
 
     def closed(self):
         """Check if the journal file is closed."""
         return self.file.closed
 
     def close(self):
-        """Clear the queue, stop the thread, and close the journal file."""
-        with self.mutex:
-            self.queue.clear()
-        self.put(None)
+        """Write out the records still queued, stop the thread, and close the journal file."""
+        if self.thread is not None:
+            self.put(None)
+            self.thread.join()
+        if self.dirty and self.fsync != 'never':
+            self.sync()
         self.file.close()
+        self.close_reader()
 
-    def load(self):
+    def load(self, locate=False):
         """
-        Load all the records from the journal file and return the non-deleted ones.
-        :return: list of records
+        Reload every record from the start of the journal, reopening the file first if
+        another process has replaced it.
+        :param locate: Yield value locations instead of values (see read)
+        :return: Generator of records, sets and deletes alike, in journal order
         """
-        if len(self.queue) > 0:
-            self.join()
+        if self.replaced():
+            self.reopen()
         self.pos = 0
-        data = filter(lambda x: len(x) > 1, list(self.formatter.deserialize(self.read())))
-        self.count = len(data)
-        return data
+        self.count = 0
+        if self.segment_bytes:
+            return self.load_segments(locate)
+        return self.replay(locate)
+
+    def load_segments(self, locate=False):
+        """Generator for load: every sealed segment from its hint file, then the active file."""
+        self.close_sealed()
+        self.stale = False
+        for number in segment_numbers(self.file_path):
+            if number >= self.segment:
+                break
+            for record in self.read_sealed(number, locate):
+                yield record
+        for record in self.replay(locate):
+            yield record
+
+    def read_sealed(self, number, locate=False):
+        """
+        Apply a sealed segment from its hint file (or by reading it, if the hint is missing
+        or stale), keeping the segment open for reading values.
+        :return: Generator of the final record of every key in the segment
+        """
+        stream = open(segment_path(self.file_path, number), 'rb')
+        formatter = copy(self.formatter)
+        formatter.read_header(stream)
+        self.sealed[number] = (stream, formatter)
+        hint = read_hint(hint_path(self.file_path, number), os.fstat(stream.fileno()).st_size)
+        if hint is None:
+            self.stats.incr('hint_misses')
+            states, records, _ = scan(stream, formatter, self.chunk_size)
+        else:
+            states, records = hint
+        self.count += records
+        for key, location in states.iteritems():
+            if location is None:
+                yield [key]
+                continue
+            offset, size, tag = location
+            if locate and not formatter.expiring(tag):
+                yield [key, location + (number,)]
+                continue
+            with self.random_mutex:
+                stream.seek(offset)
+                value = stream.read(size)
+            record = [key, location + (number,) if locate else formatter.load_value(tag, value)]
+            if formatter.expiring(tag):
+                record.append(formatter.expiry(value))
+            yield record
+
+    def recover(self, keep=True):
+        """
+        Check every record of the journal file and repair it, dropping a torn record at the end
+        and quarantining damaged regions in the middle (see recovery.repair). Sealed segments
+        were fsynced when they were sealed and are left alone. If anything was dropped, the
+        next load is a full one.
+        :param keep: Save the bytes dropped aside, in path.torn and path.quarantine
+        :return: dict of the number of intact records, the bytes cut off the end ('torn') and
+                 the (offset, size) of every region cut out ('quarantined')
+        """
+        self.writable()
+        self.formatter.require('Recovery', 'locations')
+        self.flush()
+        with self.stats.timer('recover'), self.lock():
+            self.follow()
+            report = repair(self.file_path, self.formatter, keep, self.chunk_size)
+            self.follow()
+            if report['torn'] or report['quarantined']:
+                self.stale = True
+        self.stats.incr('torn_bytes', report['torn'])
+        self.stats.incr('quarantined_bytes', sum(size for _, size in report['quarantined']))
+        self.recovery = report
+        return report
+
+    def restore(self, end, count, inode):
+        """
+        Carry on from a snapshot of the journal read elsewhere (e.g. by another process): the
+        next read starts at `end`.
+        :param end: File offset the snapshot was read up to
+        :param count: Number of records before end
+        :param inode: Inode of the file the snapshot was read from
+        :return: False if that file is no longer the journal, in which case nothing changes
+        """
+        if self.replaced():
+            self.reopen()
+        if inode != self.inode:
+            return False
+        self.pos = end
+        self.count = count
+        return True
+
+    def replay(self, locate=False):
+        """
+        Wait for queued records to be written, then read only the records appended since the last read.
+        :param locate: Yield value locations instead of values (see read)
+        :return: Generator of records, sets and deletes alike, in journal order
+        """
+        self.flush()
+        return self.read(locate)
+
+    def replaced(self):
+        """Check if the journal file was compacted, replaced or truncated since we last read it."""
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return True
+        if not self.segment_bytes:
+            return self.stale or stat.st_ino != self.inode or stat.st_size < self.pos
+        # A file that was sealed is still linked (as a segment) and carries on incrementally
+        reading = os.fstat(self.reader.fileno())
+        if self.stale or not reading.st_nlink or (stat.st_ino == reading.st_ino and stat.st_size < self.pos):
+            return True
+        for number, (stream, _) in self.sealed.iteritems():
+            try:
+                if os.stat(segment_path(self.file_path, number)).st_ino != os.fstat(stream.fileno()).st_ino:
+                    return True
+            except OSError:
+                return True
+        return False
 
     def opened(self):
         """Check if the journal file is open."""
         return not self.file.closed
 
     def open(self):
-        """Open the journal file, or create a new journal file if it does not exist."""
-        self.file = open(self.file_path, 'ab+')
-        stat = os.stat(self.file_path)
+        """Open the journal file, or create a new journal file if it does not exist (unless read-only)."""
+        self.file = open(self.file_path, 'rb' if self.readonly else 'ab+')
+        self.reader = open(self.file_path, 'rb')
+        self.random = open(self.file_path, 'rb')
+        self.read_inode = os.fstat(self.reader.fileno()).st_ino
+        self.pos = 0
+        self.stale = False
+        with self.lock():
+            self.lock.rebind()
+            stat = os.fstat(self.file.fileno())
+            if stat.st_size == 0:
+                if not self.readonly:
+                    self.write(self.formatter.create_header())
+            else:
+                self.adopt(self.reader)
         self.inode = stat.st_ino
-        if stat.st_size == 0:
-            self.write(self.formatter.create_header())
-        self.pos = self.file.tell()
+        self.read_format = self.formatter
+        if self.segment_bytes:
+            self.segment = self.number(self.read_inode)
+            # The sealed segments are only read by a full load
+            self.stale = True
 
-    def read(self):
+    def number(self, inode):
+        """The number the journal file with this inode has (or will have once sealed)."""
+        numbers = segment_numbers(self.file_path)
+        for number in reversed(numbers):
+            try:
+                if os.stat(segment_path(self.file_path, number)).st_ino == inode:
+                    return number
+            except OSError:
+                pass
+        return numbers[-1] + 1 if numbers else 1
+
+    def adopt(self, stream):
+        """
+        Switch writes to the format recorded in a journal file's header, e.g. when opening a
+        version 1 journal. The formatter is replaced rather than changed in place, so a batch
+        serialized concurrently can tell that it was encoded for another file.
+        :param stream: Python file buffer of the journal file
+        """
+        formatter = copy(self.formatter)
+        formatter.read_header(stream)
+        if formatter.create_header() != self.formatter.create_header():
+            self.formatter = formatter
+
+    def reopen(self):
+        """Close the journal file and open whatever is now at its path."""
+        with self.lock():
+            self.file.close()
+            self.close_reader()
+            self.open()
+
+    def close_reader(self):
+        """Close the read handle and its memory map."""
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.reader.close()
+        self.random.close()
+        self.close_sealed()
+
+    def close_sealed(self):
+        """Close the sealed segments read so far."""
+        for stream, _ in self.sealed.itervalues():
+            stream.close()
+        self.sealed = {}
+
+    def fetch(self, location):
         """
-        Read the journal file from previous position, returning the contents as bytes.
-        :return: The data from file as a byte array.
+        Read and decode a value from where read(locate=True) found it.
+        :param location: (value offset, value size, tag), followed by the segment number if
+                         the journal is segmented
         """
-        with FileLock(self.file_path):
-            self.file.seek(self.pos)
-            if self.pos is 0:
-                self.formatter.read_header(self.file)
-            buf = self.file.read()
-        self.pos = self.file.tell()
-        return bytearray(str(buf))
+        offset, size, tag = location[:3]
+        if len(location) > 3 and location[3] != self.segment:
+            stream, formatter = self.sealed[location[3]]
+            with self.random_mutex:
+                stream.seek(offset)
+                return formatter.load_value(tag, stream.read(size))
+        return self.read_format.load_value(tag, self.pread(offset, size))
+
+    def located(self, location):
+        """Complete a value location in the file being read (see fetch)."""
+        if self.segment_bytes:
+            return location + (self.segment,)
+        return location
 
-    def write(self, string):
+    def pread(self, offset, size):
+        """
+        Read bytes at an offset of the file being read, without moving the read position.
+        :param offset: File offset
+        :param size: Number of bytes
+        """
+        if self.mmap:
+            return self.mapped(offset + size)[offset:offset + size]
+        with self.random_mutex:
+            self.random.seek(offset)
+            return self.random.read(size)
+
+    def mapped(self, end):
+        """
+        Map the journal into memory, remapping only if it has grown past the current mapping.
+        :param end: Offset the mapping must reach
+        """
+        if self.mapping is None or len(self.mapping) < end:
+            if self.mapping is not None:
+                self.mapping.close()
+            self.mapping = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapping
+
+    def map_records(self, offset, end, locate=False):
+        """
+        Parse records straight out of the memory map.
+        :param offset: Offset of the first record
+        :param end: Offset to stop at
+        :param locate: Yield value locations instead of values
+        :return: Generator of records
         """
-        Write some data to the journal file.
+        if locate:
+            parsed = self.read_format.locations(self.mapped(end), offset, end)
+        else:
+            parsed = self.read_format.records(self.mapped(end), offset, end)
+        for record, offset in parsed:
+            yield record
+        if offset != end:
+            raise FormatException("Truncated record at offset {}".format(offset))
+
+    def follow(self):
+        """
+        Switch writes over to the file now at the journal path if ours was replaced (by a
+        compaction in any process) while we waited for the lock. Must be called with the lock
+        held; the records read so far no longer match the file, so the next load is a full one.
+        """
+        while True:
+            stat = os.fstat(self.file.fileno())
+            try:
+                current = os.stat(self.file_path).st_ino
+            except OSError:
+                current = None
+            if stat.st_nlink and current == stat.st_ino:
+                return
+            self.file.close()
+            self.file = open(self.file_path, 'ab+')
+            self.inode = os.fstat(self.file.fileno()).st_ino
+            if not (self.segment_bytes and stat.st_nlink):
+                self.stale = True
+            self.lock.rebind()
+            with open(self.file_path, 'rb') as stream:
+                self.adopt(stream)
+
+    def compact(self, formatter=None):
+        """
+        Rewrite the journal with only the latest record for each live key and swap it in with
+        an atomic rename; keys whose expiry time has passed are left out. The snapshot is taken
+        from the file as it was when compaction started and written out without holding the
+        lock; records appended in the meantime are then replayed onto the new file under the
+        exclusive lock, just before the rename.
+        :param formatter: Format of the new journal, defaults to the current one
+        :return: False if another process replaced the journal first, True otherwise
+        """
+        self.writable()
+        self.formatter.require('Compaction', 'deserialize_stream', 'load_value')
+        if self.segment_bytes:
+            return self.merge(formatter)
+        target = formatter or self.formatter
+        with self.lock(exclusive=False):
+            self.follow()
+            source = open(self.file_path, 'rb')
+            end = os.fstat(self.file.fileno()).st_size
+        try:
+            source_format = copy(self.formatter)
+            source_format.read_header(source)
+            live = {}
+            now = time.time()
+            for record in source_format.deserialize_stream(source, self.chunk_size, end - source.tell(), True):
+                if len(record) > 1 and (len(record) == 2 or record[2] > now):
+                    live[record[0]] = record[1:]
+                else:
+                    live.pop(record[0], None)
+            out, temp = create_temp(self.file_path, '.compact')
+            with out:
+                out.write(target.create_header())
+                # Values are read back one at a time, in file order, so memory holds only the keys
+                for key, state in sorted(live.iteritems(), key=lambda item: item[1][0][0]):
+                    offset, size, tag = state[0]
+                    source.seek(offset)
+                    out.write(target.serialize([key, source_format.load_value(tag, source.read(size))] + state[1:]))
+                count = len(live)
+                del live
+                with self.lock():
+                    self.follow()
+                    if os.fstat(self.file.fileno()).st_ino != os.fstat(source.fileno()).st_ino:
+                        os.remove(temp)
+                        return False
+                    tail = os.fstat(self.file.fileno()).st_size - end
+                    source.seek(end)
+                    for record in source_format.deserialize_stream(source, self.chunk_size, tail):
+                        if len(record) > 2 and record[2] <= now:
+                            # Overwrote a key the snapshot may have, so it stays as a delete
+                            record = record[:1]
+                        out.write(target.serialize(record))
+                        count += 1
+                    out.flush()
+                    os.fsync(out.fileno())
+                    os.rename(temp, self.file_path)
+                    self.formatter = target
+                    self.follow()
+                    self.count = count
+        finally:
+            source.close()
+        return True
+
+    def seal(self):
+        """
+        Seal the journal file as the next numbered segment, with a hint file, and start a new
+        empty journal file in its place. Must be called with the exclusive lock held.
+        """
+        numbers = segment_numbers(self.file_path)
+        number = numbers[-1] + 1 if numbers else 1
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with open(self.file_path, 'rb') as stream:
+            formatter = copy(self.formatter)
+            formatter.read_header(stream)
+            states, records, size = scan(stream, formatter, self.chunk_size)
+        write_hint(hint_path(self.file_path, number), states, records, size)
+        # The sealed file keeps its inode, so readers part way through it can finish it
+        os.link(self.file_path, segment_path(self.file_path, number))
+        out, temp = create_temp(self.file_path, '.seal')
+        with out:
+            out.write(self.formatter.create_header())
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(temp, self.file_path)
+        self.follow()
+        self.stats.incr('segments_sealed')
+
+    def merge(self, formatter=None):
+        """
+        Compaction for a segmented journal: seal the journal file, then rewrite the sealed
+        segments one at a time, each keeping only the keys whose final state it holds (and
+        deletes only while an older segment still has the key).
+        :param formatter: Format of the rewritten segments, defaults to the current one
+        :return: False if another process rewrote a segment first, True otherwise
+        """
+        target = formatter or self.formatter
+        with self.lock():
+            self.follow()
+            header = self.formatter.create_header()
+            if os.fstat(self.file.fileno()).st_size > len(header) or target.create_header() != header:
+                self.formatter = target
+                self.seal()
+        segments = []
+        for number in segment_numbers(self.file_path):
+            with open(segment_path(self.file_path, number), 'rb') as stream:
+                source = copy(self.formatter)
+                source.read_header(stream)
+                stat = os.fstat(stream.fileno())
+                hint = read_hint(hint_path(self.file_path, number), stat.st_size)
+                states, records = hint if hint is not None else scan(stream, source, self.chunk_size)[:2]
+            segments.append((number, states, records, stat.st_ino, source.create_header()))
+        newest, oldest = {}, {}
+        for number, states, _, _, _ in segments:
+            for key in states:
+                newest[key] = number
+                oldest.setdefault(key, number)
+        merged, count = True, 0
+        for number, states, records, inode, header in segments:
+            keep = [(key, location) for key, location in states.iteritems()
+                    if newest[key] == number and (location is not None or oldest[key] < number)]
+            count += len(keep)
+            if len(keep) < records or header != target.create_header():
+                merged = self.rewrite(number, keep, inode, target) and merged
+        self.count = count
+        return merged
+
+    def rewrite(self, number, keep, inode, target):
+        """
+        Replace a sealed segment (and its hint) with one holding only the given key states.
+        Keys that have expired are written as deletes, for the next merge to drop.
+        :param keep: List of (key, location or None for a delete) in the segment
+        :param inode: Inode the segment had when the states were read
+        :param target: Formatter of the new segment
+        :return: False if the segment was rewritten by someone else in the meantime
+        """
+        path = segment_path(self.file_path, number)
+        with open(path, 'rb') as source:
+            if os.fstat(source.fileno()).st_ino != inode:
+                return False
+            source_format = copy(self.formatter)
+            source_format.read_header(source)
+            now = time.time()
+            out, temp = create_temp(path, '.merge')
+            with out:
+                out.write(target.create_header())
+                for key, location in keep:
+                    if location is None:
+                        out.write(target.serialize([key]))
+                        continue
+                    offset, size, tag = location
+                    source.seek(offset)
+                    value = source.read(size)
+                    record = [key, source_format.load_value(tag, value)]
+                    if source_format.expiring(tag):
+                        record.append(source_format.expiry(value))
+                        if record[2] <= now:
+                            record = [key]
+                    out.write(target.serialize(record))
+                out.flush()
+                os.fsync(out.fileno())
+                out.seek(0)
+                target_format = copy(target)
+                target_format.read_header(out)
+                states, records, size = scan(out, target_format, self.chunk_size)
+        with self.lock():
+            if os.stat(path).st_ino != inode:
+                os.remove(temp)
+                return False
+            os.rename(temp, path)
+            write_hint(hint_path(self.file_path, number), states, records, size)
+        self.stats.incr('segments_merged')
+        return True
+
+    def read(self, locate=False):
+        """
+        Stream the records appended since the previous read. Only the end of the file is
+        taken under the lock; the records before it are complete and are parsed from a
+        separate read handle, a chunk at a time, while writers carry on.
+        :param locate: Yield [key, (value offset, value size, tag)] for sets instead of the
+                       value; pread and read_format.load_value turn a location into the value
+        :return: Generator of records
+        :raise JournalReplaced: Before any record, if the file being read is no longer the journal
+        """
+        while True:
+            if self.segment_bytes:
+                for record in self.read_rolled(locate):
+                    yield record
+            if self.readonly:
+                end = os.fstat(self.reader.fileno()).st_size
+                for record in self.read_committed(end, locate):
+                    yield record
+                return
+            with self.lock(exclusive=False):
+                if self.segment_bytes:
+                    self.follow()
+                elif self.stale or self.inode != self.read_inode:
+                    # The writer followed a compaction: the end of the new file means nothing in the old one
+                    self.stale = True
+                    raise JournalReplaced(self.file_path)
+                if not self.segment_bytes or self.inode == self.read_inode:
+                    end = os.fstat(self.file.fileno()).st_size
+                    break
+        for record in self.read_file(end, locate):
+            yield record
+
+    def read_rolled(self, locate=False):
+        """
+        Catch up after the file being read was sealed: read the rest of it, then the segments
+        sealed after it, and carry on with the active file from its start.
+        """
+        while True:
+            try:
+                if os.stat(self.file_path).st_ino == self.read_inode:
+                    return
+            except OSError:
+                return
+            for record in self.read_file(os.fstat(self.reader.fileno()).st_size, locate):
+                yield record
+            # Values in the sealed file are read through its random access handle from now on
+            self.sealed[self.segment] = (self.random, self.read_format)
+            last = self.segment
+            for number in segment_numbers(self.file_path):
+                if number > self.segment:
+                    for record in self.read_sealed(number, locate):
+                        yield record
+                    last = number
+            if self.mapping is not None:
+                self.mapping.close()
+                self.mapping = None
+            self.reader.close()
+            self.reader = open(self.file_path, 'rb')
+            self.random = open(self.file_path, 'rb')
+            self.read_inode = os.fstat(self.reader.fileno()).st_ino
+            self.segment = last + 1
+            self.pos = 0
+
+    def read_file(self, end, locate=False):
+        """Read the file being read from the read position up to end."""
+        self.reader.seek(self.pos)
+        if self.pos == 0:
+            self.read_format = copy(self.formatter)
+            self.read_format.read_header(self.reader)
+        if self.mmap:
+            stream = self.map_records(self.reader.tell(), end, locate)
+        else:
+            stream = self.read_format.deserialize_stream(self.reader, self.chunk_size, end - self.reader.tell(),
+                                                         locate)
+        if locate and self.segment_bytes:
+            stream = ([record[0], self.located(record[1])] + record[2:] if len(record) > 1 else record
+                      for record in stream)
+        # Time spent producing records (reading and parsing), not the caller's time between them
+        clock, spent, records = time.time, 0, 0
+        try:
+            started = clock()
+            for record in stream:
+                spent += clock() - started
+                records += 1
+                yield record
+                started = clock()
+        except CRCException:
+            self.stats.incr('crc_failures')
+            raise
+        finally:
+            self.count += records
+            self.stats.incr('records_read', records)
+            self.stats.incr('bytes_read', end - self.pos)
+            self.stats.observe('deserialize', spent)
+        self.pos = end
+
+    def read_committed(self, end, locate=False):
+        """
+        Read-only counterpart of read_file. The journal is read without its lock while the
+        writer appends to it, so a record at the end may be only partly written: parsing
+        stops in front of it and the next read starts there. A CRC mismatch is taken for a
+        record still being written too, but if the same record fails again it is corrupt.
+        Needs a formatter that can parse buffers (see BaseFormat.records).
+        """
+        self.reader.seek(self.pos)
+        if self.pos == 0:
+            if end == 0:
+                # The writer has not written the header yet
+                return
+            self.read_format = copy(self.formatter)
+            self.read_format.read_header(self.reader)
+            self.pos = self.reader.tell()
+        parse = self.read_format.locations if locate else self.read_format.records
+        pending = bytearray()
+        records = 0
+        start = self.pos
+        try:
+            while start + len(pending) < end:
+                chunk = self.reader.read(min(self.chunk_size, end - start - len(pending)))
+                if not chunk:
+                    break
+                pending += chunk
+                buf = memoryview(pending)
+                offset = 0
+                try:
+                    for record, offset in parse(buf, 0, None, start) if locate else parse(buf, 0):
+                        records += 1
+                        yield record
+                except CRCException:
+                    if self.suspect == start + offset:
+                        self.stats.incr('crc_failures')
+                        raise
+                    self.suspect = start + offset
+                    end = start + offset
+                # The view must be gone before the bytearray can be resized.
+                del buf
+                del pending[:offset]
+                start += offset
+        finally:
+            self.count += records
+            self.stats.incr('records_read', records)
+            self.stats.incr('bytes_read', start - self.pos)
+            self.pos = start
+            if self.suspect is not None and start > self.suspect:
+                self.suspect = None
+
+    def write(self, string, records=None, formatter=None):
+        """
+        Write some data to the journal file. The read position moves past it only if nothing
+        else was appended since our last read, so other writers' records are never skipped.
         :param string: Serialized data
+        :param records: The records in string, re-serialized if the journal was swapped for a
+                        file in another format while we waited for the lock
+        :param formatter: The formatter that serialized string
+        :return: File offset the data was written at
         """
         string = bytearray(str(string))
-        with FileLock(self.file_path):
+        started = time.time()
+        with self.lock():
+            locked = time.time()
+            self.follow()
+            if records is not None and formatter is not self.formatter:
+                # Serialized as one batch, so records that were batched stay all or nothing
+                string = self.formatter.serialize_batch(records)
+            formatter, inode = self.formatter, self.inode
+            end = os.fstat(self.file.fileno()).st_size
             self.file.write(string)
+            flushing = time.time()
             self.file.flush()
-        self.pos = self.file.tell()
+            done = time.time()
+            if self.segment_bytes and records is not None and end + len(string) >= self.segment_bytes:
+                self.seal()
+        stats = self.stats
+        stats.observe('lock_wait', locked - started)
+        stats.observe('flush', done - flushing)
+        stats.observe('write', done - started)
+        stats.incr('bytes_written', len(string))
+        if end == self.pos and inode == self.read_inode:
+            self.pos = end + len(string)
+            if records is not None:
+                self.count += len(records)
+        if records is not None:
+            stats.incr('records_written', len(records))
+            for listener in self.listeners:
+                listener(records, string, end, formatter, inode)
+        return end
+
+    def batch_stats(self):
+        """
+        Report how well the worker has been grouping records into commits.
+        :return: dict with batch count, records written, largest and mean batch size, and how
+                 many queued writes were coalesced away (in number and as a share of all writes)
+        """
+        return {
+            'batches': self.batches,
+            'records': self.batch_records,
+            'bytes': self.byte_size,
+            'max': self.batch_max,
+            'mean': float(self.batch_records) / self.batches if self.batches else 0.0,
+            'coalesced': self.coalesced,
+            'coalesce_ratio': float(self.coalesced) / self.queued if self.queued else 0.0,
+        }
+
+    def sync(self):
+        """Force everything written so far to stable storage."""
+        written = self.written
+        with self.stats.timer('fsync'):
+            os.fsync(self.file.fileno())
+        with self.progress:
+            self.synced = time.time()
+            if written == self.written:
+                self.dirty = False
+            if written > self.durable:
+                self.durable = written
+                self.progress.notify_all()
+
+    def next_sync(self):
+        """Seconds until the periodic fsync is due, or None if nothing is waiting on one."""
+        if not self.dirty or self.fsync in ('never', 'batch'):
+            return None
+        return max(0, self.synced + self.fsync - time.time())
 
     def worker(self):
-        """Threaded function which processes records put in the internal queue."""
-        while True:
-            record = self.get()
-            if record is None:
+        """
+        Threaded function which processes records put in the internal queue.
+        Every record waiting in the queue (or arriving within the linger window) is
+        serialized into one buffer and committed with a single locked write. Consecutive
+        records are serialized together (see BaseFormat.serialize_many), as many at a time
+        as are expected to fit in batch_bytes.
+        """
+        running = True
+        while running:
+            try:
+                record = self.take(timeout=self.next_sync())
+            except Empty:
+                if self.opened():
+                    self.sync()
+                    self.signal()
+                continue
+            deadline = time.time() + self.linger
+            formatter = self.formatter
+            buf = bytearray()
+            taken, records, run = 0, [], []
+            # Bytes a record takes on average, to tell when a run would fill the batch
+            record_size = self.byte_size // self.batch_records if self.batch_records else 64
+            while True:
+                if record is not self.WAKE:
+                    taken += 1
+                if record is None:
+                    running = False
+                    break
+                if record is self.WAKE:
+                    pass
+                elif isinstance(record, tuple):
+                    if run:
+                        buf += formatter.serialize_many(run)
+                        run = []
+                    buf += formatter.serialize_batch(record)
+                    records.extend(record)
+                else:
+                    run.append(record)
+                    records.append(record)
+                if run and len(buf) + len(run) * record_size >= self.batch_bytes:
+                    buf += formatter.serialize_many(run)
+                    run = []
+                if len(buf) >= self.batch_bytes:
+                    break
+                try:
+                    remaining = deadline - time.time()
+                    if remaining > 0 and self.overflow == 'coalesce':
+                        # Let writes pile up (and merge) in the queue instead of taking them as they come
+                        time.sleep(remaining)
+                        remaining = 0
+                    record = self.take(remaining > 0, remaining)
+                except Empty:
+                    break
+            if run:
+                buf += formatter.serialize_many(run)
+            if buf:
+                self.commit(buf, records, formatter)
+            oldest = self.oldest()
+            with self.progress:
+                self.written = oldest - 1
+                if not buf and not self.dirty:
+                    self.durable = self.written
+                self.progress.notify_all()
+            if buf and (self.fsync == 'batch' or self.next_sync() == 0):
+                self.sync()
+            self.signal()
+            for _ in xrange(taken):
                 self.task_done()
-                break
-            self.write(self.formatter.serialize(record))
-            if record > 1:
-                self.count += 1
-            self.task_done()
+
+    def commit(self, buf, records, formatter):
+        """
+        Write one serialized batch to the journal and count it in the batch stats.
+        :param buf: Serialized records
+        :param records: The records in the batch
+        :param formatter: The formatter that serialized them
+        """
+        self.write(buf, records, formatter)
+        self.byte_size += len(buf)
+        self.batches += 1
+        self.batch_records += len(records)
+        self.batch_max = max(self.batch_max, len(records))
+        self.stats.observe('batch_records', len(records), unit=1)
+        self.dirty = True
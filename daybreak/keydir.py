@@ -0,0 +1,162 @@
+"""
+keydir.py
+
+classes:
+  LazyValues
+"""
+from collections import OrderedDict
+from threading import Lock
+
+
+class LazyValues(object):
+    """
+    Dict-like store for DB(..., lazy_values=True) which keeps only where each value lives in
+    the journal (a Bitcask style "keydir") and reads values on demand, through a small LRU
+    cache bounded by the encoded size of the values it holds.
+    """
+
+    def __init__(self, journal, default_factory=None, cache_bytes=1 << 24):
+        """
+        :param journal: The Journal the values are stored in
+        :param default_factory: Callable for the default value, as with defaultdict
+        :param cache_bytes: Encoded size of values the cache may hold
+        """
+        self.journal = journal
+        self.default_factory = default_factory
+        self.cache_bytes = cache_bytes
+        # key -> where the value is in the journal (see Journal.fetch), or None while it is only in pending
+        self.keydir = {}
+        self.pending = {}
+        self.cache = OrderedDict()
+        self.cached = 0
+        # Guards keydir/pending against the journal worker's listener
+        self.mutex = Lock()
+        journal.listeners.append(self.written)
+
+    def __contains__(self, key):
+        return key in self.keydir
+
+    def __len__(self):
+        return len(self.keydir)
+
+    def __iter__(self):
+        return iter(self.keydir)
+
+    def __getitem__(self, key):
+        location = self.keydir[key]
+        if location is None:
+            value = self.pending.get(key, self)
+            if value is not self:
+                return value
+            # Written to disk since we looked
+            location = self.keydir[key]
+        if key in self.cache:
+            value, size = self.cache.pop(key)
+            self.cache[key] = (value, size)
+            return value
+        value = self.journal.fetch(location)
+        self.remember(key, value, location[1])
+        return value
+
+    def __setitem__(self, key, value):
+        with self.mutex:
+            self.keydir[key] = None
+            self.pending[key] = value
+        self.forget(key)
+
+    def __delitem__(self, key):
+        with self.mutex:
+            del self.keydir[key]
+            self.pending.pop(key, None)
+        self.forget(key)
+
+    def pop(self, key, default=None):
+        """Remove a key, returning its value (read from disk if needed) or default."""
+        if key not in self.keydir:
+            return default
+        value = self[key]
+        del self[key]
+        return value
+
+    def discard(self, key):
+        """Remove a key if present, without reading its value."""
+        if key in self.keydir:
+            del self[key]
+
+    def state(self, key):
+        """Where a key stands, as (location, value only in memory), for reset to put it back."""
+        with self.mutex:
+            return self.keydir.get(key, self), self.pending.get(key, self)
+
+    def reset(self, key, state):
+        """Put a key back as it was when state was taken."""
+        location, value = state
+        with self.mutex:
+            if location is self:
+                self.keydir.pop(key, None)
+            else:
+                self.keydir[key] = location
+            if value is self:
+                self.pending.pop(key, None)
+            else:
+                self.pending[key] = value
+        self.forget(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.keydir else default
+
+    def keys(self):
+        return self.keydir.keys()
+
+    def values(self):
+        return [self[key] for key in self.keydir]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keydir]
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.keydir)
+
+    def clear(self):
+        self.keydir.clear()
+        self.pending.clear()
+        self.cache.clear()
+        self.cached = 0
+
+    def locate(self, key, location):
+        """Point a key at a value read from the journal, replacing anything set in memory."""
+        with self.mutex:
+            self.keydir[key] = location
+            self.pending.pop(key, None)
+        self.forget(key)
+
+    def remember(self, key, value, size):
+        """Add a value to the cache, evicting the least recently used ones to stay in budget."""
+        if size > self.cache_bytes:
+            return
+        self.cache[key] = (value, size)
+        self.cached += size
+        while self.cached > self.cache_bytes:
+            _, (_, evicted) = self.cache.popitem(last=False)
+            self.cached -= evicted
+
+    def forget(self, key):
+        """Drop a key from the cache."""
+        if key in self.cache:
+            self.cached -= self.cache.pop(key)[1]
+
+    def written(self, records, buf, offset, formatter, inode):
+        """
+        Journal listener: once a value set in memory is on disk, keep only its location.
+        Batches written to a different file than the one being read (after a compaction)
+        are left in pending until the next full load.
+        """
+        if inode != self.journal.read_inode:
+            return
+        located = formatter.locations(memoryview(buf), 0, None, offset)
+        with self.mutex:
+            for record, (written, _) in zip(records, located):
+                key = record[0]
+                if len(record) > 1 and self.pending.get(key, self) is record[1]:
+                    self.keydir[key] = self.journal.located(written[1])
+                    del self.pending[key]
@@ -0,0 +1,222 @@
+"""
+lock.py
+
+classes:
+  ReentrantLock
+  FlockLock
+  LockfileLock
+  LocalLock
+"""
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from threading import Condition, Lock
+from thread import get_ident
+from FileLock import FileLock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ReentrantLock(object):
+    """
+    Abstract cross-process lock which a thread may take several times over.
+    Threads in this process queue up on an in-process condition; only the outermost
+    acquire and release touch the process-wide lock, implemented by subclasses.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.owner = None
+        self.modes = []
+        # Threads the owner lets use its exclusive hold (see lend), and their nesting depth
+        self.borrowers = set()
+        self.borrowed = 0
+
+    @abstractmethod
+    def _lock(self, exclusive, blocking):
+        """
+        Take (or convert) the process-wide lock.
+        :return: True if the lock was taken
+        """
+        pass
+
+    @abstractmethod
+    def _unlock(self):
+        """Drop the process-wide lock."""
+        pass
+
+    def held(self):
+        """Check if the current thread holds the lock."""
+        return self.owner == get_ident()
+
+    def exclusive(self):
+        """Check if the lock is currently held in exclusive mode."""
+        return bool(self.modes) and self.modes[-1]
+
+    def acquire(self, exclusive=True, blocking=True):
+        """
+        Acquire the lock, shared or exclusive. Re-acquiring from the owning thread nests, and
+        asking for exclusive access while holding a shared lock upgrades it until released.
+        :return: True if the lock was taken, False if `blocking` is False and it is busy
+        """
+        me = get_ident()
+        with self.cond:
+            while self.owner not in (None, me):
+                if me in self.borrowers:
+                    self.borrowed += 1
+                    return True
+                if not blocking:
+                    return False
+                self.cond.wait()
+            self.owner = me
+        current = self.modes[-1] if self.modes else None
+        wanted = exclusive or bool(current)
+        if wanted != current and not self._lock(wanted, blocking):
+            if not self.modes:
+                self._release_owner()
+            return False
+        self.modes.append(wanted)
+        return True
+
+    def release(self):
+        """Release one level of the lock, dropping the process-wide lock on the outermost one."""
+        if not self.held():
+            with self.cond:
+                if get_ident() not in self.borrowers or not self.borrowed:
+                    raise RuntimeError('Cannot release a lock owned by another thread')
+                self.borrowed -= 1
+                self.cond.notify_all()
+            return
+        mode = self.modes.pop()
+        if not self.modes:
+            self._unlock()
+            self._release_owner()
+        elif self.modes[-1] != mode:
+            self._lock(self.modes[-1], True)
+
+    def lend(self, thread):
+        """
+        Let another thread acquire the lock while this thread holds it exclusively; its
+        acquires and releases nest inside our hold instead of waiting for it.
+        :param thread: ident of the borrowing thread
+        """
+        if not self.held() or not self.exclusive():
+            raise RuntimeError('Only an exclusive owner can lend the lock')
+        with self.cond:
+            self.borrowers.add(thread)
+            self.cond.notify_all()
+
+    def reclaim(self, thread):
+        """Stop lending the lock to a thread, waiting until it has released it."""
+        with self.cond:
+            # The borrower may still be inside an acquire; it must stay one until it releases
+            while self.borrowed:
+                self.cond.wait()
+            self.borrowers.discard(thread)
+
+    def rebind(self):
+        """Take the process-wide lock again in the held mode, after the locked file was reopened."""
+        if self.modes:
+            self._lock(self.modes[-1], True)
+
+    def _release_owner(self):
+        with self.cond:
+            self.owner = None
+            self.cond.notify_all()
+
+    @contextmanager
+    def __call__(self, exclusive=True):
+        """Hold the lock for the duration of a ``with`` block."""
+        self.acquire(exclusive)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+class FlockLock(ReentrantLock):
+    """
+    Advisory ``flock`` on an already-open file descriptor. Readers take it shared and the
+    writer exclusive; a contended acquire blocks in the kernel rather than polling.
+    """
+
+    def __init__(self, fileno):
+        """
+        :param fileno: Callable returning the file descriptor to lock
+        """
+        ReentrantLock.__init__(self)
+        self.fileno = fileno
+
+    def _lock(self, exclusive, blocking):
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fileno(), flags)
+        except IOError:
+            if blocking:
+                raise
+            return False
+        return True
+
+    def _unlock(self):
+        fcntl.flock(self.fileno(), fcntl.LOCK_UN)
+
+
+class LockfileLock(ReentrantLock):
+    """
+    Fallback for platforms without ``fcntl``: the ``.lock`` file from FileLock. There is no
+    shared mode, so every acquire is exclusive.
+    """
+
+    def __init__(self, file_path):
+        ReentrantLock.__init__(self)
+        self.filelock = FileLock(file_path)
+
+    def _lock(self, exclusive, blocking):
+        if self.filelock.locked():
+            return True
+        return self.filelock.acquire(blocking)
+
+    def _unlock(self):
+        self.filelock.release()
+
+
+class LocalLock(ReentrantLock):
+    """
+    Keeps only the threads of this process apart, taking no lock other processes see. For
+    read-only journals, which never make writers wait.
+    """
+
+    def _lock(self, exclusive, blocking):
+        return True
+
+    def _unlock(self):
+        pass
+
+
+def create_lock(file_path, fileno, locking='flock'):
+    """
+    Build the lock a journal should use.
+    :param file_path: Path of the journal file
+    :param fileno: Callable returning the journal's open file descriptor
+    :param locking: 'flock' (falls back to 'lockfile' without fcntl), 'lockfile', or 'local'
+                    for no lock between processes
+    """
+    if locking not in ('flock', 'lockfile', 'local'):
+        raise ValueError("locking must be 'flock', 'lockfile' or 'local'")
+    if locking == 'local':
+        return LocalLock()
+    if locking == 'flock' and fcntl is not None:
+        return FlockLock(fileno)
+    return LockfileLock(file_path)
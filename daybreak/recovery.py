@@ -0,0 +1,131 @@
+"""
+recovery.py
+
+Repair of a journal file left damaged by a crash. The records are checked in a single pass
+over a memory map of the file. A torn record at the end (one only partly written when the
+process or the machine died) is cut off, and a damaged region in the middle is cut out, from
+the first record that fails up to the next one that parses and passes its CRC, so the records
+on either side of it are kept. The bytes removed are saved next to the journal, in
+path.torn and path.quarantine, each region prefixed by its offset and size (see REGION).
+
+functions:
+  repair
+  valid_end
+  resync
+"""
+import mmap
+import os
+from copy import copy
+from struct import Struct
+from format import FormatException
+from files import create_temp
+
+# Prefix of every region saved aside: journal offset, size
+REGION = Struct('!QQ')
+
+
+def repair(path, formatter, keep=True, chunk_size=1 << 16):
+    """
+    Check every record of a journal file and repair it: a torn tail is truncated in place,
+    while damage in the middle means rewriting the file without it (to a temporary file with
+    the journal's permissions, renamed over it). Must be called with the journal's exclusive
+    lock held. Needs a formatter that can parse buffers (see BaseFormat.locations).
+    :param path: Path of the journal file
+    :param formatter: Formatter of the journal (the file's header is read into a copy)
+    :param keep: Save the bytes removed aside, in path.torn and path.quarantine
+    :param chunk_size: Number of bytes copied at a time when the file is rewritten
+    :return: dict of the number of intact records, the bytes cut off the end ('torn') and
+             the (offset, size) of every region cut out of the middle ('quarantined')
+    """
+    report = {'records': 0, 'torn': 0, 'quarantined': []}
+    with open(path, 'rb') as stream:
+        formatter = copy(formatter)
+        formatter.read_header(stream)
+        start = stream.tell()
+        size = os.fstat(stream.fileno()).st_size
+        if start == size:
+            return report
+        buf = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset, tail = start, size
+            while offset < size:
+                offset, records = valid_end(formatter, buf, offset, size)
+                report['records'] += records
+                if offset == size:
+                    break
+                resume = resync(formatter, buf, offset + 1, size)
+                if resume is None:
+                    tail = offset
+                    break
+                report['quarantined'].append((offset, resume - offset))
+                offset = resume
+            report['torn'] = size - tail
+            if keep and tail < size:
+                save(path + '.torn', buf, tail, size, chunk_size)
+            if not report['quarantined']:
+                if tail < size:
+                    with open(path, 'r+b') as out:
+                        out.truncate(tail)
+                        out.flush()
+                        os.fsync(out.fileno())
+                return report
+            out, temp = create_temp(path, '.recover')
+            with out:
+                kept = start
+                copy_range(buf, out, 0, start, chunk_size)
+                for offset, length in report['quarantined']:
+                    copy_range(buf, out, kept, offset, chunk_size)
+                    if keep:
+                        save(path + '.quarantine', buf, offset, offset + length, chunk_size)
+                    kept = offset + length
+                copy_range(buf, out, kept, tail, chunk_size)
+                out.flush()
+                os.fsync(out.fileno())
+            os.rename(temp, path)
+        finally:
+            buf.close()
+    return report
+
+
+def valid_end(formatter, buf, offset, size):
+    """
+    Follow the intact records from offset.
+    :return: (offset just past the last intact record, number of records)
+    """
+    end, records = offset, 0
+    try:
+        for _, end in formatter.locations(buf, offset, size):
+            records += 1
+    except FormatException:
+        pass
+    return end, records
+
+
+def resync(formatter, buf, offset, size):
+    """
+    Find the next intact record at or after offset, trying every byte offset in turn.
+    Garbage rarely passes for a record: its sizes must fit in the file and its CRC match.
+    :return: Offset of the record, or None if there is none up to size
+    """
+    for candidate in xrange(offset, size):
+        try:
+            if next(formatter.locations(buf, candidate, size), None) is not None:
+                return candidate
+        except FormatException:
+            pass
+    return None
+
+
+def copy_range(buf, out, start, end, chunk_size):
+    """Write the bytes from start to end of buf to a file, a chunk at a time."""
+    for offset in xrange(start, end, chunk_size):
+        out.write(buf[offset:min(offset + chunk_size, end)])
+
+
+def save(path, buf, start, end, chunk_size):
+    """Append a region of a journal to a file, prefixed by its offset and size."""
+    with open(path, 'ab') as out:
+        out.write(REGION.pack(start, end - start))
+        copy_range(buf, out, start, end, chunk_size)
+        out.flush()
+        os.fsync(out.fileno())
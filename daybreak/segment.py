@@ -0,0 +1,126 @@
+"""
+segment.py
+
+Sealed journal segments and their hint files. With Journal(..., segment_bytes=N) the file at
+the journal path is the active segment; once it grows past N bytes it is sealed as
+path.<number>.seg and a hint file, path.<number>.hint, records the final state of every key
+in it, so loading a sealed segment needs neither a CRC check nor a pass over dead records.
+
+functions:
+  segment_path
+  hint_path
+  segment_numbers
+  scan
+  write_hint
+  read_hint
+"""
+import os
+import re
+from binascii import crc32
+from collections import OrderedDict
+from struct import Struct, pack, unpack_from
+from files import create_temp
+
+# Magic string of hint files
+HINT_MAGIC = 'DAYBREAKHINT'
+
+# Hint header: number of keys, records in the segment, size of the segment file
+HINT_HEADER = Struct('!IIQ')
+
+# Hint entry: key size, value size (DELETE for a delete), value offset, tag (NO_TAG for none)
+HINT_ENTRY = Struct('!IIQB')
+
+DELETE = (1 << 32) - 1
+NO_TAG = 0xff
+
+
+def segment_path(file_path, number):
+    """Path of a sealed segment."""
+    return '{}.{}.seg'.format(file_path, number)
+
+
+def hint_path(file_path, number):
+    """Path of a sealed segment's hint file."""
+    return '{}.{}.hint'.format(file_path, number)
+
+
+def segment_numbers(file_path):
+    """Numbers of the sealed segments of a journal, oldest first."""
+    directory, name = os.path.split(os.path.abspath(file_path))
+    pattern = re.compile(re.escape(name) + r'\.(\d+)\.seg$')
+    matches = (pattern.match(entry) for entry in os.listdir(directory))
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+def scan(stream, formatter, chunk_size=1 << 16):
+    """
+    Read a segment and find the final state of every key in it.
+    :param stream: Segment file positioned just past its header
+    :param formatter: Formatter that read the header
+    :return: (OrderedDict of key to (value offset, value size, tag), or None for a delete,
+             number of records, size of the segment)
+    """
+    states = OrderedDict()
+    records = 0
+    for record in formatter.deserialize_stream(stream, chunk_size, None, True):
+        records += 1
+        states.pop(record[0], None)
+        states[record[0]] = record[1] if len(record) > 1 else None
+    return states, records, stream.tell()
+
+
+def write_hint(path, states, records, size):
+    """
+    Atomically write a hint file.
+    :param states: Final key states, as returned by scan
+    :param records: Number of records in the segment
+    :param size: Size of the segment file the hint describes
+    """
+    hint = bytearray(HINT_MAGIC) + HINT_HEADER.pack(len(states), records, size)
+    for key, location in states.iteritems():
+        if location is None:
+            hint += HINT_ENTRY.pack(len(key), DELETE, 0, NO_TAG)
+        else:
+            offset, value_size, tag = location
+            hint += HINT_ENTRY.pack(len(key), value_size, offset, NO_TAG if tag is None else tag)
+        hint += key
+    hint += pack('!I', crc32(hint) & 0xffffffff)
+    out, temp = create_temp(path, '.tmp')
+    with out:
+        out.write(hint)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(temp, path)
+
+
+def read_hint(path, size):
+    """
+    Read a hint file written by write_hint.
+    :param size: Size of the segment file, which the hint must have been written for
+    :return: (states, records) as for scan, or None if the hint is missing, corrupt or stale
+    """
+    try:
+        with open(path, 'rb') as f:
+            hint = f.read()
+    except IOError:
+        return None
+    start = len(HINT_MAGIC) + HINT_HEADER.size
+    if len(hint) < start + 4 or not hint.startswith(HINT_MAGIC):
+        return None
+    if unpack_from('!I', hint, len(hint) - 4)[0] != crc32(hint[:-4]) & 0xffffffff:
+        return None
+    keys, records, hinted = HINT_HEADER.unpack_from(hint, len(HINT_MAGIC))
+    if hinted != size:
+        return None
+    states = OrderedDict()
+    offset = start
+    for _ in xrange(keys):
+        key_size, value_size, value_offset, tag = HINT_ENTRY.unpack_from(hint, offset)
+        offset += HINT_ENTRY.size
+        key = hint[offset:offset + key_size]
+        offset += key_size
+        if value_size == DELETE:
+            states[key] = None
+        else:
+            states[key] = (value_offset, value_size, None if tag == NO_TAG else tag)
+    return states, records
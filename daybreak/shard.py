@@ -0,0 +1,393 @@
+"""
+shard.py
+
+classes:
+  ShardedDB
+  Descending
+
+functions:
+  descending
+  snapshot
+  compact
+"""
+import os
+import time
+from binascii import crc32
+from heapq import merge
+from copy import copy
+from contextlib import contextmanager
+from multiprocessing import Pool
+from threading import RLock
+from db import DB
+from format import DefaultFormat
+from journal import Journal
+from files import create_temp
+from lock import create_lock
+from index import successor
+
+
+class ShardedDB(object):
+    """
+    Database spread over several journals ("shards"), each a DB with its own file, writer
+    thread and lock. Keys are routed by a stable hash, so a key always lives in the same
+    shard; loading and compaction run the shards in parallel in a process pool.
+
+    Open a sharded database with the number of shards it was created with, which is kept
+    in file_name.shards.
+    """
+
+    def __init__(self, file_name='', shards=4, processes=None, formatter=None, **options):
+        """
+        :param file_name: Journal files are named file_name.0, file_name.1, ...
+        :param shards: Number of shards
+        :param processes: Size of the process pool for loading and compaction (None for one
+                          per CPU, 1 to do the work in this process)
+        :param formatter: Record formatter, defaults to DefaultFormat
+        :param options: Passed on to every shard's DB
+        """
+        self.file_name = file_name
+        self.meta_path = file_name + '.shards'
+        self.readonly = options.get('readonly', False)
+        self._check_shards(shards)
+        self.processes = processes
+        self.formatter = formatter or DefaultFormat()
+        self.lazy_values = options.get('lazy_values', False)
+        self.chunk_size = options.get('chunk_size', 1 << 16)
+        self.locking = options.get('locking', 'flock')
+        self.segment_bytes = options.get('segment_bytes')
+        self._mutex = RLock()
+        self.shards = [DB('{}.{}'.format(file_name, n), self.formatter, autoload=False, **options)
+                       for n in xrange(shards)]
+        self._reload(self.shards)
+
+    def _check_shards(self, shards):
+        """
+        Make sure the database is opened with the number of shards it has (keys would be
+        routed to the wrong shards otherwise), recording it if the database is new.
+        :raise ValueError: On a mismatch
+        """
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                existing = int(f.read())
+        else:
+            # Created before the count was recorded: count the journal files
+            existing = 0
+            while os.path.exists('{}.{}'.format(self.file_name, existing)):
+                existing += 1
+        if existing and existing != shards:
+            raise ValueError("{} has {} shards, not {}".format(self.file_name, existing, shards))
+        if self.readonly or os.path.exists(self.meta_path):
+            return
+        f, temp = create_temp(self.meta_path, '.tmp')
+        with f:
+            f.write(str(shards))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self.meta_path)
+
+    def file(self):
+        """Returns the database file name prefix."""
+        return self.file_name
+
+    def shard(self, key):
+        """The shard a key is stored in."""
+        return self.shards[(crc32(self.formatter.encode_key(key)) & 0xffffffff) % len(self.shards)]
+
+    def default(self, value=None):
+        """Set a new default value for database."""
+        for db in self.shards:
+            db.default(value)
+
+    def __getitem__(self, key):
+        """Retrieve a value at key from the database."""
+        return self.shard(key)[key]
+    get = __getitem__
+
+    def __setitem__(self, key, value, durability='queued', ttl=None):
+        """Set a key in the database, see DB.set."""
+        return self.shard(key).set(key, value, durability=durability, ttl=ttl)
+    set = __setitem__
+
+    def set_flush(self, key, value):
+        """Set a key and wait until it is fsynced to disk."""
+        return self.shard(key).set_flush(key, value)
+
+    def __delitem__(self, key, durability='queued'):
+        """Delete a key from the database."""
+        return self.shard(key).delete(key, durability)
+    delete = __delitem__
+
+    def delete_flush(self, key):
+        """Delete a key and wait until the delete is fsynced to disk."""
+        return self.shard(key).delete_flush(key)
+
+    def update(self, d, durability='queued', ttl=None):
+        """
+        Update database with dict. Each shard writes its keys as one batch record, so the
+        update is all or nothing per shard, but not across shards.
+        """
+        parts = {}
+        for key, value in d.iteritems():
+            parts.setdefault(id(self.shard(key)), {})[key] = value
+        for db in self.shards:
+            if id(db) in parts:
+                db.update(parts[id(db)], durability, ttl)
+
+    def update_flush(self, d):
+        """Update database with dict and wait until it is fsynced to disk."""
+        return self.update(d, durability='fsynced')
+
+    def has_key(self, key):
+        """Does this db have this key?"""
+        return self.shard(key).has_key(key)
+    include = has_key
+    is_member = has_key
+
+    def has_value(self, value, index=None):
+        """Does this db have this value? See DB.has_value."""
+        return any(db.has_value(value, index) for db in self.shards)
+
+    def create_index(self, name, fn):
+        """Declare a secondary index on every shard, see DB.create_index."""
+        for db in self.shards:
+            db.create_index(name, fn)
+
+    def drop_index(self, name):
+        """Remove a secondary index."""
+        for db in self.shards:
+            db.drop_index(name)
+
+    def find(self, index, field):
+        """Look up the items whose value has a field, through a secondary index (see DB.find)."""
+        return [item for db in self.shards for item in db.find(index, field)]
+
+    def size(self):
+        """Return the number of stored items."""
+        return sum(db.size() for db in self.shards)
+
+    def bytesize(self):
+        """Estimate the memory held by the database's keys and values, in bytes."""
+        return sum(db.bytesize() for db in self.shards)
+
+    def stats(self):
+        """
+        Report the shards' metrics (see DB.stats), with the queue depth, key count and
+        logsize summed over all of them.
+        :return: dict of metrics, with each shard's under 'shards'
+        """
+        shards = [db.stats() for db in self.shards]
+        result = {'shards': shards}
+        for name in ('queue_depth', 'keys', 'logsize', 'memory_bytes'):
+            result[name] = sum(stats[name] for stats in shards)
+        return result
+
+    def logsize(self):
+        """Counter of how many records are in the journals."""
+        return sum(db.logsize() for db in self.shards)
+
+    def is_empty(self):
+        """Return true if database is empty."""
+        return self.size() == 0
+
+    def __iter__(self):
+        """Iterate over the key, value pairs in the database."""
+        for db in self.shards:
+            for item in db:
+                yield item
+
+    def keys(self):
+        """Return the keys in the db."""
+        return [key for db in self.shards for key in db.keys()]
+
+    def range(self, start=None, end=None, reverse=False):
+        """
+        Lazily iterate over the key, value pairs with keys from start (inclusive) to end
+        (exclusive) in key order, merging the shards' ranges (see DB.range).
+        """
+        ranges = [db.range(start, end, reverse) for db in self.shards]
+        if not reverse:
+            # A key is in one shard only, so the values are never compared
+            return merge(*ranges)
+        return ((item.key, value) for item, value in merge(*map(descending, ranges)))
+
+    def prefix(self, prefix, reverse=False):
+        """Lazily iterate over the key, value pairs whose keys start with prefix, in key order (see range)."""
+        return self.range(prefix, successor(prefix), reverse)
+
+    def values(self):
+        """Returns a list of the values."""
+        return [value for db in self.shards for value in db.values()]
+
+    def flush(self, fsync=False, timeout=None):
+        """
+        Wait until every change made so far is written to every shard, see DB.flush. The
+        timeout covers all the shards, not each one.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        return all([db.flush(fsync, None if deadline is None else max(0, deadline - time.time()))
+                    for db in self.shards])
+
+    def load(self):
+        """
+        Sync the database with what is on disk. Shards whose journal was replaced are
+        reloaded in parallel; the others apply only the records appended since the last sync.
+        """
+        stale = []
+        for db in self.shards:
+            db.flush()
+            if db._journal.replaced():
+                stale.append(db)
+            else:
+                db.load()
+        self._reload(stale)
+    sunrise = load
+
+    def _reload(self, shards):
+        """
+        Read the given shards' journals in the process pool and take the data they hold.
+        Segmented journals load from their hint files instead, and read-only ones without
+        locking (see Journal.read_committed), both in this process.
+        """
+        if self.segment_bytes or self.readonly:
+            for db in shards:
+                db.load()
+            return
+        jobs = [(db._journal.file_path, db._journal.formatter, self.chunk_size, self.lazy_values, self.locking)
+                for db in shards]
+        for db, result in zip(shards, self._map(snapshot, jobs)):
+            db._restore(*result)
+
+    def _map(self, fn, jobs):
+        """Run fn over jobs in the process pool (or in this process, if it would not help)."""
+        if self.processes == 1 or len(jobs) < 2:
+            return map(fn, jobs)
+        pool = Pool(min(self.processes or len(jobs), len(jobs)))
+        try:
+            return pool.map(fn, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    @contextmanager
+    def lock(self):
+        """
+        Lock every shard for an exclusive commit across processes and threads, see DB.lock.
+        Shards are always locked in the same order, so two transactions cannot deadlock.
+        """
+        with self.synchronize():
+            held = []
+            try:
+                for db in self.shards:
+                    transaction = db.lock()
+                    transaction.__enter__()
+                    held.append(transaction)
+                yield self
+            finally:
+                for transaction in reversed(held):
+                    transaction.__exit__(None, None, None)
+
+    @contextmanager
+    def synchronize(self):
+        """Synchronize access to the database from multiple threads (of this process only)."""
+        with self._mutex:
+            yield self
+
+    def clear(self, flush=False):
+        """Remove all keys and values from the database."""
+        for db in self.shards:
+            db.clear(flush)
+
+    def compact(self, formatter=None):
+        """
+        Compact every shard, in parallel in the process pool, then reload them.
+        :param formatter: Format of the new journals, defaults to the current ones
+        :return: False if another process replaced any of the journals first, True otherwise
+        """
+        self.flush()
+        jobs = [(db._journal.file_path, db._journal.formatter, formatter, self.locking, self.segment_bytes)
+                for db in self.shards]
+        result = all(self._map(compact, jobs))
+        self.load()
+        return result
+
+    def checkpoint(self):
+        """Checkpoint every shard, see DB.checkpoint."""
+        for db in self.shards:
+            db.checkpoint()
+
+    def recover(self, keep=True):
+        """Repair every shard's journal after a crash, see DB.recover. :return: List of the shards' reports"""
+        return [db.recover(keep) for db in self.shards]
+
+    def sweep(self, limit=None):
+        """Drop the expired keys of every shard, see DB.sweep. :return: Number of keys dropped"""
+        return sum(db.sweep(limit) for db in self.shards)
+
+    def migrate(self, formatter=None):
+        """Rewrite every shard in another format, by default the latest DefaultFormat version."""
+        return self.compact(formatter or DefaultFormat())
+
+    def close(self):
+        """Close the database for reading and writing."""
+        for db in self.shards:
+            db.close()
+
+    def closed(self):
+        """Checks if the database connection has been closed."""
+        return all(db.closed() for db in self.shards)
+
+
+class Descending(object):
+    """Wraps a key so that it sorts the other way round, for merging descending ranges."""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+def descending(items):
+    """Generator of key, value pairs with the keys wrapped in Descending."""
+    for key, value in items:
+        yield Descending(key), value
+
+
+def snapshot(job):
+    """
+    Pool task: read a journal from the start and fold it into the live data.
+    :param job: (path, formatter, chunk_size, locate, locking)
+    :return: (dict of key to the rest of its last record, i.e. [value or value location] or
+             [value or value location, expiry time], end offset, record count, inode)
+    """
+    path, formatter, chunk_size, locate, locking = job
+    with open(path, 'rb') as stream:
+        with create_lock(path, stream.fileno, locking)(exclusive=False):
+            stat = os.fstat(stream.fileno())
+        read_format = copy(formatter)
+        read_format.read_header(stream)
+        live, count = {}, 0
+        for record in read_format.deserialize_stream(stream, chunk_size, stat.st_size - stream.tell(), locate):
+            count += 1
+            if len(record) > 1:
+                live[record[0]] = record[1:]
+            else:
+                live.pop(record[0], None)
+    return live, stat.st_size, count, stat.st_ino
+
+
+def compact(job):
+    """
+    Pool task: compact a journal (see Journal.compact).
+    :param job: (path, formatter, formatter of the new journal, locking, segment_bytes)
+    """
+    path, formatter, target, locking, segment_bytes = job
+    journal = Journal(path, formatter, locking=locking, segment_bytes=segment_bytes)
+    try:
+        return journal.compact(target)
+    finally:
+        journal.close()
@@ -0,0 +1,142 @@
+"""
+stats.py
+
+classes:
+  Histogram
+  Stats
+
+functions:
+  deep_sizeof
+"""
+import time
+from math import frexp
+from sys import getsizeof
+from contextlib import contextmanager
+from threading import Lock
+
+
+class Histogram(object):
+    """
+    Log2-bucketed histogram: recording a value is a few dict and float operations, and
+    quantiles are reported as the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self, unit=1e-6):
+        """
+        :param unit: Smallest value told apart (the first bucket's upper bound)
+        """
+        self.unit = unit
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        """Record one value."""
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bucket = frexp(value / self.unit)[1] if value > self.unit else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (0 < q <= 1)."""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.unit * 2 ** bucket, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        :return: dict with count, mean, max and p50/p90/p99
+        """
+        return {
+            'count': self.count,
+            'mean': float(self.total) / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Stats(object):
+    """
+    Counters and histograms shared by a database and its journal. Updated from the journal's
+    worker, the sweeper, the poller and callers' threads, so every update holds a lock.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.mutex = Lock()
+
+    def incr(self, name, n=1):
+        """Add to a counter."""
+        with self.mutex:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def histogram(self, name, unit=1e-6):
+        """Get (or create) a histogram."""
+        with self.mutex:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(unit)
+            return self.histograms[name]
+
+    def observe(self, name, value, unit=1e-6):
+        """
+        Record a value (a duration in seconds unless the histogram says otherwise).
+        :param unit: Unit of the histogram, if this creates it
+        """
+        with self.mutex:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(unit)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        """Record how long a ``with`` block takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def snapshot(self):
+        """
+        :return: dict of every counter and a snapshot of every histogram
+        """
+        with self.mutex:
+            result = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                result[name] = histogram.snapshot()
+        return result
+
+
+def deep_sizeof(obj, sample=1000):
+    """
+    Estimate the memory held by an object, including what its containers hold. Containers
+    with more than `sample` items are extrapolated from their first `sample` items, taken
+    from a copy so that other threads may change them meanwhile.
+    """
+    size = getsizeof(obj)
+    if isinstance(obj, dict):
+        items = dict.items(obj)
+        measured = sum(deep_sizeof(key, sample) + deep_sizeof(value, sample)
+                       for key, value in items[:sample])
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = list(obj)
+        measured = sum(deep_sizeof(item, sample) for item in items[:sample])
+    else:
+        return size
+    total = len(items)
+    if total > sample:
+        measured = measured * total // sample
+    return size + measured
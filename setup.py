@@ -28,6 +28,6 @@ setup(
         'toolz',
         'nose'
     ],
-    packages=['daybreak'],
+    packages=['daybreak', 'daybreak.bench'],
 
 )
\ No newline at end of file
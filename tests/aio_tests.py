@@ -0,0 +1,75 @@
+from daybreak.aio import AsyncDB, asyncio
+from nose.plugins.skip import SkipTest
+import os
+
+file_path = './test_aio.db'
+
+
+def setup():
+    if asyncio is None or not hasattr(asyncio, 'From'):
+        raise SkipTest('needs trollius')
+    return asyncio.new_event_loop()
+
+
+def cleanup(loop):
+    loop.close()
+    os.remove(file_path)
+
+
+def test_durable_writes_and_transactions():
+    loop = setup()
+    From = asyncio.From
+
+    @asyncio.coroutine
+    def scenario():
+        db = yield From(AsyncDB.open(file_path, loop=loop))
+        assert (yield From(db.set('foo', 'bar', durability='fsynced'))) == 'bar'
+        yield From(db.update({'a': 1, 'b': 2}))
+        yield From(db.lock(lambda d: d.set('a', d['a'] + 1)))
+        assert (yield From(db.delete('b'))) == 2
+        assert (yield From(db.flush(fsync=True)))
+        yield From(db.load())
+        result = db['a'], db['foo'], 'b' in db
+        yield From(db.close())
+        raise asyncio.Return(result)
+
+    assert loop.run_until_complete(scenario()) == (2, 'bar', False)
+    cleanup(loop)
+
+
+def test_full_queue_waits_on_the_executor():
+    loop = setup()
+    From = asyncio.From
+
+    @asyncio.coroutine
+    def scenario():
+        db = yield From(AsyncDB.open(file_path, loop=loop, queue_size=1))
+        journal = db.db._journal
+        journal.lock.acquire()
+        # The worker takes one record and waits for the lock, the next fills the queue
+        db.set('a', 1)
+        while journal.qsize():
+            yield From(asyncio.sleep(0.01, loop=loop))
+        db.set('b', 2)
+        waiting = db.set('c', 3)
+        batch = db.update({'d': 4}, ttl=60)
+        # Waits behind the earlier write to the key
+        again = db.set('c', 5)
+        flushed = db.flush()
+        # Reading a missing key stores the default without blocking the loop either
+        assert db['e'] is None and 'e' not in db
+        yield From(asyncio.sleep(0.05, loop=loop))
+        assert not waiting.done() and not batch.done() and not flushed.done()
+        journal.lock.release()
+        assert (yield From(waiting)) == 3
+        yield From(batch)
+        yield From(flushed)
+        assert again.done()
+        result = db['c'], db['d'], 'd' in db.db._expires
+        yield From(db.flush())
+        assert 'e' in db
+        yield From(db.close())
+        raise asyncio.Return(result)
+
+    assert loop.run_until_complete(scenario()) == (5, 4, True)
+    cleanup(loop)
@@ -39,3 +39,140 @@ def test_daybreak_values_func():
     testdb['baz'] = 'foo'
     assert testdb.values() == ['bar', 'foo']
     cleanup(testdb)
+
+
+def test_daybreak_syncs_sets_and_deletes():
+    writer, reader = setup(), setup()
+    writer['foo'] = 'bar'
+    writer['baz'] = 'qux'
+    writer._journal.join()
+    reader.load()
+    assert reader['foo'] == 'bar'
+    del writer['foo']
+    writer._journal.join()
+    reader.load()
+    assert not reader.has_key('foo')
+    assert reader['baz'] == 'qux'
+    reader.close()
+    cleanup(writer)
+
+
+def test_daybreak_reloads_replaced_journal():
+    writer, reader = setup(), setup()
+    writer['foo'] = 'bar'
+    writer._journal.join()
+    reader.load()
+    other = DB(file_path + '.new')
+    other['baz'] = 'qux'
+    other._journal.join()
+    os.rename(file_path + '.new', file_path)
+    reader.load()
+    assert not reader.has_key('foo')
+    assert reader['baz'] == 'qux'
+    other.close()
+    writer.close()
+    cleanup(reader)
+
+
+def test_daybreak_compacts_atomically():
+    testdb, other = setup(), setup()
+    for i in xrange(100):
+        testdb['foo'] = i
+    testdb['bar'] = 'baz'
+    del testdb['bar']
+    testdb._journal.join()
+    before = os.path.getsize(file_path)
+    assert testdb.compact()
+    assert os.path.getsize(file_path) < before
+    other.load()
+    assert other['foo'] == 99
+    assert not other.has_key('bar')
+    other['qux'] = 'quux'
+    other._journal.join()
+    testdb.load()
+    assert testdb['qux'] == 'quux'
+    assert testdb.logsize() == 2
+    other.close()
+    cleanup(testdb)
+
+
+def test_daybreak_compacts_in_background():
+    testdb = DB(file_path, compact_ratio=2, compact_min=10)
+    for i in xrange(50):
+        testdb['foo'] = i
+        testdb._journal.join()
+    testdb._compactor.join()
+    testdb.load()
+    assert testdb.logsize() < 50
+    assert testdb['foo'] == 49
+    cleanup(testdb)
+
+
+def test_concurrent_compactions_do_not_collide():
+    from threading import Thread
+    import glob
+    testdb = setup()
+    for i in xrange(2000):
+        testdb[str(i % 50)] = i
+    testdb.flush()
+    errors = []
+
+    def compact():
+        try:
+            testdb.compact()
+        except Exception as e:
+            errors.append(e)
+    threads = [Thread(target=compact) for _ in xrange(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert glob.glob(file_path + '.*') == []
+    testdb.load()
+    assert testdb.size() == 50 and testdb['49'] == 1999
+    cleanup(testdb)
+
+
+def increment(times):
+    db = DB(file_path)
+    for _ in xrange(times):
+        with db.lock():
+            db['counter'] = (db['counter'] or 0) + 1
+    db.close()
+
+
+def test_daybreak_lock_is_atomic_across_processes():
+    from multiprocessing import Process
+    testdb = setup()
+    workers = [Process(target=increment, args=(25,)) for _ in xrange(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    with testdb.lock():
+        assert testdb['counter'] == 100
+        testdb['counter'] += 1
+    other = DB(file_path)
+    assert other['counter'] == 101
+    other.close()
+    cleanup(testdb)
+
+
+def test_daybreak_migrates_to_compressed_format():
+    from daybreak.format import CompressedFormat
+    testdb = setup()
+    values = dict(('key-%d' % i, '{"status": "open", "id": %d, "tags": ["alpha", "beta", "gamma"]}' % i)
+                  for i in xrange(200))
+    testdb.update(values)
+    testdb.flush()
+    plain = os.path.getsize(file_path)
+    testdb.migrate(CompressedFormat(CompressedFormat.train(values.values()[:50])))
+    assert os.path.getsize(file_path) < plain / 2
+    testdb.close()
+    for lazy in (False, True):
+        reopened = DB(file_path, CompressedFormat(), lazy_values=lazy)
+        assert dict(iter(reopened)) == values
+        values['key-0'] = reopened['key-0'] = values['key-1'] + ' '
+        reopened.close()
+    cleanup(DB(file_path, CompressedFormat()))
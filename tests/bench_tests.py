@@ -0,0 +1,22 @@
+from daybreak.bench import percentiles
+from daybreak.bench.__main__ import main
+import json
+import os
+
+output_path = './test_bench.json'
+
+
+def test_percentiles():
+    result = percentiles([float(i) for i in xrange(1, 101)])
+    assert result['p50'] == 51.0
+    assert result['p99'] == 99.0
+    assert result['min'] == 1.0 and result['max'] == 100.0
+
+
+def test_cli_writes_json():
+    main(['writes', 'loads', '--scale', '0.01', '--output', output_path])
+    with open(output_path) as f:
+        report = json.load(f)
+    os.remove(output_path)
+    assert sorted(report['results']) == ['loads', 'writes']
+    assert report['results']['writes']['throughput']['records'] == 1000
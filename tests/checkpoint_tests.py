@@ -0,0 +1,113 @@
+from daybreak.db import DB
+import os
+import time
+
+file_path = './test_checkpoint.db'
+
+
+def setup(**options):
+    return DB(file_path, **options)
+
+
+def cleanup(db):
+    db.clear(flush=True)
+    db.close()
+    os.remove(file_path)
+
+
+def test_load_replays_only_records_after_checkpoint():
+    testdb = setup()
+    for i in xrange(100):
+        testdb['key-%d' % (i % 10)] = i
+    testdb.checkpoint()
+    testdb['key-0'] = 'after'
+    del testdb['key-1']
+    testdb.close()
+    reopened = setup()
+    assert reopened['key-0'] == 'after'
+    assert not reopened.has_key('key-1')
+    assert reopened['key-9'] == 99
+    assert reopened.size() == 9
+    stats = reopened.stats()
+    assert stats['checkpoint_loads'] == 1
+    assert stats['records_read'] == 2
+    reopened['key-2'] = 'more'
+    reopened.flush()
+    assert setup()['key-2'] == 'more'
+    cleanup(reopened)
+
+
+def test_stale_checkpoint_falls_back_to_full_load():
+    testdb = setup()
+    for i in xrange(20):
+        testdb['key-%d' % i] = i
+    testdb.checkpoint()
+    testdb.compact()
+    testdb['key-0'] = 'after'
+    testdb.close()
+    reopened = setup()
+    assert not reopened.stats().get('checkpoint_loads')
+    assert reopened['key-0'] == 'after'
+    assert reopened.size() == 20
+    reopened.close()
+    with open(file_path + '.checkpoint', 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write('\0')
+    reopened = setup()
+    assert not reopened.stats().get('checkpoint_loads')
+    assert reopened.size() == 20
+    cleanup(reopened)
+    assert not os.path.exists(file_path + '.checkpoint')
+
+
+def test_checkpoint_every_n_records():
+    testdb = setup(checkpoint_records=50)
+    for i in xrange(60):
+        testdb.set('key-%d' % i, i, durability='written')
+    deadline = time.time() + 10
+    while not os.path.exists(file_path + '.checkpoint') and time.time() < deadline:
+        time.sleep(0.01)
+    testdb._checkpointer.join()
+    testdb.close()
+    reopened = setup()
+    assert reopened.stats()['checkpoint_loads'] == 1
+    assert reopened.size() == 60
+    cleanup(reopened)
+
+
+def test_auto_checkpoints_need_values_in_memory_and_one_file():
+    for options in ({'lazy_values': True, 'checkpoint_records': 10},
+                    {'segment_bytes': 1 << 16, 'checkpoint_bytes': 1 << 10}):
+        try:
+            setup(**options)
+            assert False
+        except ValueError:
+            pass
+    assert not os.path.exists(file_path)
+
+
+def test_concurrent_checkpoints_do_not_collide():
+    from threading import Thread
+    testdb = setup()
+    for i in xrange(2000):
+        testdb[str(i)] = i
+    testdb.flush()
+    errors = []
+
+    def checkpoint():
+        try:
+            for _ in xrange(5):
+                testdb.checkpoint()
+        except Exception as e:
+            errors.append(e)
+    threads = [Thread(target=checkpoint) for _ in xrange(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    testdb.close()
+    reopened = setup()
+    assert reopened.stats()['checkpoint_loads'] == 1
+    assert reopened.size() == 2000
+    cleanup(reopened)
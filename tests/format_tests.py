@@ -0,0 +1,112 @@
+from daybreak.format import DefaultFormat, CompressedFormat, FormatException
+from StringIO import StringIO
+import os
+
+
+def serialized(formatter, records):
+    return str(bytearray().join(formatter.serialize(list(r)) for r in records))
+
+
+def test_stream_matches_whole_buffer():
+    formatter = DefaultFormat()
+    records = [['a', 1], ['b', 'x' * 100], ['a'], ['c', [1, 2]]]
+    data = serialized(formatter, records)
+    expected = list(formatter.deserialize(data))
+    assert list(formatter.deserialize_stream(StringIO(data), chunk_size=7)) == expected
+    assert expected == [['a', 1], ['b', 'x' * 100], ['a'], ['c', [1, 2]]]
+
+
+def test_stream_stops_at_size():
+    formatter = DefaultFormat()
+    first = serialized(formatter, [['a', 1]])
+    data = first + serialized(formatter, [['b', 2]])
+    assert list(formatter.deserialize_stream(StringIO(data), 4, len(first))) == [['a', 1]]
+
+
+def test_stream_rejects_truncated_record():
+    formatter = DefaultFormat()
+    data = serialized(formatter, [['a', 1]])
+    try:
+        list(formatter.deserialize_stream(StringIO(data[:-1]), 4))
+    except FormatException:
+        return
+    assert False, 'truncated record was accepted'
+
+
+def test_typed_values_round_trip():
+    formatter = DefaultFormat()
+    values = ['1', u'caf\xe9', 42, -1 << 40, 1 << 80, 2.5, True, None, {'a': [1, (2, 3)]}, '']
+    data = serialized(formatter, [['k', value] for value in values])
+    decoded = [record[1] for record in formatter.deserialize(data)]
+    assert decoded == values
+    assert [type(value) for value in decoded] == [type(value) for value in values]
+
+
+def test_version_2_never_evaluates_values():
+    formatter = DefaultFormat()
+    data = serialized(formatter, [['k', '__import__("os").getpid()']])
+    assert list(formatter.deserialize(data)) == [['k', '__import__("os").getpid()']]
+
+
+def test_reads_version_1_header():
+    formatter = DefaultFormat(1)
+    header = StringIO(str(formatter.create_header()))
+    reader = DefaultFormat()
+    reader.read_header(header)
+    assert reader.version == 1
+    data = serialized(formatter, [['k', '[1, 2]']])
+    assert list(reader.deserialize(data)) == [['k', [1, 2]]]
+
+
+def test_batch_is_all_or_nothing():
+    formatter = DefaultFormat()
+    before = serialized(formatter, [['a', 1]])
+    batch = str(formatter.serialize_batch([['b', 2], ['a'], ['c', u'x']]))
+    data = before + batch
+    assert list(formatter.deserialize(data)) == [['a', 1], ['b', 2], ['a'], ['c', u'x']]
+    stream = formatter.deserialize_stream(StringIO(data[:-1]), 5, len(data) - 1)
+    assert next(stream) == ['a', 1]
+    try:
+        next(stream)
+    except FormatException:
+        return
+    assert False, 'torn batch was applied'
+
+
+def test_version_1_batch_falls_back_to_records():
+    formatter = DefaultFormat(1)
+    data = str(formatter.serialize_batch([['a', '1'], ['b', '2']]))
+    assert data == serialized(formatter, [['a', '1'], ['b', '2']])
+
+
+def test_compressed_values_round_trip():
+    values = ['{"status": "open", "owner": "user-%d", "tags": ["alpha", "beta"]}' % i for i in xrange(50)]
+    formatter = CompressedFormat(CompressedFormat.train(values))
+    records = [['k%d' % i, value] for i, value in enumerate(values)] + [['small', 'x'], ['noise', os.urandom(200)]]
+    data = serialized(formatter, records)
+    assert len(data) < len(serialized(DefaultFormat(), records)) / 2
+    frames = list(formatter.frames(memoryview(bytearray(data)), 0))
+    assert all(tag & formatter.COMPRESSED for _, tag, _, _, _ in frames[:50])
+    assert not any(tag & formatter.COMPRESSED for _, tag, _, _, _ in frames[50:])
+    reader = CompressedFormat()
+    reader.read_header(StringIO(str(formatter.create_header())))
+    assert reader.dictionary == formatter.dictionary
+    assert list(reader.deserialize(data)) == records
+
+
+def test_compressed_format_reads_version_2():
+    data = str(DefaultFormat().create_header()) + serialized(DefaultFormat(), [['a', 'b' * 100]])
+    stream = StringIO(data)
+    formatter = CompressedFormat('b' * 100)
+    formatter.read_header(stream)
+    assert formatter.version == 2
+    assert list(formatter.deserialize(stream.read())) == [['a', 'b' * 100]]
+    assert serialized(formatter, [['a', 'b' * 100]]) == data[len(DefaultFormat().create_header()):]
+
+
+def test_serialize_many_matches_serialize():
+    records = [['a', 1], ['b', u'abc'], ['a'], ['c', {'x': [1, 2]}], [u'd', 2.5], ['e', 'v' * 100]]
+    for formatter in (DefaultFormat(1), DefaultFormat(), CompressedFormat('v' * 100)):
+        data = formatter.serialize_many(records)
+        assert data == bytearray().join(formatter.serialize(record) for record in records)
+    assert list(formatter.deserialize(data)) == [[str(record[0])] + record[1:] for record in records]
@@ -0,0 +1,104 @@
+from daybreak.db import DB
+from daybreak.index import SortedKeys, successor
+import os
+import random
+
+file_path = './test_index.db'
+
+
+def setup(**options):
+    return DB(file_path, ordered=True, **options)
+
+
+def cleanup(db):
+    db.close()
+    os.remove(file_path)
+
+
+def test_sorted_keys_matches_sorted_set():
+    random.seed(19)
+    index = SortedKeys()
+    index.LOAD = 4
+    keys = set()
+    for _ in xrange(2000):
+        key = random.randint(0, 300)
+        if random.random() < 0.6:
+            index.add(key)
+            keys.add(key)
+        else:
+            index.discard(key)
+            keys.discard(key)
+    expected = sorted(keys)
+    assert len(index) == len(keys)
+    assert list(index.irange()) == expected
+    assert list(index.irange(reverse=True)) == expected[::-1]
+    for start, end in [(50, 100), (None, 10), (290, None), (120, 120), (-5, 400)]:
+        part = [key for key in expected if (start is None or key >= start) and (end is None or key < end)]
+        assert list(index.irange(start, end)) == part
+        assert list(index.irange(start, end, reverse=True)) == part[::-1]
+    assert all(key in index for key in keys)
+    assert 301 not in index
+
+
+def test_successor():
+    assert successor('user:42:') == 'user:42;'
+    assert successor('a\xff') == 'b'
+    assert successor('\xff\xff') is None
+    assert successor(u'k') == u'l'
+
+
+def test_range_and_prefix_scans():
+    testdb = setup()
+    testdb.update(dict(('user:%d:%d' % (user, item), item) for user in xrange(20) for item in xrange(5)))
+    testdb['user:42:0'] = 'a'
+    testdb['user:42:1'] = 'b'
+    del testdb['user:3:4']
+    assert list(testdb.prefix('user:42:')) == [('user:42:0', 'a'), ('user:42:1', 'b')]
+    assert [key for key, _ in testdb.prefix('user:3:', reverse=True)] == ['user:3:3', 'user:3:2', 'user:3:1',
+                                                                        'user:3:0']
+    assert [key for key, _ in testdb.range('user:18:3', 'user:19:1')] == ['user:18:3', 'user:18:4', 'user:19:0']
+    testdb.flush()
+    other = setup()
+    assert list(other.range()) == sorted(iter(testdb))
+    testdb['user:0:9'] = 9
+    del testdb['user:0:0']
+    testdb.flush()
+    other.load()
+    assert [key for key, _ in other.prefix('user:0:')] == ['user:0:1', 'user:0:2', 'user:0:3', 'user:0:4',
+                                                           'user:0:9']
+    other.close()
+    unordered = DB(file_path)
+    assert list(unordered.range('user:1:', 'user:11')) == list(testdb.range('user:1:', 'user:11'))
+    unordered.close()
+    cleanup(testdb)
+
+
+def test_secondary_index():
+    testdb = setup()
+    testdb.update({'a': {'status': 'open'}, 'b': {'status': 'done'}, 'c': {'status': 'open'}, 'd': 'plain'})
+    testdb.create_index('status', lambda value: value['status'])
+    assert sorted(testdb.find('status', 'open')) == [('a', {'status': 'open'}), ('c', {'status': 'open'})]
+    testdb['a'] = {'status': 'done'}
+    del testdb['c']
+    testdb['e'] = {'status': 'open'}
+    assert sorted(key for key, _ in testdb.find('status', 'done')) == ['a', 'b']
+    assert testdb.find('status', 'open') == [('e', {'status': 'open'})]
+    assert testdb.has_value('open', index='status')
+    assert not testdb.has_value('closed', index='status')
+    testdb.flush()
+    other = setup()
+    other.create_index('status', lambda value: value['status'])
+    testdb['b'] = {'status': 'open'}
+    testdb.flush()
+    other.load()
+    assert sorted(key for key, _ in other.find('status', 'open')) == ['b', 'e']
+    testdb.compact()
+    other.load()
+    assert [key for key, _ in other.find('status', 'done')] == ['a']
+    assert other.stats()['index']['count'] > 0
+    other.close()
+    lazy = setup(lazy_values=True)
+    lazy.create_index('status', lambda value: value['status'])
+    assert sorted(key for key, _ in lazy.find('status', 'open')) == ['b', 'e']
+    lazy.close()
+    cleanup(testdb)
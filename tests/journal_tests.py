@@ -0,0 +1,305 @@
+from daybreak.db import DB
+from daybreak.format import BaseFormat, DefaultFormat
+import os
+import time
+
+file_path = './test_journal.db'
+
+
+def setup(**options):
+    return DB(file_path, **options)
+
+
+def cleanup(db):
+    db.close()
+    os.remove(file_path)
+
+
+def test_worker_groups_queued_records():
+    testdb = setup(linger=0.2, fsync='batch')
+    for i in xrange(100):
+        testdb[str(i)] = i
+    testdb._journal.join()
+    stats = testdb._journal.batch_stats()
+    assert stats['records'] == 100
+    assert stats['batches'] < 100
+    assert stats['max'] > 1
+    testdb.load()
+    assert testdb['99'] == 99
+    cleanup(testdb)
+
+
+def test_batch_bytes_limits_batch_size():
+    testdb = setup(linger=0.2, batch_bytes=1)
+    for key in 'abc':
+        testdb[key] = key
+    testdb._journal.join()
+    assert testdb._journal.batch_stats()['max'] == 1
+    cleanup(testdb)
+
+
+def test_lockfile_locking_backend():
+    testdb = setup(locking='lockfile')
+    testdb['foo'] = 'bar'
+    testdb.load()
+    assert testdb['foo'] == 'bar'
+    assert not os.path.exists(file_path + '.lock')
+    cleanup(testdb)
+
+
+def test_version_1_journal_is_migrated():
+    old = setup(formatter=DefaultFormat(1))
+    old['foo'] = 'bar'
+    old._journal.join()
+    old.close()
+    testdb = setup()
+    assert testdb._journal.formatter.version == 1
+    testdb['baz'] = 1
+    testdb._journal.join()
+    assert testdb.migrate()
+    with open(file_path, 'rb') as f:
+        assert f.read(10) == str(DefaultFormat().create_header())
+    testdb['qux'] = u'quux'
+    testdb.load()
+    assert testdb['foo'] == 'bar'
+    assert testdb['baz'] == 1
+    assert testdb['qux'] == u'quux'
+    cleanup(testdb)
+
+
+def test_mmap_read_path():
+    testdb = setup(mmap=True)
+    testdb['foo'] = 'bar'
+    testdb.load()
+    mapping = testdb._journal.mapping
+    assert testdb['foo'] == 'bar'
+    testdb['baz'] = {'a': 1}
+    del testdb['foo']
+    testdb.load()
+    assert testdb._journal.mapping is not mapping
+    assert testdb['baz'] == {'a': 1}
+    assert not testdb.has_key('foo')
+    reloaded = setup(mmap=True)
+    assert reloaded['baz'] == {'a': 1}
+    reloaded.close()
+    cleanup(testdb)
+
+
+def test_flush_waits_for_queued_records():
+    testdb = setup(linger=0.2)
+    journal = testdb._journal
+    for i in xrange(10):
+        testdb[str(i)] = i
+    assert not testdb.flush(timeout=0.01)
+    assert testdb.flush()
+    assert journal.written == journal.queued
+    assert testdb.flush(fsync=True)
+    assert journal.durable == journal.queued
+    assert journal.batch_stats()['records'] == 10
+    cleanup(testdb)
+
+
+def test_durability_levels():
+    testdb = setup(linger=0.5)
+    journal = testdb._journal
+    testdb.set('a', 1, durability='written')
+    assert journal.written == journal.queued
+    testdb.set_flush('b', 2)
+    testdb.delete_flush('a')
+    testdb.update_flush({'c': 3, 'd': 4})
+    assert journal.durable == journal.queued
+    other = setup()
+    assert sorted(other.keys()) == ['b', 'c', 'd']
+    other.close()
+    cleanup(testdb)
+
+
+def test_close_writes_queued_records():
+    testdb = setup(linger=0.5)
+    testdb['foo'] = 'bar'
+    testdb.close()
+    testdb = setup()
+    assert testdb['foo'] == 'bar'
+    cleanup(testdb)
+
+
+def test_update_is_one_batch_record():
+    testdb = setup()
+    queued = testdb._journal.queued
+    assert testdb.update(dict((str(i), i) for i in xrange(1000)), durability='written') is None
+    assert testdb._journal.queued == queued + 1
+    assert testdb._journal.batch_stats()['batches'] == 1
+    other = setup(mmap=True)
+    assert other.size() == 1000 and other['999'] == 999
+    assert other.logsize() == 1000
+    other.close()
+    cleanup(testdb)
+
+
+def test_coalesce_merges_queued_writes():
+    testdb = setup(linger=0.2, overflow='coalesce', queue_size=10)
+    testdb['first'] = 0
+    for i in xrange(100):
+        testdb['hot'] = i
+    testdb['gone'] = 1
+    del testdb['gone']
+    testdb.update({'hot': 'batched'})
+    testdb['hot'] = 'last'
+    assert testdb.flush(timeout=5)
+    stats = testdb._journal.batch_stats()
+    assert stats['coalesced'] == 100
+    assert stats['records'] < 10
+    assert testdb.stats()['coalesce_ratio'] == stats['coalesce_ratio'] > 0.9
+    other = setup()
+    assert other['hot'] == 'last' and not other.has_key('gone')
+    other.close()
+    cleanup(testdb)
+
+
+def test_callbacks_do_not_keep_writes_from_coalescing():
+    testdb = setup(linger=0.2, overflow='coalesce', queue_size=2)
+    journal = testdb._journal
+    called = []
+    testdb['first'] = 0
+    for i in xrange(3):
+        journal.when(testdb._set('hot', i), 'written', lambda: called.append(True))
+    assert journal.qsize() <= 2
+    assert testdb.flush(timeout=5)
+    assert journal.batch_stats()['coalesced'] == 2
+    cleanup(testdb)
+    assert len(called) == 3
+
+
+def test_overflow_raise():
+    from Queue import Full
+    testdb = setup(queue_size=1, overflow='raise')
+    try:
+        with testdb._journal.lock():
+            for i in xrange(3):
+                testdb[str(i)] = i
+    except Full:
+        pass
+    else:
+        assert False, 'full queue accepted a record'
+    cleanup(testdb)
+
+
+def test_overflow_raise_leaves_memory_as_it_was():
+    from Queue import Full
+    for options in ({}, {'lazy_values': True}, {'ordered': True}):
+        testdb = setup(queue_size=1, overflow='raise', **options)
+        testdb['0'] = 'old'
+        testdb.flush()
+        with testdb._journal.lock():
+            # The worker takes one record and waits for the lock, the next fills the queue
+            testdb['1'] = 1
+            while testdb._journal.qsize():
+                time.sleep(0.01)
+            testdb['2'] = 1
+            try:
+                testdb['refused'] = 1
+                assert False, 'full queue accepted a record'
+            except Full:
+                pass
+            for d in ({'0': 'new'}, {'3': 3, '0': 'new'}):
+                try:
+                    testdb.update(d)
+                    assert False, 'full queue accepted a record'
+                except Full:
+                    pass
+            try:
+                testdb.set('0', 'new', ttl=60)
+                assert False, 'full queue accepted a record'
+            except Full:
+                pass
+        testdb.flush()
+        assert sorted(testdb.keys()) == ['0', '1', '2'] and testdb['0'] == 'old'
+        assert testdb._expires == {}
+        if options.get('ordered'):
+            assert [key for key, _ in testdb.range()] == ['0', '1', '2']
+        other = setup()
+        assert sorted(iter(other)) == sorted(iter(testdb))
+        other.close()
+        cleanup(testdb)
+
+
+def test_when_calls_back_from_worker():
+    from threading import Event
+    testdb = setup(linger=0.1)
+    journal = testdb._journal
+    written, synced = Event(), Event()
+    journal.when(journal << ['a', 1], 'written', written.set)
+    assert not written.is_set()
+    assert written.wait(5)
+    journal.when(journal.queued, 'fsynced', synced.set)
+    assert synced.wait(5)
+    assert journal.durable == journal.queued
+    called = []
+    journal.when(journal.queued, 'written', lambda: called.append(True))
+    assert called == [True]
+    cleanup(testdb)
+
+
+def test_read_after_following_a_compaction_reloads():
+    from daybreak.journal import JournalReplaced
+    testdb = setup(mmap=True)
+    other = setup(mmap=True)
+    for i in xrange(50):
+        testdb[str(i)] = i
+        other['other-%d' % i] = i
+    testdb.flush()
+    other.load()
+    testdb.compact()
+    # Our writer moves to the compacted file, the reader is still on the old one
+    other['last'] = 'x'
+    other.flush()
+    try:
+        list(other._journal.read())
+        assert False, 'read past a compaction'
+    except JournalReplaced:
+        pass
+    other.load()
+    assert other.size() == 101
+    assert other['49'] == 49 and other['last'] == 'x'
+    other.close()
+    cleanup(testdb)
+
+
+class PlainFormat(BaseFormat):
+    """A format with only the methods BaseFormat requires."""
+
+    def __init__(self):
+        self.inner = DefaultFormat()
+
+    def read_header(self, stream):
+        self.inner.read_header(stream)
+
+    def create_header(self):
+        return self.inner.create_header()
+
+    def serialize(self, data):
+        return self.inner.serialize(data)
+
+    def deserialize(self, string):
+        return self.inner.deserialize(string)
+
+
+def test_features_check_the_format_on_open():
+    for options, method in (({'mmap': True}, 'records'), ({'lazy_values': True}, 'deserialize_stream'),
+                            ({'recover': True}, 'locations'), ({'compact_ratio': 2}, 'deserialize_stream'),
+                            ({'segment_bytes': 1024}, 'deserialize_stream')):
+        try:
+            setup(formatter=PlainFormat(), **options)
+            assert False
+        except ValueError as e:
+            assert method in str(e)
+    testdb = setup(formatter=PlainFormat())
+    testdb['a'] = 1
+    try:
+        testdb.compact()
+        assert False
+    except ValueError as e:
+        assert 'deserialize_stream' in str(e)
+    testdb.load()
+    assert testdb['a'] == 1
+    cleanup(testdb)
@@ -0,0 +1,82 @@
+from daybreak.db import DB
+import os
+
+file_path = './test_keydir.db'
+
+
+def setup(**options):
+    return DB(file_path, lazy_values=True, **options)
+
+
+def cleanup(db):
+    db.close()
+    os.remove(file_path)
+
+
+def test_written_values_leave_memory():
+    testdb = setup()
+    testdb['foo'] = 'bar' * 100
+    testdb['baz'] = {'a': 1}
+    testdb._journal.join()
+    assert testdb._data.pending == {}
+    assert testdb['foo'] == 'bar' * 100
+    assert testdb['baz'] == {'a': 1}
+    cleanup(testdb)
+
+
+def test_loads_locations_only():
+    writer = setup()
+    writer.update({'a': 1, 'b': 'two', 'c': [3]})
+    del writer['b']
+    writer._journal.join()
+    testdb = setup(mmap=True)
+    assert sorted(testdb.keys()) == ['a', 'c']
+    assert all(isinstance(location, tuple) for location in testdb._data.keydir.values())
+    assert testdb.has_key('a') and not testdb.has_key('b')
+    assert sorted(testdb) == [('a', 1), ('c', [3])]
+    testdb.close()
+    cleanup(writer)
+
+
+def test_cache_is_bounded():
+    testdb = setup(cache_bytes=250)
+    for i in xrange(10):
+        testdb[str(i)] = 'x' * 100
+    testdb._journal.join()
+    for i in xrange(10):
+        assert testdb[str(i)] == 'x' * 100
+    assert testdb._data.cached <= 250
+    assert len(testdb._data.cache) == 2
+    cleanup(testdb)
+
+
+def test_compacts_lazily_loaded_values():
+    testdb = setup()
+    for i in xrange(20):
+        testdb['foo'] = i
+    testdb['bar'] = 'baz'
+    testdb._journal.join()
+    assert testdb.compact()
+    testdb.load()
+    assert testdb.logsize() == 2
+    assert testdb['foo'] == 19
+    assert testdb['bar'] == 'baz'
+    cleanup(testdb)
+
+
+def test_mapped_values_survive_a_clear_elsewhere():
+    testdb = setup(mmap=True)
+    for i in xrange(100):
+        testdb[str(i)] = 'x' * 1000
+    testdb.flush()
+    other = setup(mmap=True)
+    assert other['99'] == 'x' * 1000
+    testdb.clear(flush=True)
+    # Still reads the file it had mapped, which was replaced rather than truncated
+    other._data.cache.clear()
+    other._data.cached = 0
+    assert other['42'] == 'x' * 1000
+    other.load()
+    assert other.size() == 0
+    other.close()
+    cleanup(testdb)
@@ -0,0 +1,115 @@
+from daybreak.lock import ReentrantLock, FlockLock, LockfileLock
+import os
+
+file_path = './test_lock.db'
+
+
+def setup():
+    first, second = open(file_path, 'ab+'), open(file_path, 'ab+')
+    return first, second, FlockLock(first.fileno), FlockLock(second.fileno)
+
+
+def cleanup(*files):
+    for f in files:
+        f.close()
+    os.remove(file_path)
+
+
+def test_shared_locks_coexist():
+    first, second, a, b = setup()
+    assert a.acquire(exclusive=False)
+    assert b.acquire(exclusive=False, blocking=False)
+    assert not a.exclusive()
+    a.release()
+    b.release()
+    cleanup(first, second)
+
+
+def test_exclusive_lock_is_reentrant():
+    first, second, a, b = setup()
+    with a():
+        with a(exclusive=False):
+            assert a.exclusive()
+            assert not b.acquire(exclusive=False, blocking=False)
+        assert not b.acquire(exclusive=False, blocking=False)
+    assert b.acquire(blocking=False)
+    b.release()
+    cleanup(first, second)
+
+
+def test_shared_lock_upgrades_inside_block():
+    first, second, a, b = setup()
+    with a(exclusive=False):
+        with a():
+            assert not b.acquire(exclusive=False, blocking=False)
+        assert b.acquire(exclusive=False, blocking=False)
+        b.release()
+    cleanup(first, second)
+
+
+def test_lockfile_fallback():
+    lock = LockfileLock(file_path)
+    with lock():
+        assert os.path.exists(file_path + '.lock')
+    assert not os.path.exists(file_path + '.lock')
+
+
+def test_lent_lock_nests_inside_owner():
+    from threading import Thread, Event
+    first, second, a, b = setup()
+    lent, taken = Event(), []
+
+    def borrower():
+        lent.wait()
+        with a(exclusive=False):
+            taken.append(a.exclusive())
+
+    thread = Thread(target=borrower)
+    thread.start()
+    with a():
+        a.lend(thread.ident)
+        lent.set()
+        thread.join()
+        assert taken == [True]
+        a.reclaim(thread.ident)
+        assert not b.acquire(blocking=False)
+    assert b.acquire(blocking=False)
+    b.release()
+    cleanup(first, second)
+
+
+def test_reclaim_waits_for_borrower_to_release():
+    from threading import Thread, Event
+    import time
+    first, second, a, b = setup()
+    inside, errors = Event(), []
+
+    def borrower():
+        a.acquire()
+        inside.set()
+        time.sleep(0.05)
+        try:
+            a.release()
+        except RuntimeError as e:
+            errors.append(e)
+
+    with a():
+        thread = Thread(target=borrower)
+        thread.start()
+        a.lend(thread.ident)
+        inside.wait()
+        a.reclaim(thread.ident)
+        thread.join()
+    assert not errors
+    cleanup(first, second)
+
+
+def test_subclasses_must_implement_the_process_wide_lock():
+    class Partial(ReentrantLock):
+        def _lock(self, exclusive, blocking):
+            return True
+    try:
+        Partial()
+        assert False
+    except TypeError:
+        pass
@@ -0,0 +1,73 @@
+from daybreak.db import DB
+from daybreak.format import DefaultFormat
+import os
+import time
+
+file_path = './test_readonly.db'
+
+
+def setup(**options):
+    return DB(file_path, **options)
+
+
+def cleanup(*dbs):
+    for db in dbs:
+        db.close()
+    os.remove(file_path)
+
+
+def test_replica_follows_writer_without_locking():
+    writer = setup()
+    writer.set('a', 1, durability='written')
+    reader = setup(readonly=True, poll_interval=None)
+    assert reader['a'] == 1
+    assert reader['missing'] is None
+    assert not reader.has_key('missing')
+    with writer.lock():
+        writer['b'] = 2
+        writer.flush()
+        reader.load()
+        assert reader['b'] == 2
+    for write in (lambda: reader.set('a', 2), lambda: reader.delete('a'), lambda: reader.update({'c': 3}),
+                  reader.compact, lambda: reader.clear(flush=True)):
+        try:
+            write()
+        except IOError:
+            pass
+        else:
+            assert False, 'read-only database was written to'
+    assert dict(iter(reader)) == {'a': 1, 'b': 2}
+    assert not os.path.exists(file_path + '.lock')
+    cleanup(reader, writer)
+
+
+def test_partial_tail_is_not_yet_committed():
+    writer = setup()
+    writer.set('a', 1, durability='written')
+    writer.close()
+    record = str(DefaultFormat().serialize(['b', 'x' * 100]))
+    reader = setup(readonly=True, poll_interval=None)
+    with open(file_path, 'ab') as f:
+        f.write(record[:50])
+        f.flush()
+        reader.load()
+        assert dict(iter(reader)) == {'a': 1}
+        f.write(record[50:])
+        f.flush()
+        reader.load()
+    assert reader['b'] == 'x' * 100
+    assert reader.logsize() == 2
+    cleanup(reader)
+
+
+def test_replica_polls_for_changes():
+    writer = setup()
+    reader = setup(readonly=True, poll_interval=0.01)
+    writer.set('a', 1, durability='written')
+    writer.compact()
+    writer.set('b', 2, durability='written')
+    deadline = time.time() + 5
+    while dict(iter(reader)) != {'a': 1, 'b': 2} and time.time() < deadline:
+        time.sleep(0.01)
+    assert dict(iter(reader)) == {'a': 1, 'b': 2}
+    cleanup(reader, writer)
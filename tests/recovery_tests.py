@@ -0,0 +1,87 @@
+from daybreak.db import DB
+from daybreak.format import CRCException
+from daybreak.recovery import REGION
+import glob
+import os
+import stat
+
+file_path = './test_recovery.db'
+
+
+def setup(**options):
+    return DB(file_path, **options)
+
+
+def cleanup(db):
+    db.close()
+    for path in glob.glob(file_path + '*'):
+        os.remove(path)
+
+
+def write_records(keys):
+    testdb = setup()
+    for key in keys:
+        testdb.set(key, key * 10)
+        testdb.flush()
+    testdb.close()
+    return os.path.getsize(file_path)
+
+
+def test_clean_journal_is_left_alone():
+    size = write_records('abc')
+    testdb = setup(recover=True)
+    assert testdb._journal.recovery == {'records': 3, 'torn': 0, 'quarantined': []}
+    assert os.path.getsize(file_path) == size
+    assert glob.glob(file_path + '.*') == []
+    cleanup(testdb)
+
+
+def test_torn_tail_is_truncated():
+    size = write_records('abc')
+    with open(file_path, 'ab') as f:
+        f.write('\x00\x00\x00\x01\x00\x00\x00\x10\x00d')
+    testdb = setup(recover=True)
+    assert testdb._journal.recovery == {'records': 3, 'torn': 10, 'quarantined': []}
+    assert os.path.getsize(file_path) == size
+    assert sorted(testdb.keys()) == ['a', 'b', 'c']
+    assert testdb.stats()['torn_bytes'] == 10
+    with open(file_path + '.torn', 'rb') as f:
+        assert REGION.unpack(f.read(REGION.size)) == (size, 10)
+        assert f.read() == '\x00\x00\x00\x01\x00\x00\x00\x10\x00d'
+    testdb['d'] = 'dd'
+    testdb.close()
+    reopened = setup()
+    assert reopened['d'] == 'dd'
+    cleanup(reopened)
+
+
+def test_damage_in_the_middle_is_quarantined():
+    write_records('abcde')
+    os.chmod(file_path, 0o640)
+    with open(file_path, 'r+b') as f:
+        data = f.read()
+        offset = data.index('c' * 10)
+        f.seek(offset)
+        f.write('X' * 5)
+    try:
+        setup()
+        assert False
+    except CRCException:
+        pass
+    testdb = setup(recover=True)
+    report = testdb._journal.recovery
+    assert report['records'] == 4 and report['torn'] == 0
+    assert [size for _, size in report['quarantined']] == [24]
+    assert sorted(testdb.keys()) == ['a', 'b', 'd', 'e']
+    assert testdb['e'] == 'e' * 10
+    # Rewritten without the damage, with the same permissions
+    assert stat.S_IMODE(os.stat(file_path).st_mode) == 0o640
+    with open(file_path + '.quarantine', 'rb') as f:
+        assert REGION.unpack(f.read(REGION.size)) == report['quarantined'][0]
+        assert 'XXXXX' in f.read()
+    # Damage that runs into the end of the file is a torn tail
+    with open(file_path, 'ab') as f:
+        f.write('\xff' * 40)
+    assert testdb.recover() == {'records': 4, 'torn': 40, 'quarantined': []}
+    assert testdb.size() == 4
+    cleanup(testdb)
@@ -0,0 +1,86 @@
+from daybreak.db import DB
+from daybreak.segment import segment_numbers, hint_path, write_hint, read_hint
+import glob
+import os
+import stat
+
+file_path = './test_segment.db'
+
+
+def setup(**options):
+    return DB(file_path, segment_bytes=1024, **options)
+
+
+def cleanup(db):
+    db.clear(flush=True)
+    db.close()
+    os.remove(file_path)
+
+
+def fill(db, start, stop):
+    for i in xrange(start, stop):
+        db.set('key-%d' % (i % 50), 'value-%d' % i, durability='written')
+        if i % 7 == 0:
+            db.delete('key-%d' % ((i + 1) % 50), durability='written')
+
+
+def test_journal_rolls_into_hinted_segments():
+    testdb = setup()
+    fill(testdb, 0, 300)
+    expected = dict(iter(testdb))
+    numbers = segment_numbers(file_path)
+    assert len(numbers) > 2
+    assert all(os.path.exists(hint_path(file_path, number)) for number in numbers)
+    assert os.path.getsize(file_path) < 1024
+    testdb.close()
+    for lazy in (False, True):
+        reopened = setup(lazy_values=lazy)
+        assert dict(iter(reopened)) == expected
+        assert not reopened.stats().get('hint_misses')
+        reopened.close()
+    os.remove(hint_path(file_path, numbers[0]))
+    reopened = setup()
+    assert dict(iter(reopened)) == expected
+    assert reopened.stats()['hint_misses'] == 1
+    cleanup(reopened)
+
+
+def test_reader_follows_rolls_incrementally():
+    writer, reader = setup(), setup(lazy_values=True)
+    fill(writer, 0, 100)
+    reader.load()
+    fill(writer, 100, 400)
+    assert not reader._journal.replaced()
+    reader.load()
+    assert dict(iter(reader)) == dict(iter(writer))
+    reader.close()
+    cleanup(writer)
+
+
+def test_compaction_merges_segments():
+    testdb = setup()
+    fill(testdb, 0, 400)
+    expected = dict(iter(testdb))
+    before = sum(os.path.getsize('{}.{}.seg'.format(file_path, n)) for n in segment_numbers(file_path))
+    assert testdb.compact()
+    after = sum(os.path.getsize('{}.{}.seg'.format(file_path, n)) for n in segment_numbers(file_path))
+    assert after < before / 2
+    testdb.load()
+    assert dict(iter(testdb)) == expected
+    testdb['new'] = 'x'
+    testdb.close()
+    reopened = setup(lazy_values=True)
+    expected['new'] = 'x'
+    assert dict(iter(reopened)) == expected
+    cleanup(reopened)
+
+
+def test_rewritten_hint_keeps_its_permissions():
+    path = file_path + '.hint-test'
+    write_hint(path, {'a': (0, 1, None)}, 1, 10)
+    os.chmod(path, 0o640)
+    write_hint(path, {'a': None}, 2, 20)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    assert read_hint(path, 20) == ({'a': None}, 2)
+    assert glob.glob(path + '*') == [path]
+    os.remove(path)
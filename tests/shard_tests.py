@@ -0,0 +1,136 @@
+from daybreak.shard import ShardedDB
+from daybreak.format import BaseFormat, DefaultFormat
+import os
+import time
+
+file_path = './test_shard.db'
+
+
+def setup(**options):
+    return ShardedDB(file_path, **options)
+
+
+def cleanup(db):
+    db.close()
+    for n in xrange(len(db.shards)):
+        os.remove('{}.{}'.format(file_path, n))
+    os.remove(file_path + '.shards')
+
+
+def test_keys_are_spread_and_merged():
+    testdb = setup()
+    testdb.update(dict((str(i), i) for i in xrange(100)))
+    testdb['extra'] = 'x'
+    del testdb['0']
+    assert testdb.size() == 100
+    assert sorted(testdb.keys()) == sorted([str(i) for i in xrange(1, 100)] + ['extra'])
+    assert all(db.size() for db in testdb.shards)
+    assert testdb.shard('42') is testdb.shard(u'42')
+    assert dict(iter(testdb))['99'] == 99
+    cleanup(testdb)
+
+
+class PlainFormat(BaseFormat):
+    """A format with only the methods BaseFormat requires."""
+
+    def __init__(self):
+        self.inner = DefaultFormat()
+
+    def read_header(self, stream):
+        self.inner.read_header(stream)
+
+    def create_header(self):
+        return self.inner.create_header()
+
+    def serialize(self, data):
+        return self.inner.serialize(data)
+
+    def deserialize(self, string):
+        return self.inner.deserialize(string)
+
+
+def test_any_format_can_pick_shards():
+    testdb = setup(formatter=PlainFormat())
+    testdb.update(dict((str(i), i) for i in xrange(20)))
+    assert testdb.shard('7') is testdb.shard(u'7')
+    testdb.flush()
+    testdb.close()
+    reopened = setup(formatter=PlainFormat())
+    assert reopened['7'] == 7 and reopened.size() == 20
+    cleanup(reopened)
+
+
+def test_reload_and_compact_in_process_pool():
+    testdb = setup(processes=2)
+    for i in xrange(200):
+        testdb[str(i % 20)] = i
+    testdb.close()
+    testdb = setup(processes=2, lazy_values=True)
+    assert testdb.size() == 20 and testdb['19'] == 199
+    assert testdb.logsize() == 200
+    assert testdb.compact()
+    assert testdb.logsize() == 20
+    testdb['new'] = 1
+    assert testdb['5'] == 185
+    cleanup(testdb)
+
+
+def test_shard_count_must_match():
+    testdb = setup(shards=3)
+    testdb.close()
+    for shards in (2, 4):
+        try:
+            setup(shards=shards)
+        except ValueError:
+            pass
+        else:
+            assert False, 'opened with {} shards instead of 3'.format(shards)
+    # Databases from before the count was recorded are checked against their files
+    os.remove(file_path + '.shards')
+    try:
+        setup(shards=4)
+    except ValueError:
+        pass
+    else:
+        assert False, 'opened with more shards than it has'
+    cleanup(setup(shards=3))
+
+
+def test_compressed_format_in_process_pool():
+    from daybreak.format import CompressedFormat
+    formatter = CompressedFormat('{"status": "open", "owner": "someone"}' * 4, min_size=16)
+    testdb = setup(processes=2, formatter=formatter)
+    for i in xrange(40):
+        testdb[str(i)] = {'status': 'open', 'owner': 'someone', 'n': i}
+    testdb.close()
+    testdb = setup(processes=2, formatter=formatter)
+    assert testdb.size() == 40 and testdb['7']['n'] == 7
+    assert testdb.compact()
+    assert testdb['39']['n'] == 39
+    cleanup(testdb)
+
+
+def test_range_and_prefix_merge_the_shards():
+    testdb = setup(ordered=True)
+    testdb.update(dict(('user:%d:%d' % (user, item), item) for user in xrange(12) for item in xrange(3)))
+    expected = sorted(iter(testdb))
+    assert list(testdb.range()) == expected
+    assert list(testdb.range(reverse=True)) == expected[::-1]
+    assert [key for key, _ in testdb.prefix('user:1')] == [key for key, _ in expected if key.startswith('user:1')]
+    assert list(testdb.range('user:10:2', 'user:11:1', reverse=True)) == [('user:11:0', 0), ('user:10:2', 2)]
+    cleanup(testdb)
+
+
+def test_flush_timeout_covers_every_shard():
+    testdb = setup(shards=4)
+    locks = [db._journal.lock for db in testdb.shards]
+    for lock in locks:
+        lock.acquire()
+    testdb.update(dict((str(i), i) for i in xrange(40)))
+    started = time.time()
+    assert not testdb.flush(timeout=0.2)
+    assert time.time() - started < 0.5
+    for lock in locks:
+        lock.release()
+    assert testdb.flush(timeout=5)
+    cleanup(testdb)
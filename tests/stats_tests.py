@@ -0,0 +1,79 @@
+from daybreak.db import DB
+from daybreak.stats import Histogram, Stats, deep_sizeof
+from threading import Thread
+import os
+import time
+
+file_path = './test_stats.db'
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(unit=1)
+    for value in xrange(1, 101):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 100
+    assert snapshot['max'] == 100
+    assert 50 <= snapshot['p50'] <= 64
+    assert snapshot['p99'] == 100
+
+
+def test_deep_sizeof_counts_contents():
+    assert deep_sizeof({'a': 'x' * 1000}) > 1000
+    assert deep_sizeof(['x' * 100] * 5000, sample=100) > 5000 * 100
+
+
+def test_db_stats():
+    testdb = DB(file_path)
+    testdb['foo'] = 'bar' * 1000
+    testdb.load()
+    stats = testdb.stats()
+    assert stats['records_written'] == 1
+    assert stats['bytes_written'] > 3000
+    assert stats['write']['count'] == 2
+    assert stats['load']['count'] == 2
+    assert stats['queue_depth'] == 0
+    assert stats['memory_bytes'] > 3000
+    testdb.close()
+    os.remove(file_path)
+
+
+def test_stats_hook():
+    testdb = DB(file_path)
+    reports = []
+    testdb.add_stats_hook(reports.append, interval=0.01)
+    time.sleep(0.1)
+    assert reports and 'queue_depth' in reports[0]
+    testdb.close()
+    os.remove(file_path)
+
+
+def test_stats_while_another_thread_writes():
+    testdb = DB(file_path)
+    for i in xrange(2000):
+        testdb['key-%d' % i] = i
+    stop = []
+
+    def churn():
+        i = 0
+        while not stop:
+            testdb['new-%d' % i] = i
+            testdb.delete('new-%d' % (i - 10))
+            i += 1
+    writer = Thread(target=churn)
+    writer.start()
+    try:
+        for _ in xrange(100):
+            assert testdb.stats()['memory_bytes'] > 0
+    finally:
+        stop.append(True)
+        writer.join()
+    stats = Stats()
+    threads = [Thread(target=lambda: [stats.incr('n') for _ in xrange(10000)]) for _ in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stats.snapshot()['n'] == 40000
+    testdb.close()
+    os.remove(file_path)
@@ -0,0 +1,152 @@
+from daybreak.db import DB
+from daybreak.format import DefaultFormat, CompressedFormat
+from daybreak.segment import segment_numbers
+import glob
+import os
+import time
+
+file_path = './test_ttl.db'
+
+
+def setup(**options):
+    return DB(file_path, **options)
+
+
+def cleanup(db):
+    db.clear(flush=True)
+    db.close()
+    for path in glob.glob(file_path + '*'):
+        os.remove(path)
+
+
+def test_expiry_round_trip():
+    expires = time.time() + 60
+    for formatter in (DefaultFormat(), CompressedFormat('spam' * 20, min_size=8)):
+        records = [['a', 'spam' * 10, expires], ['b', 7], ['c']]
+        assert list(formatter.deserialize(formatter.serialize_many(records))) == records
+        assert list(formatter.deserialize(formatter.serialize_batch(records))) == records
+        buf = memoryview(formatter.serialize(records[0]))
+        (key, (offset, size, tag), stored), _ = next(formatter.locations(buf, 0))
+        assert formatter.expiring(tag) and stored == expires
+        assert formatter.load_value(tag, buf[offset:offset + size]) == 'spam' * 10
+
+
+def test_expired_keys_are_dropped_on_access_and_load():
+    testdb = setup(sweep_interval=None)
+    testdb.set('short', 1, ttl=0.05)
+    testdb.set('long', 2, ttl=60)
+    testdb.update({'batch': 3}, ttl=0.05)
+    testdb['plain'] = 4
+    assert testdb['short'] == 1 and testdb.has_key('batch')
+    testdb.flush()
+    time.sleep(0.1)
+    assert not testdb.has_key('short')
+    assert len(testdb._data) == 3
+    # Counting the keys drops the other expired one
+    assert testdb.size() == 2
+    assert testdb.stats()['expired'] == 2
+    other = setup(sweep_interval=None)
+    assert sorted(other.keys()) == ['long', 'plain']
+    other.close()
+    # Setting a key again without a ttl keeps it
+    testdb['long'] = 5
+    testdb.flush()
+    lazy = setup(lazy_values=True, sweep_interval=None)
+    assert lazy._expires == {}
+    assert lazy['long'] == 5
+    lazy.close()
+    cleanup(testdb)
+
+
+def test_sweeper_drops_keys_in_expiry_order():
+    testdb = setup(sweep_interval=None, ordered=True)
+    for i in xrange(10):
+        testdb.set('key-%d' % i, i, ttl=0.05 if i % 2 else 60)
+    testdb.set('key-1', 'kept', ttl=60)
+    time.sleep(0.1)
+    assert testdb.sweep(limit=2) == 2
+    assert testdb.sweep() == 2
+    assert testdb.sweep() == 0
+    assert [key for key, _ in testdb.range()] == ['key-0', 'key-1', 'key-2', 'key-4', 'key-6', 'key-8']
+    testdb.close()
+    background = setup(sweep_interval=0.05)
+    background.set('gone', 1, ttl=0.05)
+    time.sleep(0.3)
+    assert 'gone' not in background.keys()
+    cleanup(background)
+
+
+def test_compaction_and_checkpoints_discard_expired_records():
+    testdb = setup(sweep_interval=None)
+    for i in xrange(20):
+        testdb.set('key-%d' % i, i, ttl=0.05 if i < 10 else 60)
+    testdb.flush()
+    time.sleep(0.1)
+    testdb.compact()
+    assert testdb.logsize() == 10
+    testdb.checkpoint()
+    testdb.set('key-10', 'again', ttl=0.05)
+    testdb.close()
+    time.sleep(0.1)
+    reopened = setup(sweep_interval=None)
+    assert reopened.stats()['checkpoint_loads'] == 1
+    assert sorted(reopened.keys()) == sorted('key-%d' % i for i in xrange(11, 20))
+    assert reopened._expires['key-19'] > time.time()
+    cleanup(reopened)
+
+
+def test_segment_merge_discards_expired_records():
+    testdb = setup(sweep_interval=None, segment_bytes=256)
+    for i in xrange(30):
+        testdb.set('key-%d' % i, 'x' * 20, ttl=0.05 if i % 3 else 60)
+    testdb.flush()
+    assert segment_numbers(file_path)
+    lazy = setup(lazy_values=True, segment_bytes=256, sweep_interval=None)
+    assert len(lazy._expires) == 30
+    lazy.close()
+    time.sleep(0.1)
+    testdb.compact()
+    reopened = setup(lazy_values=True, segment_bytes=256, sweep_interval=None)
+    assert sorted(reopened.keys()) == sorted('key-%d' % i for i in xrange(0, 30, 3))
+    assert reopened['key-3'] == 'x' * 20
+    reopened.close()
+    cleanup(testdb)
+
+
+def test_reading_an_expired_key_does_not_store_the_default():
+    testdb = setup(sweep_interval=None)
+    testdb.set('a', 1, ttl=0.05)
+    time.sleep(0.1)
+    assert testdb['a'] is None
+    assert not testdb.has_key('a')
+    testdb.compact()
+    assert testdb.size() == 0
+    reopened = setup(sweep_interval=None)
+    assert reopened.size() == 0
+    reopened.close()
+    cleanup(testdb)
+
+
+def test_whole_db_accessors_leave_out_expired_keys():
+    testdb = setup(sweep_interval=None)
+    testdb.set('a', 1, ttl=0.05)
+    testdb.set('b', 2, ttl=60)
+    time.sleep(0.1)
+    assert testdb.keys() == ['b'] and testdb.values() == [2] and list(testdb) == [('b', 2)]
+    assert testdb.size() == 1
+    assert not testdb.has_value(1) and testdb.has_value(2)
+    cleanup(testdb)
+
+
+def test_ttl_is_refused_by_a_format_without_expiry_times():
+    testdb = setup(formatter=DefaultFormat(1), sweep_interval=None)
+    for write in (lambda: testdb.set('a', 1, ttl=60), lambda: testdb.update({'a': 1}, ttl=60)):
+        try:
+            write()
+            assert False
+        except ValueError:
+            pass
+    assert not testdb.has_key('a')
+    testdb.set('a', 1)
+    assert testdb['a'] == 1
+    cleanup(testdb)